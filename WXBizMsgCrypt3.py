@@ -10,14 +10,20 @@ import logging
 import base64
 import random
 import hashlib
+import re
 import time
 import struct
 from Crypto.Cipher import AES
 import xml.etree.cElementTree as ET
 import socket
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
 import ierror
 
+logger = logging.getLogger(__name__)
+
 
 """
 关于Crypto.Cipher模块，ImportError: No module named 'Crypto'解决方案
@@ -38,6 +44,14 @@ def throw_exception(message, exception_class=FormatException):
 class SHA1:
     """计算企业微信的消息签名接口"""
 
+    def __init__(self, token=None):
+        """
+        :param token: 可选，预先绑定的票据；绑定后可用 sign() 复用已哈希的票据前缀
+        """
+        self.token = token
+        # 预先对票据做一次哈希，排序后票据位于最前面时直接 copy() 复用
+        self._token_sha = hashlib.sha1(token.encode()) if token is not None else None
+
     def getSHA1(self, token, timestamp, nonce, encrypt):
         """用SHA1算法生成安全签名
         @param token:  票据
@@ -53,7 +67,28 @@ class SHA1:
             sha.update("".join(sortlist).encode())
             return ierror.WXBizMsgCrypt_OK, sha.hexdigest()
         except Exception as e:
-            logger = logging.getLogger()
+            logger.error(e)
+            return ierror.WXBizMsgCrypt_ComputeSignature_Error, None
+
+    def sign(self, timestamp, nonce, encrypt):
+        """使用构造时绑定的票据生成安全签名，结果与 getSHA1 一致
+        @param timestamp: 时间戳
+        @param nonce: 随机字符串
+        @param encrypt: 密文
+        @return: 安全签名
+        """
+        try:
+            sortlist = [timestamp, nonce, encrypt]
+            sortlist.sort()
+            if self.token <= sortlist[0]:
+                sha = self._token_sha.copy()
+            else:
+                sortlist.append(self.token)
+                sortlist.sort()
+                sha = hashlib.sha1()
+            sha.update("".join(sortlist).encode())
+            return ierror.WXBizMsgCrypt_OK, sha.hexdigest()
+        except Exception as e:
             logger.error(e)
             return ierror.WXBizMsgCrypt_ComputeSignature_Error, None
 
@@ -69,8 +104,31 @@ class XMLParse:
 <Nonce><![CDATA[%(nonce)s]]></Nonce>
 </xml>"""
 
+    # 快速扫描只处理已知格式：<xml> 下一层的简单节点 + 一个 <Encrypt><![CDATA[...]]></Encrypt>
+    ENCRYPT_OPEN = '<Encrypt><![CDATA['
+    ENCRYPT_CLOSE = ']]></Encrypt>'
+    # Encrypt 节点前后的部分只允许在该长度内，超出或不匹配时交给 ElementTree
+    SCAN_LIMIT = 4096
+    # 节点内容和节点之间不允许出现 ElementTree 会拒绝的控制字符，\s 也会匹配 \x0b、\x1c 等，这里只用xml的空白字符
+    _NODE = r'<(\w+)>(?:<!\[CDATA\[[^\]\x00-\x08\x0b\x0c\x0e-\x1f]*\]\]>|[^<&\x00-\x08\x0b\x0c\x0e-\x1f]*)</\1>'
+    _HEAD_RE = re.compile(r'(?:<\?xml[^<>\x00-\x08\x0b\x0c\x0e-\x1f]*\?>)?[ \t\r\n]*<xml>[ \t\r\n]*'
+                          r'(?:' + _NODE + r'[ \t\r\n]*)*')
+    _TAIL_RE = re.compile(r'[ \t\r\n]*(?:' + _NODE + r'[ \t\r\n]*)*</xml>[ \t\r\n]*')
+    # ASCII 中 isprintable 为 False 的字符
+    _CONTROL_BYTES = bytes(range(0x20)) + b'\x7f'
+
+    def __init__(self, fast=False):
+        """
+        :param fast: 为 True 时 extract 先用快速扫描提取 Encrypt 节点，不构建xml树
+        """
+        self.fast = fast
+
     def extract(self, xmltext):
         """提取xml数据包中的消息内容"""
+        if self.fast:
+            encrypt = self.scan_encrypt(xmltext)
+            if encrypt is not None:
+                return ierror.WXBizMsgCrypt_OK, encrypt
         try:
             xml_tree = ET.fromstring(xmltext)
             
@@ -87,10 +145,46 @@ class XMLParse:
             return ierror.WXBizMsgCrypt_OK, msg_dict
         
         except Exception as e:
-            logger = logging.getLogger()
             logger.error(e)
             return ierror.WXBizMsgCrypt_ParseXml_Error, None
 
+    def scan_encrypt(self, xmltext):
+        """不构建xml树，直接定位 Encrypt 节点的 CDATA 内容
+        @param xmltext: 回调的xml数据包，str 或 bytes
+        @return: 密文；数据包不是已知格式时返回 None
+        """
+        if isinstance(xmltext, (bytes, bytearray)):
+            try:
+                xmltext = xmltext.decode('utf-8')
+            except UnicodeDecodeError:
+                return None
+        start = xmltext.find(self.ENCRYPT_OPEN)
+        if start < 0 or start > self.SCAN_LIMIT or xmltext.find('<Encrypt>') != start:
+            return None
+        begin = start + len(self.ENCRYPT_OPEN)
+        end = xmltext.find(']]>', begin)
+        if end < 0 or not xmltext.startswith(self.ENCRYPT_CLOSE, end):
+            return None
+        tail = end + len(self.ENCRYPT_CLOSE)
+        if len(xmltext) - tail > self.SCAN_LIMIT:
+            return None
+        # Encrypt 前后都必须是 <xml> 下一层的简单节点，且不能出现第二个 Encrypt
+        if self._HEAD_RE.fullmatch(xmltext, 0, start) is None:
+            return None
+        if self._TAIL_RE.fullmatch(xmltext, tail) is None or xmltext.find('<Encrypt>', tail) >= 0:
+            return None
+        encrypt = xmltext[begin:end]
+        if not encrypt:
+            return None
+        # 换行、控制字符等会被 ElementTree 归一化或拒绝，这类数据包交给 ElementTree；
+        # 密文通常是 ASCII，此时只需排除控制字符，bytes.translate 比 isprintable 快数倍
+        if encrypt.isascii():
+            if len(encrypt.encode('ascii').translate(None, self._CONTROL_BYTES)) != len(encrypt):
+                return None
+        elif not encrypt.isprintable():
+            return None
+        return encrypt
+
     def generate(self, encrypt, signature, timestamp, nonce):
         """生成xml消息
         @param encrypt: 加密后的消息密文
@@ -113,6 +207,8 @@ class PKCS7Encoder():
     """提供基于PKCS7算法的加解密接口"""
 
     block_size = 32
+    # 补位字节表，下标为补位长度，避免每次重新拼接补位串
+    pad_table = tuple(bytes([n]) * n for n in range(block_size + 1))
 
     def encode(self, text):
         """ 对需要加密的明文进行填充补位
@@ -125,8 +221,7 @@ class PKCS7Encoder():
         if amount_to_pad == 0:
             amount_to_pad = self.block_size
         # 获得补位所用的字符
-        pad = chr(amount_to_pad)
-        return text + (pad * amount_to_pad).encode()
+        return text + self.pad_table[amount_to_pad]
 
     def decode(self, decrypted):
         """删除解密后明文的补位字符
@@ -140,7 +235,13 @@ class PKCS7Encoder():
 
 
 class Prpcrypt(object):
-    """提供接收和推送给企业微信消息的加解密接口"""
+    """提供接收和推送给企业微信消息的加解密接口
+
+    密钥、IV、补位器以及用于解密的 ECB 对象都在构造时准备好，同一个实例可以反复使用。
+    """
+
+    # 密文不超过该长度时使用 ECB + 异或完成 CBC 解密（实测 4KB 左右与 AES.new 持平）
+    ECB_DECRYPT_LIMIT = 4096
 
     def __init__(self, key):
 
@@ -148,6 +249,11 @@ class Prpcrypt(object):
         self.key = key
         # 设置加解密模式为AES的CBC模式
         self.mode = AES.MODE_CBC
+        self.iv = key[:16]
+        self.pkcs7 = PKCS7Encoder()
+        # CBC 对象带状态不能复用，ECB 对象无状态，可以复用来完成 CBC 解密：
+        # P[i] = D(C[i]) xor C[i-1]，其中 C[-1] 为 IV
+        self._ecb = AES.new(self.key, AES.MODE_ECB)
 
     def encrypt(self, text, receiveid):
         """对明文进行加密
@@ -156,54 +262,125 @@ class Prpcrypt(object):
         """
         # 16位随机字符串添加到明文开头
         text = text.encode()
-        text = self.get_random_str() + struct.pack("I", socket.htonl(len(text))) + text + receiveid.encode()
+        if isinstance(receiveid, str):
+            receiveid = receiveid.encode()
+        text = self.get_random_str() + struct.pack("I", socket.htonl(len(text))) + text + receiveid
 
         # 使用自定义的填充方式对明文进行补位填充
-        pkcs7 = PKCS7Encoder()
-        text = pkcs7.encode(text)
+        text = self.pkcs7.encode(text)
         # 加密
-        cryptor = AES.new(self.key, self.mode, self.key[:16])
+        cryptor = AES.new(self.key, self.mode, self.iv)
         try:
             ciphertext = cryptor.encrypt(text)
             # 使用BASE64对加密后的字符串进行编码
             return ierror.WXBizMsgCrypt_OK, base64.b64encode(ciphertext)
         except Exception as e:
-            logger = logging.getLogger()
             logger.error(e)
             return ierror.WXBizMsgCrypt_EncryptAES_Error, None
 
-    def decrypt(self, text, receiveid):
-        """对解密后的明文进行补位删除
-        @param text: 密文
-        @return: 删除填充补位后的明文
-        """
+    def _cbc_decrypt(self, ciphertext):
+        """AES-CBC 解密，短消息用复用的 ECB 对象完成，长消息仍新建 CBC 对象"""
+        size = len(ciphertext)
+        if size > self.ECB_DECRYPT_LIMIT:
+            # 长消息时整数异或的开销超过 AES.new，直接走 CBC
+            return AES.new(self.key, self.mode, self.iv).decrypt(ciphertext)
+        blocks = self._ecb.decrypt(ciphertext)
+        chain = self.iv + ciphertext[:-16]
+        return (int.from_bytes(blocks, 'little') ^ int.from_bytes(chain, 'little')).to_bytes(size, 'little')
+
+    def _unpack(self, plain_text, receiveid):
+        """去除补位、随机串并校验 receiveid，返回指向明文xml的 memoryview"""
         try:
-            cryptor = AES.new(self.key, self.mode, self.key[:16])
-            # 使用BASE64对密文进行解码，然后AES-CBC解密
-            plain_text = cryptor.decrypt(base64.b64decode(text))
-        except Exception as e:
-            logger = logging.getLogger()
-            logger.error(e)
-            return ierror.WXBizMsgCrypt_DecryptAES_Error, None
-        try:
-            pad = plain_text[-1]
-            # 去掉补位字符串
-            # pkcs7 = PKCS7Encoder()
-            # plain_text = pkcs7.encode(plain_text)
-            # 去除16位随机字符串
-            content = plain_text[16:-pad]
-            xml_len = socket.ntohl(struct.unpack("I", content[: 4])[0])
+            buf = memoryview(plain_text)
+            pad = buf[-1]
+            # 去除16位随机字符串以及补位字符串
+            content = buf[16:-pad]
+            xml_len = struct.unpack_from("!I", content)[0]
             xml_content = content[4: xml_len + 4]
             from_receiveid = content[xml_len + 4:]
         except Exception as e:
-            logger = logging.getLogger()
             logger.error(e)
             return ierror.WXBizMsgCrypt_IllegalBuffer, None
 
-        if from_receiveid.decode('utf8') != receiveid:
+        if isinstance(receiveid, str):
+            receiveid = receiveid.encode()
+        if from_receiveid != receiveid:
             return ierror.WXBizMsgCrypt_ValidateCorpid_Error, None
         return 0, xml_content
 
+    def decrypt_view(self, text, receiveid):
+        """解密并返回指向明文xml的 memoryview，不额外拷贝
+        @param text: 密文
+        @param receiveid: 期望的 receiveid，str 或 bytes
+        @return: (ret, memoryview)
+        """
+        try:
+            # 使用BASE64对密文进行解码，然后AES-CBC解密
+            plain_text = self._cbc_decrypt(base64.b64decode(text))
+        except Exception as e:
+            logger.error(e)
+            return ierror.WXBizMsgCrypt_DecryptAES_Error, None
+        return self._unpack(plain_text, receiveid)
+
+    def decrypt(self, text, receiveid):
+        """对解密后的明文进行补位删除
+        @param text: 密文
+        @return: 删除填充补位后的明文
+        """
+        ret, xml_content = self.decrypt_view(text, receiveid)
+        if ret != 0:
+            return ret, None
+        return 0, xml_content.tobytes()
+
+    def decrypt_many(self, texts, receiveid, buf=None):
+        """批量解密，短密文拼接后只调用一次 ECB 解密
+        @param texts: 密文列表
+        @param receiveid: 期望的 receiveid，str 或 bytes
+        @param buf: 可复用的 bytearray，用于存放 ECB 解密结果
+        @return: [(ret, xml_content)]，与逐条调用 decrypt 的结果一致
+        """
+        results = [None] * len(texts)
+        pending = []
+        total = 0
+        for i, text in enumerate(texts):
+            try:
+                ciphertext = base64.b64decode(text)
+            except Exception as e:
+                logger.error(e)
+                results[i] = (ierror.WXBizMsgCrypt_DecryptAES_Error, None)
+                continue
+            size = len(ciphertext)
+            if size == 0 or size % 16 or size > self.ECB_DECRYPT_LIMIT:
+                # 长消息或非法长度走单条路径，错误码保持一致
+                try:
+                    plain_text = self._cbc_decrypt(ciphertext)
+                except Exception as e:
+                    logger.error(e)
+                    results[i] = (ierror.WXBizMsgCrypt_DecryptAES_Error, None)
+                    continue
+                ret, xml_content = self._unpack(plain_text, receiveid)
+                results[i] = (ret, xml_content.tobytes() if ret == 0 else None)
+                continue
+            pending.append((i, total, ciphertext))
+            total += size
+
+        if not pending:
+            return results
+        if buf is None:
+            buf = bytearray(total)
+        elif len(buf) < total:
+            buf.extend(bytes(total - len(buf)))
+        out = memoryview(buf)[:total]
+        self._ecb.decrypt(b"".join(item[2] for item in pending), output=out)
+        for i, offset, ciphertext in pending:
+            size = len(ciphertext)
+            chain = self.iv + ciphertext[:-16]
+            plain_text = (int.from_bytes(out[offset: offset + size], 'little')
+                          ^ int.from_bytes(chain, 'little')).to_bytes(size, 'little')
+            ret, xml_content = self._unpack(plain_text, receiveid)
+            results[i] = (ret, xml_content.tobytes() if ret == 0 else None)
+        return results
+
     def get_random_str(self):
         """ 随机生成16位字符串
         @return: 16位字符串
@@ -222,7 +399,15 @@ class WXBizMsgCrypt(object):
             throw_exception("[error]: EncodingAESKey unvalid !", FormatException)
             # return ierror.WXBizMsgCrypt_IllegalAesKey,None
         self.m_sToken = sToken
+        self.m_sEncodingAESKey = sEncodingAESKey
         self.m_sReceiveId = sReceiveId
+        # 预先构建可复用的加解密上下文，避免每条消息都重新创建对象
+        self.m_bReceiveId = sReceiveId.encode()
+        self.sha1 = SHA1(sToken)
+        self.xmlParse = XMLParse(fast=True)
+        self.pc = Prpcrypt(self.key)
+        # 各阶段耗时回调 observer(stage, seconds)，stage 为 xml_extract/signature/decrypt，为 None 时不计时
+        self.stage_observer = None
 
         # 验证URL
         # @param sMsgSignature: 签名串，对应URL参数的msg_signature
@@ -233,14 +418,12 @@ class WXBizMsgCrypt(object):
         # @return：成功0，失败返回对应的错误码
 
     def VerifyURL(self, sMsgSignature, sTimeStamp, sNonce, sEchoStr):
-        sha1 = SHA1()
-        ret, signature = sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, sEchoStr)
+        ret, signature = self.sha1.sign(sTimeStamp, sNonce, sEchoStr)
         if ret != 0:
             return ret, None
         if not signature == sMsgSignature:
             return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
-        pc = Prpcrypt(self.key)
-        ret, sReplyEchoStr = pc.decrypt(sEchoStr, self.m_sReceiveId)
+        ret, sReplyEchoStr = self.pc.decrypt(sEchoStr, self.m_bReceiveId)
         return ret, sReplyEchoStr
 
     def EncryptMsg(self, sReplyMsg, sNonce, timestamp=None):
@@ -250,20 +433,17 @@ class WXBizMsgCrypt(object):
         # @param sNonce: 随机串，可以自己生成，也可以用URL参数的nonce
         # sEncryptMsg: 加密后的可以直接回复用户的密文，包括msg_signature, timestamp, nonce, encrypt的xml格式的字符串,
         # return：成功0，sEncryptMsg,失败返回对应的错误码None
-        pc = Prpcrypt(self.key)
-        ret, encrypt = pc.encrypt(sReplyMsg, self.m_sReceiveId)
-        encrypt = encrypt.decode('utf8')
+        ret, encrypt = self.pc.encrypt(sReplyMsg, self.m_bReceiveId)
         if ret != 0:
             return ret, None
+        encrypt = encrypt.decode('utf8')
         if timestamp is None:
             timestamp = str(int(time.time()))
         # 生成安全签名
-        sha1 = SHA1()
-        ret, signature = sha1.getSHA1(self.m_sToken, timestamp, sNonce, encrypt)
+        ret, signature = self.sha1.sign(timestamp, sNonce, encrypt)
         if ret != 0:
             return ret, None
-        xmlParse = XMLParse()
-        return ret, xmlParse.generate(encrypt, signature, timestamp, sNonce)
+        return ret, self.xmlParse.generate(encrypt, signature, timestamp, sNonce)
 
     def DecryptMsg(self, sPostData, sMsgSignature, sTimeStamp, sNonce):
         # 检验消息的真实性，并且获取解密后的明文
@@ -273,17 +453,118 @@ class WXBizMsgCrypt(object):
         # @param sPostData: 密文，对应POST请求的数据
         #  xml_content: 解密后的原文，当return返回0时有效
         # @return: 成功0，失败返回对应的错误码
+        if self.stage_observer is not None:
+            return self._decrypt_msg_timed(sPostData, sMsgSignature, sTimeStamp, sNonce)
         # 验证安全签名
-        xmlParse = XMLParse()
-        ret, encrypt = xmlParse.extract(sPostData)
+        ret, encrypt = self.xmlParse.extract(sPostData)
         if ret != 0:
             return ret, None
-        sha1 = SHA1()
-        ret, signature = sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, encrypt)
+        ret, signature = self.sha1.sign(sTimeStamp, sNonce, encrypt)
         if ret != 0:
             return ret, None
         if not signature == sMsgSignature:
             return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
-        pc = Prpcrypt(self.key)
-        ret, xml_content = pc.decrypt(encrypt, self.m_sReceiveId)
+        ret, xml_content = self.pc.decrypt(encrypt, self.m_bReceiveId)
         return ret, xml_content
+
+    def _decrypt_msg_timed(self, sPostData, sMsgSignature, sTimeStamp, sNonce):
+        """与 DecryptMsg 相同，并把各阶段耗时交给 stage_observer"""
+        observe = self.stage_observer
+        start = time.perf_counter()
+        ret, encrypt = self.xmlParse.extract(sPostData)
+        now = time.perf_counter()
+        observe('xml_extract', now - start)
+        if ret != 0:
+            return ret, None
+        start = now
+        ret, signature = self.sha1.sign(sTimeStamp, sNonce, encrypt)
+        now = time.perf_counter()
+        observe('signature', now - start)
+        if ret != 0:
+            return ret, None
+        if not signature == sMsgSignature:
+            return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
+        ret, xml_content = self.pc.decrypt(encrypt, self.m_bReceiveId)
+        observe('decrypt', time.perf_counter() - now)
+        return ret, xml_content
+
+    def DecryptMsgBatch(self, items, batch_size=256, processes=None):
+        # 批量检验并解密消息，按输入顺序逐条产出结果
+        # @param items: 可迭代对象，元素为 (sPostData, sMsgSignature, sTimeStamp, sNonce)
+        # @param batch_size: 每批处理的消息数，批内复用解密缓冲区
+        # @param processes: 大于1时把各批分发到进程池处理
+        # @return: 生成器，产出 (ret, xml_content)，错误码与 DecryptMsg 一致
+        batches = _chunked(items, batch_size)
+        if processes and processes > 1:
+            yield from self._decrypt_batches_in_pool(batches, processes)
+            return
+        buf = bytearray()
+        for batch in batches:
+            yield from self._decrypt_batch(batch, buf)
+
+    def EncryptMsgBatch(self, items):
+        # 批量加密回复消息，复用同一个加解密上下文
+        # @param items: 可迭代对象，元素为 (sReplyMsg, sNonce) 或 (sReplyMsg, sNonce, timestamp)
+        # @return: 生成器，产出 (ret, sEncryptMsg)，与 EncryptMsg 一致
+        for item in items:
+            yield self.EncryptMsg(*item)
+
+    def _decrypt_batch(self, batch, buf=None):
+        """校验一批消息的签名，再一次性解密通过校验的密文"""
+        results = [None] * len(batch)
+        indexes = []
+        encrypts = []
+        for i, (sPostData, sMsgSignature, sTimeStamp, sNonce) in enumerate(batch):
+            ret, encrypt = self.xmlParse.extract(sPostData)
+            if ret != 0:
+                results[i] = (ret, None)
+                continue
+            ret, signature = self.sha1.sign(sTimeStamp, sNonce, encrypt)
+            if ret != 0:
+                results[i] = (ret, None)
+                continue
+            if not signature == sMsgSignature:
+                results[i] = (ierror.WXBizMsgCrypt_ValidateSignature_Error, None)
+                continue
+            indexes.append(i)
+            encrypts.append(encrypt)
+        for i, result in zip(indexes, self.pc.decrypt_many(encrypts, self.m_bReceiveId, buf)):
+            results[i] = result
+        return results
+
+    def _decrypt_batches_in_pool(self, batches, processes):
+        """把各批消息交给进程池解密，最多同时挂起 processes*2 批，保持输出顺序"""
+        window = processes * 2
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_batch_worker,
+                                 initargs=(self.m_sToken, self.m_sEncodingAESKey, self.m_sReceiveId)) as pool:
+            futures = deque()
+            for batch in batches:
+                futures.append(pool.submit(_decrypt_batch_worker, batch))
+                if len(futures) >= window:
+                    yield from futures.popleft().result()
+            while futures:
+                yield from futures.popleft().result()
+
+
+def _chunked(items, size):
+    """把可迭代对象按 size 切成列表"""
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# 进程池中每个子进程各自持有一个加解密上下文
+_batch_wxcpt = None
+
+
+def _init_batch_worker(sToken, sEncodingAESKey, sReceiveId):
+    global _batch_wxcpt
+    _batch_wxcpt = WXBizMsgCrypt(sToken, sEncodingAESKey, sReceiveId)
+
+
+def _decrypt_batch_worker(batch):
+    return _batch_wxcpt._decrypt_batch(batch, bytearray())
@@ -1,8 +1,352 @@
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NameResolutionError, NewConnectionError, ConnectTimeoutError
 import json
-from typing import Optional, Dict, Any, Union
+import time
+import socket
+import asyncio
+import logging
+import threading
+import weakref
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from typing import Optional, Dict, Any, Union, Tuple, Callable, List, AsyncIterator
+
+from .ratelimit import RateLimiter
+
+try:
+    import httpx
+except ImportError:  # 仅 AsyncRequestClient 需要
+    httpx = None
+
+# 需要重试的状态码
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+# 读超时/状态码重试只针对幂等方法，与 urllib3 Retry 的默认行为一致；连接失败对所有方法重试
+RETRY_METHODS = frozenset({'DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT', 'TRACE'})
+# 记录 URL 时隐藏的查询参数
+REDACTED_PARAMS = frozenset({'access_token', 'corpsecret'})
+
+logger = logging.getLogger(__name__)
+# 当前线程正在进行的请求记录，由计时连接填写 DNS/连接/首字节耗时
+_trace_local = threading.local()
+
+
+def redact_url(url: str, params: Optional[Dict[str, Any]] = None) -> str:
+    """
+    隐藏 access_token 等敏感参数，得到可以记录的 URL 模板
+    >>> redact_url('https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token=abc')
+    'https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token=***'
+    """
+    parts = urlsplit(url.strip())
+    query = parse_qsl(parts.query, keep_blank_values=True) + list((params or {}).items())
+    query = [(key, '***' if key in REDACTED_PARAMS else value) for key, value in query]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query, safe='*'), ''))
+
+
+class RequestTrace:
+    """
+    一次请求的记录，交给 RequestHooks 中的钩子
+
+    dns/connect 为本次请求新建连接的耗时之和(复用连接时为 0)，connect 包含 TLS 握手；
+    ttfb 为最后一次尝试从发出请求到收到响应头的耗时；total 包含 urllib3 Retry 的重试和读取响应体；
+    attempts 为实际发出的次数，包括 urllib3 Retry 的重试。
+    AsyncRequestClient 的记录中 DNS 解析计入 connect(httpcore 不单独报告)，dns 为 0；
+    stream 的 total 和 bytes 在退出 async with 时记录，包含读取响应体。
+    """
+
+    __slots__ = ('method', 'url', 'endpoint', 'status', 'attempts', 'dns', 'connect', 'ttfb', 'total', 'bytes', 'error',
+                 'started', '_sent_at')
+
+    def __init__(self, method: str, url: str):
+        self.method = method
+        self.url = url
+        self.endpoint = RateLimiter.endpoint_of(url)
+        self.status = 0
+        self.attempts = 0
+        self.dns = 0.0
+        self.connect = 0.0
+        self.ttfb = 0.0
+        self.total = 0.0
+        self.bytes = 0
+        self.error: Optional[str] = None
+        self.started = time.time()
+        self._sent_at = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'method': self.method, 'url': self.url, 'endpoint': self.endpoint, 'status': self.status, 'attempts': self.attempts,
+                'dns': round(self.dns, 6), 'connect': round(self.connect, 6), 'ttfb': round(self.ttfb, 6),
+                'total': round(self.total, 6), 'bytes': self.bytes, 'error': self.error}
+
+
+class RequestHooks:
+    """
+    RequestClient/AsyncRequestClient 的请求钩子
+
+    pre 钩子在发出请求前调用，post 钩子在请求完成(包括失败)后调用，参数都是 RequestTrace；
+    钩子抛出的异常只记录日志，不影响请求。没有钩子时 RequestClient 不做任何记录。
+
+    示例：
+    >>> request_hooks.add(post=lambda trace: print(trace.url, trace.status, trace.total))
+    """
+
+    def __init__(self):
+        self.pre: List[Callable[[RequestTrace], None]] = []
+        self.post: List[Callable[[RequestTrace], None]] = []
+
+    def __bool__(self):
+        return bool(self.pre or self.post)
+
+    def add(self, pre: Optional[Callable[[RequestTrace], None]] = None,
+            post: Optional[Callable[[RequestTrace], None]] = None):
+        if pre is not None:
+            self.pre.append(pre)
+        if post is not None:
+            self.post.append(post)
+
+    def remove(self, hook: Callable[[RequestTrace], None]):
+        for hooks in (self.pre, self.post):
+            while hook in hooks:
+                hooks.remove(hook)
+
+    def run(self, hooks: List[Callable[[RequestTrace], None]], trace: RequestTrace):
+        for hook in list(hooks):
+            try:
+                hook(trace)
+            except Exception:
+                logger.exception("Request hook %r failed", hook)
+
+
+# 未指定 hooks 的 RequestClient/AsyncRequestClient 共用
+request_hooks = RequestHooks()
+
+
+def _trace_error(trace: RequestTrace, e: 'RequestException'):
+    """请求失败时记录状态码(有响应时)和原始异常类型"""
+    original = e.original_exception
+    response = getattr(original, 'response', None)
+    if response is not None:
+        trace.status = response.status_code
+    trace.error = type(original or e).__name__
+
+
+# httpcore 新建连接的事件，TCP 连接包含 DNS 解析
+_CONNECT_STARTED = frozenset({'connection.connect_tcp.started', 'connection.connect_unix_socket.started',
+                              'connection.start_tls.started'})
+_CONNECT_COMPLETE = frozenset({'connection.connect_tcp.complete', 'connection.connect_unix_socket.complete',
+                               'connection.start_tls.complete'})
+
+
+def _httpcore_trace(trace: RequestTrace) -> Callable:
+    """
+    httpcore 的 trace 扩展，记录新建连接(含DNS和TLS)的耗时和首字节耗时
+    事件名形如 connection.connect_tcp.started、http11.receive_response_headers.complete
+    """
+    connect_started = 0.0
+
+    async def on_event(name: str, info: Dict[str, Any]):
+        nonlocal connect_started
+        now = time.perf_counter()
+        if name in _CONNECT_STARTED:
+            connect_started = now
+        elif name in _CONNECT_COMPLETE and connect_started:
+            trace.connect += now - connect_started
+            connect_started = 0.0
+        elif name.endswith('.send_request_body.complete'):
+            trace._sent_at = now
+        elif name.endswith('.receive_response_headers.complete') and trace._sent_at:
+            trace.ttfb = now - trace._sent_at
+
+    return on_event
+
+
+class _TimingConnectionMixin:
+    """记录 DNS/连接/首字节耗时的 urllib3 连接，当前线程没有 RequestTrace 时与原连接一致"""
+
+    def _new_conn(self):
+        trace = getattr(_trace_local, 'trace', None)
+        if trace is None:
+            return super()._new_conn()
+        # 先解析再逐个地址连接，分别计时；TLS 证书校验和 SNI 仍使用 self.host
+        start = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host, self.port, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        finally:
+            trace.dns += time.perf_counter() - start
+        dns_host = self._dns_host
+        error = None
+        try:
+            for *_, sockaddr in dict.fromkeys(addresses):
+                self._dns_host = sockaddr[0]
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError) as e:
+                    error = e
+            raise error
+        finally:
+            self._dns_host = dns_host
+
+    def connect(self):
+        trace = getattr(_trace_local, 'trace', None)
+        if trace is None:
+            return super().connect()
+        start = time.perf_counter()
+        dns = trace.dns
+        try:
+            return super().connect()
+        finally:
+            trace.connect += time.perf_counter() - start - (trace.dns - dns)
+
+    def request(self, *args, **kwargs):
+        trace = getattr(_trace_local, 'trace', None)
+        if trace is not None:
+            trace.attempts += 1
+        result = super().request(*args, **kwargs)
+        if trace is not None:
+            trace._sent_at = time.perf_counter()
+        return result
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        trace = getattr(_trace_local, 'trace', None)
+        if trace is not None and trace._sent_at:
+            trace.ttfb = time.perf_counter() - trace._sent_at
+        return response
+
+
+class _TimingHTTPConnection(_TimingConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimingHTTPSConnection(_TimingConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimingHTTPConnection
+
+
+class _TimingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimingHTTPSConnection
+
+
+class _TimingHTTPAdapter(HTTPAdapter):
+    """使用计时连接的 HTTPAdapter"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimingHTTPConnectionPool,
+                                                   'https': _TimingHTTPSConnectionPool}
+
+
+class ConnectionManager:
+    """
+    进程内共享的连接池
+
+    功能：
+    - 同步客户端共用 requests.Session(按重试配置区分)，同一主机的连接在各模块之间复用
+    - 异步客户端按 事件循环+主机 复用 httpx.AsyncClient
+    - 按主机配置连接数、空闲连接数和 keep-alive 时间
+
+    示例：
+    >>> connection_manager.configure_host('qyapi.weixin.qq.com', max_connections=50, keepalive_expiry=60)
+    >>> session = connection_manager.session()
+    >>> client = connection_manager.async_client('https://qyapi.weixin.qq.com/cgi-bin/gettoken')
+    """
+
+    def __init__(self, max_connections: int = 20, max_keepalive: int = 10, keepalive_expiry: float = 30.0):
+        """
+        :param max_connections: 每个主机的默认最大连接数
+        :param max_keepalive: 每个主机的默认空闲连接数(仅异步客户端)
+        :param keepalive_expiry: 空闲连接保持时间(秒，仅异步客户端，requests 由服务端决定)
+        """
+        self.defaults = {'max_connections': max_connections, 'max_keepalive': max_keepalive,
+                         'keepalive_expiry': keepalive_expiry}
+        self._hosts: Dict[str, Dict[str, Any]] = {}
+        self._sessions: Dict[Tuple[int, float], requests.Session] = {}
+        # 事件循环 -> {主机: AsyncClient}，事件循环关闭回收后自动清理
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def configure_host(self, host: Optional[str] = None, **options):
+        """
+        配置主机的连接池，host 为 None 时修改默认配置；异步客户端需在首次请求前配置
+
+        :param options: max_connections, max_keepalive, keepalive_expiry
+        """
+        unknown = set(options) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"unknown pool options: {sorted(unknown)}")
+        with self._lock:
+            if host is None:
+                self.defaults.update(options)
+            else:
+                self._hosts.setdefault(host, {}).update(options)
+            for (max_retries, backoff_factor), session in self._sessions.items():
+                self._mount(session, max_retries, backoff_factor)
+
+    def host_config(self, host: str) -> Dict[str, Any]:
+        return {**self.defaults, **self._hosts.get(host, {})}
+
+    def session(self, max_retries: int = 3, backoff_factor: float = 0.3) -> requests.Session:
+        """相同重试配置的同步客户端共用一个 Session"""
+        key = (max_retries, backoff_factor)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = requests.Session()
+                    self._mount(session, max_retries, backoff_factor)
+                    self._sessions[key] = session
+        return session
+
+    def async_client(self, url: str) -> 'httpx.AsyncClient':
+        """当前事件循环中 url 所在主机的 AsyncClient，必须在事件循环中调用"""
+        if httpx is None:
+            raise RuntimeError("httpx is required for AsyncRequestClient")
+        loop = asyncio.get_running_loop()
+        host = urlsplit(url.strip()).netloc
+        clients = self._async_clients.get(loop)
+        if clients is None:
+            clients = self._async_clients.setdefault(loop, {})
+        client = clients.get(host)
+        if client is None:
+            config = self.host_config(host)
+            client = clients[host] = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=config['max_connections'],
+                max_keepalive_connections=config['max_keepalive'],
+                keepalive_expiry=config['keepalive_expiry']))
+        return client
+
+    async def aclose(self):
+        """关闭当前事件循环中的异步客户端"""
+        clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+    def _mount(self, session: requests.Session, max_retries: int, backoff_factor: float):
+        retry_strategy = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=list(RETRY_STATUS)
+        )
+        default = _TimingHTTPAdapter(max_retries=retry_strategy, pool_maxsize=self.defaults['max_connections'])
+        session.mount("http://", default)
+        session.mount("https://", default)
+        for host, options in self._hosts.items():
+            if 'max_connections' in options:
+                adapter = _TimingHTTPAdapter(max_retries=retry_strategy, pool_maxsize=options['max_connections'])
+                session.mount(f"http://{host}", adapter)
+                session.mount(f"https://{host}", adapter)
+
+
+# 进程内共享的连接池
+connection_manager = ConnectionManager()
 
 class RequestClient:
     """
@@ -27,7 +371,10 @@ class RequestClient:
         max_retries: int = 3,
         backoff_factor: float = 0.3,
         timeout: float = 10.0,
-        default_headers: Optional[Dict[str, str]] = None
+        default_headers: Optional[Dict[str, str]] = None,
+        session: Optional[requests.Session] = None,
+        limiter=None,
+        hooks: Optional[RequestHooks] = None
     ):
         """
         初始化请求客户端
@@ -36,23 +383,19 @@ class RequestClient:
         :param backoff_factor: 重试间隔因子
         :param timeout: 默认超时时间(秒)
         :param default_headers: 默认请求头
+        :param session: 自定义 Session，默认使用 connection_manager 中共享的 Session
+        :param limiter: 限流器(RateLimiter)，超限的请求排队等待后再发出
+        :param hooks: 请求钩子，默认使用进程内共享的 request_hooks
         """
-        self.session = requests.Session()
+        # 重试策略配置在共享 Session 的连接池上，相同配置的客户端复用连接
+        self.session = session or connection_manager.session(max_retries, backoff_factor)
+        self.limiter = limiter
+        self.hooks = request_hooks if hooks is None else hooks
         self.timeout = timeout
         self.default_headers = default_headers or {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
 
-        # 配置重试策略
-        retry_strategy = Retry(
-            total=max_retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=[408, 429, 500, 502, 503, 504]
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session.mount("http://", adapter)
-        self.session.mount("https://", adapter)
-
     def request(
         self,
         method: str,
@@ -62,6 +405,7 @@ class RequestClient:
         json_data: Optional[Dict[str, Any]] = None,
         headers: Optional[Dict[str, str]] = None,
         timeout: Optional[float] = None,
+        rate_keys: Optional[Dict[str, str]] = None,
         **kwargs
     ) -> requests.Response:
         """
@@ -74,13 +418,39 @@ class RequestClient:
         :param json_data: JSON数据
         :param headers: 请求头
         :param timeout: 超时时间(秒)
+        :param rate_keys: 限流维度，如 {'corp': corpid, 'external_userid': userid}
         :param kwargs: 其他requests参数
         :return: requests.Response对象
         :raises: RequestException 当请求失败时抛出
         """
         headers = {**self.default_headers, **(headers or {})}
         timeout = timeout or self.timeout
+        if self.limiter is not None:
+            self.limiter.acquire(url, rate_keys)
+        if not self.hooks:
+            return self._send(method, url, params, data, json_data, headers, timeout, **kwargs)
+
+        trace = RequestTrace(method.upper(), redact_url(url, params))
+        self.hooks.run(self.hooks.pre, trace)
+        _trace_local.trace = trace
+        start = time.perf_counter()
+        try:
+            response = self._send(method, url, params, data, json_data, headers, timeout, **kwargs)
+            trace.status = response.status_code
+            if kwargs.get('stream'):
+                trace.bytes = int(response.headers.get('Content-Length') or 0)
+            else:
+                trace.bytes = len(response.content)
+            return response
+        except RequestException as e:
+            _trace_error(trace, e)
+            raise
+        finally:
+            trace.total = time.perf_counter() - start
+            _trace_local.trace = None
+            self.hooks.run(self.hooks.post, trace)
 
+    def _send(self, method, url, params, data, json_data, headers, timeout, **kwargs) -> requests.Response:
         try:
             response = self.session.request(
                 method=method.upper(),
@@ -169,6 +539,285 @@ class RequestClient:
         return response.json()
 
 
+class AsyncRequestClient:
+    """
+    HTTP 请求客户端的异步版本，接口与 RequestClient 一致
+
+    功能：
+    - 基于 httpx.AsyncClient，连接由 connection_manager 按主机共享
+    - 408/429/5xx 状态码和连接失败时按指数退避重试
+    - 统一抛出 RequestException
+    - 与 RequestClient 共用请求钩子，记录连接/首字节/总耗时、状态码、响应大小和发出次数
+
+    示例：
+    >>> client = AsyncRequestClient()
+    >>> response = await client.get('https://api.example.com/data')
+    >>> print(response.status_code, response.json())
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        backoff_factor: float = 0.3,
+        timeout: float = 10.0,
+        default_headers: Optional[Dict[str, str]] = None,
+        manager: Optional[ConnectionManager] = None,
+        limiter=None,
+        hooks: Optional[RequestHooks] = None
+    ):
+        """
+        初始化异步请求客户端
+
+        :param max_retries: 最大重试次数
+        :param backoff_factor: 重试间隔因子，第 n 次重试前等待 backoff_factor * 2 ** (n - 1) 秒
+        :param timeout: 默认超时时间(秒)
+        :param default_headers: 默认请求头
+        :param manager: 连接池管理器，默认使用进程内共享的 connection_manager
+        :param limiter: 限流器(RateLimiter)，超限的请求排队等待后再发出
+        :param hooks: 请求钩子，默认使用进程内共享的 request_hooks
+        """
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.default_headers = default_headers or {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        }
+        self.manager = manager or connection_manager
+        self.limiter = limiter
+        self.hooks = request_hooks if hooks is None else hooks
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        data: Optional[Union[Dict[str, Any], str, bytes]] = None,
+        json_data: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        rate_keys: Optional[Dict[str, str]] = None,
+        **kwargs
+    ) -> 'httpx.Response':
+        """
+        发送 HTTP 请求
+
+        :param method: HTTP 方法 (GET, POST, PUT, DELETE等)
+        :param url: 请求URL
+        :param params: URL查询参数
+        :param data: 表单数据
+        :param json_data: JSON数据
+        :param headers: 请求头
+        :param timeout: 超时时间(秒)
+        :param rate_keys: 限流维度，如 {'corp': corpid, 'external_userid': userid}
+        :param kwargs: 其他httpx参数
+        :return: httpx.Response对象
+        :raises: RequestException 当请求失败时抛出
+        """
+        method = method.upper()
+        url = url.strip()
+        headers = {**self.default_headers, **(headers or {})}
+        timeout = timeout or self.timeout
+        if isinstance(data, (str, bytes)):
+            kwargs['content'] = data
+            data = None
+        if self.limiter is not None:
+            await self.limiter.aacquire(url, rate_keys)
+        client = self.manager.async_client(url)
+        if not self.hooks:
+            return await self._request(client, method, url, params, data, json_data, headers, timeout, None, **kwargs)
+
+        trace = RequestTrace(method, redact_url(url, params))
+        self.hooks.run(self.hooks.pre, trace)
+        start = time.perf_counter()
+        try:
+            response = await self._request(client, method, url, params, data, json_data, headers, timeout, trace,
+                                           **kwargs)
+            trace.status = response.status_code
+            trace.bytes = len(response.content)
+            return response
+        except RequestException as e:
+            _trace_error(trace, e)
+            raise
+        finally:
+            trace.total = time.perf_counter() - start
+            self.hooks.run(self.hooks.post, trace)
+
+    async def _request(self, client, method, url, params, data, json_data, headers, timeout, trace,
+                       **kwargs) -> 'httpx.Response':
+        response = await self._send(client, method, url, params, data, json_data, headers, timeout, trace,
+                                    stream=False, **kwargs)
+        try:
+            response.raise_for_status()  # 检查HTTP错误状态
+        except httpx.HTTPStatusError as e:
+            raise RequestException(f"Request failed: {str(e)}", original_exception=e)
+        return response
+
+    async def _send(self, client, method, url, params, data, json_data, headers, timeout, trace, stream,
+                    **kwargs) -> 'httpx.Response':
+        """
+        发出请求并按规则重试，返回最后一次的响应(不检查状态码)
+        :param trace: 不为 None 时记录发出次数、连接和首字节耗时
+        :param stream: 为 True 时收到响应头即返回，响应体由调用方读取并关闭
+        """
+        if trace is not None:
+            kwargs['extensions'] = {**kwargs.get('extensions', {}), 'trace': _httpcore_trace(trace)}
+        attempt = 0
+        while True:
+            if trace is not None:
+                trace.attempts += 1
+            try:
+                request = client.build_request(method, url, params=params, data=data, json=json_data,
+                                               headers=headers, timeout=timeout, **kwargs)
+                response = await client.send(request, stream=stream)
+            except httpx.TransportError as e:
+                retryable = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) or method in RETRY_METHODS
+                if not retryable or attempt >= self.max_retries:
+                    raise RequestException(f"Request failed: {str(e)}", original_exception=e)
+            else:
+                if response.status_code not in RETRY_STATUS or method not in RETRY_METHODS \
+                        or attempt >= self.max_retries:
+                    return response
+                await response.aclose()
+            attempt += 1
+            await asyncio.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+
+    @asynccontextmanager
+    async def stream(
+        self,
+        method: str,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        data: Optional[Union[Dict[str, Any], str, bytes]] = None,
+        json_data: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        rate_keys: Optional[Dict[str, str]] = None,
+        **kwargs
+    ) -> AsyncIterator['httpx.Response']:
+        """
+        发送 HTTP 请求，收到响应头后即返回，响应体由调用方逐块读取
+
+        重试规则与 request 相同，但只在收到响应头之前重试；读取响应体时的网络错误同样转换为 RequestException。
+
+        示例：
+        >>> async with client.stream('POST', url, json_data=data) as response:
+        ...     async for text in response.aiter_text():
+        ...         print(text)
+
+        :param timeout: 连接和相邻两次读取之间的超时时间(秒)，不限制响应体的总读取时间
+        :raises: RequestException 当请求失败时抛出
+        """
+        method = method.upper()
+        url = url.strip()
+        headers = {**self.default_headers, **(headers or {})}
+        timeout = timeout or self.timeout
+        if isinstance(data, (str, bytes)):
+            kwargs['content'] = data
+            data = None
+        if self.limiter is not None:
+            await self.limiter.aacquire(url, rate_keys)
+        client = self.manager.async_client(url)
+        trace = RequestTrace(method, redact_url(url, params)) if self.hooks else None
+        if trace is not None:
+            self.hooks.run(self.hooks.pre, trace)
+        start = time.perf_counter()
+        try:
+            response = await self._send(client, method, url, params, data, json_data, headers, timeout, trace,
+                                        stream=True, **kwargs)
+            if trace is not None:
+                trace.status = response.status_code
+            try:
+                try:
+                    response.raise_for_status()  # 检查HTTP错误状态
+                except httpx.HTTPStatusError as e:
+                    raise RequestException(f"Request failed: {str(e)}", original_exception=e)
+                yield response
+            except httpx.TransportError as e:
+                raise RequestException(f"Request failed: {str(e)}", original_exception=e)
+            finally:
+                if trace is not None:
+                    trace.bytes = response.num_bytes_downloaded
+                await response.aclose()
+        except RequestException as e:
+            if trace is not None:
+                _trace_error(trace, e)
+            raise
+        finally:
+            if trace is not None:
+                trace.total = time.perf_counter() - start
+                self.hooks.run(self.hooks.post, trace)
+
+    async def get(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> 'httpx.Response':
+        """发送GET请求"""
+        return await self.request('GET', url, params=params, headers=headers, timeout=timeout, **kwargs)
+
+    async def post(
+        self,
+        url: str,
+        data: Optional[Union[Dict[str, Any], str, bytes]] = None,
+        json_data: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> 'httpx.Response':
+        """发送POST请求"""
+        return await self.request('POST', url, data=data, json_data=json_data, headers=headers, timeout=timeout,
+                                  **kwargs)
+
+    async def put(
+        self,
+        url: str,
+        data: Optional[Union[Dict[str, Any], str, bytes]] = None,
+        json_data: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> 'httpx.Response':
+        """发送PUT请求"""
+        return await self.request('PUT', url, data=data, json_data=json_data, headers=headers, timeout=timeout,
+                                  **kwargs)
+
+    async def delete(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> 'httpx.Response':
+        """发送DELETE请求"""
+        return await self.request('DELETE', url, headers=headers, timeout=timeout, **kwargs)
+
+    async def get_json(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> Any:
+        """发送GET请求并返回JSON数据"""
+        response = await self.get(url, params=params, headers=headers, timeout=timeout, **kwargs)
+        return response.json()
+
+    async def post_json(
+        self,
+        url: str,
+        json_data: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> Any:
+        """发送POST请求并返回JSON数据"""
+        response = await self.post(url, json_data=json_data, headers=headers, timeout=timeout, **kwargs)
+        return response.json()
+
 class RequestException(Exception):
     """自定义请求异常类"""
     def __init__(self, message: str, original_exception: Optional[Exception] = None):
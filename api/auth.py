@@ -1,40 +1,364 @@
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from .api import RequestClient
 from .api import RequestException
+from . import config
 from .config import CORPID
 from .config import CORPSECRET,CONTACT_CORPSECRET,WECHAT_SECRECT
+from .dispatcher import run_blocking
+from .ratelimit import rate_limiter
+from .metrics import time_upstream, TOKEN_REFRESH_SECONDS, TOKEN_AGE_SECONDS, TOKEN_EXPIRES_IN_SECONDS
+
+logger = logging.getLogger(__name__)
 # 创建客户端实例
-client = RequestClient(max_retries=3, timeout=15)
+client = RequestClient(max_retries=3, timeout=15, limiter=rate_limiter)
+
+# access_token 过期或无效时接口返回的错误码
+INVALID_TOKEN_ERRCODES = (40014, 42001)
+
+
+def _fetch_access_token(corpid: str, secret: str) -> Optional[Tuple[str, float]]:
+    """
+    调用 gettoken 获取 access_token
+    :return: (access_token, expires_in)，失败时返回 None
+    """
+    try:
+        with time_upstream('gettoken'):
+            response = client.get(config.QYAPI_BASE_URL + '/cgi-bin/gettoken',
+                                params={'corpid': corpid,'corpsecret':secret}, rate_keys={'corp': corpid})
+        result = response.json()
+    except (RequestException, ValueError) as e:
+        logger.error(f"请求失败: {e}")
+        return None
+    if result.get('errcode', 0) != 0 or not result.get('access_token'):
+        logger.error(f"获取access_token失败: {result.get('errcode')} {result.get('errmsg')}")
+        return None
+    return result['access_token'], float(result.get('expires_in', 7200))
+
+
+class TokenManager:
+    """
+    access_token 缓存
+
+    功能：
+    - 按 (corpid, secret) 缓存 token，在 expires_in 到期前 refresh_margin 秒刷新
+    - 同一个 key 同时只有一个线程调用 gettoken，其余线程等待并复用结果
+    - 接口返回 40014/42001 时作废该 token 并重新获取，每次调用最多重试一次
+    - 设置 store(SharedStore) 后 token 保存在 wechat.db 中，同一台机器上的多个进程共享，
+      刷新时加跨进程租约，同一时间只有一个进程调用 gettoken
+
+    示例：
+    >>> manager = TokenManager()
+    >>> token = manager.get(CORPID, WECHAT_SECRECT)
+    >>> result = manager.call(CORPID, WECHAT_SECRECT, lambda token: client.post(url + token).json())
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str, str], Optional[Tuple[str, float]]] = _fetch_access_token,
+        refresh_margin: float = 300.0,
+        store=None,
+        wait_timeout: float = 5.0,
+        clock: Callable[[], float] = time.time
+    ):
+        """
+        :param fetch: 获取 token 的函数 fetch(corpid, secret) -> (access_token, expires_in) 或 None
+        :param refresh_margin: 提前多少秒视为过期
+        :param store: SharedStore实例，为 None 时仅在进程内缓存
+        :param wait_timeout: 其他进程正在刷新时最多等待多少秒，超时后自行获取
+        :param clock: 时间函数(墙上时间，多进程共享时需一致)
+        """
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.store = store
+        self.wait_timeout = wait_timeout
+        self.clock = clock
+        # (corpid, secret) -> (access_token, 过期时间, 获取时间)
+        self._tokens: Dict[Tuple[str, str], Tuple[str, float, float]] = {}
+        self._locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self._names: Dict[Tuple[str, str], str] = {}
+        # 使用过的 key，后台刷新只处理这些 key
+        self._seen = set()
+        self.fetches = 0
+
+    def register(self, corpid: str, secret: str, name: str):
+        """为 key 指定指标中使用的名字，避免 secret 出现在标签中"""
+        self._names[(corpid, secret)] = name
+
+    def name(self, key: Tuple[str, str]) -> str:
+        name = self._names.get(key)
+        if name is None:
+            name = f"{key[0]}:{hashlib.sha1(key[1].encode()).hexdigest()[:8]}"
+        return name
+
+    def keys(self) -> List[Tuple[str, str]]:
+        return list(self._seen)
+
+    def get(self, corpid: str, secret: str) -> Optional[str]:
+        """获取有效的 access_token，缓存过期时刷新，失败时返回 None"""
+        key = (corpid, secret)
+        cached = self._tokens.get(key)
+        if cached is not None and self._fresh(cached, self.refresh_margin):
+            return cached[0]
+        self._seen.add(key)
+        with self._lock_for(key):
+            entry = self._obtain(key, self.refresh_margin, 'request')
+            return entry[0] if entry is not None else None
+
+    def refresh(self, corpid: str, secret: str, ahead: float) -> Optional[str]:
+        """
+        后台提前刷新：剩余有效期不足 ahead 秒时重新获取
+        :return: 刷新后的 access_token，失败时返回 None
+        """
+        key = (corpid, secret)
+        with self._lock_for(key):
+            entry = self._obtain(key, ahead, 'background')
+            return entry[0] if entry is not None else None
+
+    def peek(self, corpid: str, secret: str) -> Optional[Tuple[str, float, float]]:
+        """不触发刷新，返回 (access_token, 过期时间, 获取时间)"""
+        key = (corpid, secret)
+        return self._tokens.get(key) or self._load_shared(key)
+
+    def invalidate(self, corpid: str, secret: str, token: str):
+        """作废 token，仅当缓存中仍是该 token 时生效，避免并发调用方重复刷新"""
+        key = (corpid, secret)
+        with self._lock_for(key):
+            cached = self._tokens.get(key)
+            if cached is not None and cached[0] == token:
+                del self._tokens[key]
+            shared = self._load_shared(key)
+            if shared is not None and shared[0] == token:
+                self.store.delete(self._store_key(key))
+
+    def call(self, corpid: str, secret: str, request: Callable[[str], Any]) -> Any:
+        """
+        使用 access_token 调用接口，token 无效时刷新后重试一次
+        :param request: request(access_token) -> 接口返回的 JSON 字典
+        :return: request 的返回值，获取 token 失败时返回 None
+        """
+        token = self.get(corpid, secret)
+        if token is None:
+            return None
+        result = request(token)
+        if isinstance(result, dict) and result.get('errcode') in INVALID_TOKEN_ERRCODES:
+            logger.warning(f"access_token无效({result.get('errcode')})，刷新后重试")
+            self.invalidate(corpid, secret, token)
+            token = self.get(corpid, secret)
+            if token is None:
+                return result
+            result = request(token)
+        return result
+
+    async def aget(self, corpid: str, secret: str) -> Optional[str]:
+        """get 的异步版本，缓存有效时不切换线程，需要刷新时在线程池中执行"""
+        cached = self._tokens.get((corpid, secret))
+        if cached is not None and self._fresh(cached, self.refresh_margin):
+            return cached[0]
+        return await run_blocking(self.get, corpid, secret)
+
+    async def acall(self, corpid: str, secret: str, request: Callable[[str], Awaitable[Any]]) -> Any:
+        """
+        call 的异步版本
+        :param request: 协程函数 request(access_token) -> 接口返回的 JSON 字典
+        """
+        token = await self.aget(corpid, secret)
+        if token is None:
+            return None
+        result = await request(token)
+        if isinstance(result, dict) and result.get('errcode') in INVALID_TOKEN_ERRCODES:
+            logger.warning(f"access_token无效({result.get('errcode')})，刷新后重试")
+            await run_blocking(self.invalidate, corpid, secret, token)
+            token = await self.aget(corpid, secret)
+            if token is None:
+                return result
+            result = await request(token)
+        return result
+
+    def ages(self) -> Dict[Tuple[str], float]:
+        """各 token 的已使用时长(秒)，供 /metrics 抓取时计算"""
+        now = self.clock()
+        return {(self.name(key),): round(now - entry[2], 3) for key, entry in list(self._tokens.items())}
+
+    def expires_in(self) -> Dict[Tuple[str], float]:
+        now = self.clock()
+        return {(self.name(key),): round(entry[1] - now, 3) for key, entry in list(self._tokens.items())}
+
+    def _fresh(self, entry: Tuple[str, float, float], margin: float) -> bool:
+        return entry[1] - margin > self.clock()
+
+    def _obtain(self, key: Tuple[str, str], margin: float, trigger: str) -> Optional[Tuple[str, float, float]]:
+        """在 key 的进程内锁中调用：依次查看本地缓存、共享存储，都不满足时获取新 token"""
+        cached = self._tokens.get(key)
+        if cached is not None and self._fresh(cached, margin):
+            return cached
+        shared = self._load_shared(key)
+        if shared is not None and self._fresh(shared, margin):
+            self._tokens[key] = shared
+            return shared
+        if self.store is None:
+            return self._fetch_and_save(key, trigger)
+
+        with self.store.lease(f"token_refresh:{self.name(key)}", ttl=max(self.wait_timeout, 30)) as acquired:
+            if acquired:
+                # 拿到租约前其他进程可能刚刷新完
+                shared = self._load_shared(key)
+                if shared is not None and self._fresh(shared, margin):
+                    self._tokens[key] = shared
+                    return shared
+                return self._fetch_and_save(key, trigger)
+        # 其他进程正在刷新，等待其写入共享存储
+        deadline = self.clock() + self.wait_timeout
+        while self.clock() < deadline:
+            time.sleep(0.05)
+            shared = self._load_shared(key)
+            if shared is not None and self._fresh(shared, margin):
+                self._tokens[key] = shared
+                return shared
+        return self._fetch_and_save(key, trigger)
+
+    def _fetch_and_save(self, key: Tuple[str, str], trigger: str) -> Optional[Tuple[str, float, float]]:
+        self.fetches += 1
+        start = time.perf_counter()
+        fetched = self.fetch(*key)
+        TOKEN_REFRESH_SECONDS.observe(time.perf_counter() - start, self.name(key), trigger,
+                                      'ok' if fetched is not None else 'error')
+        if fetched is None:
+            return None
+        token, expires_in = fetched
+        now = self.clock()
+        entry = (token, now + expires_in, now)
+        self._tokens[key] = entry
+        if self.store is not None:
+            self.store.set(self._store_key(key), {'access_token': token, 'expires_at': entry[1], 'fetched_at': now},
+                           ttl=expires_in)
+        return entry
+
+    def _load_shared(self, key: Tuple[str, str]) -> Optional[Tuple[str, float, float]]:
+        if self.store is None:
+            return None
+        value = self.store.get(self._store_key(key))
+        if value is None:
+            return None
+        return value['access_token'], value['expires_at'], value['fetched_at']
+
+    def _store_key(self, key: Tuple[str, str]) -> str:
+        # 共享存储中只保存 secret 的摘要
+        return f"token:{key[0]}:{hashlib.sha1(key[1].encode()).hexdigest()}"
+
+    def _lock_for(self, key: Tuple[str, str]) -> threading.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            with self._locks_lock:
+                lock = self._locks.setdefault(key, threading.Lock())
+        return lock
+
+
+class TokenRefresher:
+    """
+    后台线程定期检查使用过的 token，剩余有效期不足 refresh_ahead 秒时提前刷新，
+    请求路径上不再等待 gettoken。refresh_ahead 需大于 TokenManager.refresh_margin + interval。
+
+    注：有效期内重复调用 gettoken 可能返回同一个 token，此时过期时间不变，下一轮检查会再次尝试。
+
+    示例：
+    >>> refresher = TokenRefresher(token_manager, interval=30)
+    >>> refresher.start()
+    >>> refresher.stop()
+    """
+
+    def __init__(self, manager: TokenManager, interval: float = 30.0, refresh_ahead: Optional[float] = None):
+        """
+        :param manager: TokenManager实例
+        :param interval: 检查间隔(秒)
+        :param refresh_ahead: 提前刷新的秒数，默认 refresh_margin + 2 * interval
+        """
+        self.manager = manager
+        self.interval = interval
+        self.refresh_ahead = refresh_ahead or manager.refresh_margin + 2 * interval
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop, name='token-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_once(self):
+        """检查一轮，刷新即将过期的 token"""
+        now = self.manager.clock()
+        for corpid, secret in self.manager.keys():
+            entry = self.manager.peek(corpid, secret)
+            if entry is None or entry[1] - self.refresh_ahead <= now:
+                try:
+                    self.manager.refresh(corpid, secret, self.refresh_ahead)
+                except Exception as e:
+                    logger.error(f"刷新access_token失败: {e}", exc_info=True)
+
+    def _loop(self):
+        while not self._stopping.wait(self.interval):
+            self.run_once()
+
+
+# 进程内共享的 token 缓存，多进程部署时由 web.create_app 设置 store
+token_manager = TokenManager()
+token_manager.register(CORPID, CORPSECRET, 'app')
+token_manager.register(CORPID, CONTACT_CORPSECRET, 'contact')
+token_manager.register(CORPID, WECHAT_SECRECT, 'wechat')
+TOKEN_AGE_SECONDS.set_function(token_manager.ages)
+TOKEN_EXPIRES_IN_SECONDS.set_function(token_manager.expires_in)
+
+
+def _token_response(corpid: str, secret: str) -> Optional[Dict[str, Any]]:
+    token = token_manager.get(corpid, secret)
+    if token is not None:
+        return {'errcode': 0, 'errmsg': 'ok', 'access_token': token}
+
 
 # 获取应用access_token 用于自建应用调用一些API
 def _get_access_token()->str:
-    try:
-        response = client.get('https://qyapi.weixin.qq.com/cgi-bin/gettoken', 
-                            params={'corpid': CORPID,'corpsecret':CORPSECRET})
-        code = response.status_code
-        if code == 200:
-            return response.json()
-    except RequestException as e:
-        print(f"请求失败: {e}")
-        
+    return _token_response(CORPID, CORPSECRET)
+
 
 # 获取通讯录access_token 用于获取本企业的人员信息
 def _get_contact_access_token()->str:
-    try:
-        response = client.get('https://qyapi.weixin.qq.com/cgi-bin/gettoken', 
-                            params={'corpid': CORPID,'corpsecret':CONTACT_CORPSECRET})
-        code = response.status_code
-        if code == 200:
-            return response.json()
-    except RequestException as e:
-        print(f"请求失败: {e}")
-        
+    return _token_response(CORPID, CONTACT_CORPSECRET)
+
+
 # 获取微信客服access_token 用于接收客服消息
 def _get_wechat_access_token():
-    try:
-        response = client.get('https://qyapi.weixin.qq.com/cgi-bin/gettoken', 
-                            params={'corpid': CORPID,'corpsecret':WECHAT_SECRECT})
-        code = response.status_code
-        if code == 200:
-            return response.json()
-    except RequestException as e:
-        print(f"请求失败: {e}")
\ No newline at end of file
+    return _token_response(CORPID, WECHAT_SECRECT)
+
+
+# 使用应用access_token 调用接口，token 失效时刷新重试一次
+def _call_with_access_token(request: Callable[[str], Any]) -> Any:
+    return token_manager.call(CORPID, CORPSECRET, request)
+
+
+# 使用通讯录access_token 调用接口
+def _call_with_contact_token(request: Callable[[str], Any]) -> Any:
+    return token_manager.call(CORPID, CONTACT_CORPSECRET, request)
+
+
+# 使用微信客服access_token 调用接口
+def _call_with_wechat_token(request: Callable[[str], Any]) -> Any:
+    return token_manager.call(CORPID, WECHAT_SECRECT, request)
+
+
+# 以下为异步版本，在事件循环中调用
+async def _acall_with_access_token(request: Callable[[str], Awaitable[Any]]) -> Any:
+    return await token_manager.acall(CORPID, CORPSECRET, request)
+
+
+async def _acall_with_wechat_token(request: Callable[[str], Awaitable[Any]]) -> Any:
+    return await token_manager.acall(CORPID, WECHAT_SECRECT, request)
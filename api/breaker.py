@@ -0,0 +1,157 @@
+import time
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from .metrics import REGISTRY
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# 指标中的状态值
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_STATE = REGISTRY.gauge(
+    'wechat_breaker_state', 'Circuit breaker state: 0 closed, 1 half-open, 2 open.', ('name',))
+BULKHEAD_INFLIGHT = REGISTRY.gauge(
+    'wechat_bulkhead_inflight', 'Calls currently running inside a bulkhead.', ('name',))
+REJECTED_TOTAL = REGISTRY.counter(
+    'wechat_breaker_rejected_total', 'Calls rejected without reaching the backend.', ('name', 'reason'))
+
+_breakers: List['CircuitBreaker'] = []
+_bulkheads: List['Bulkhead'] = []
+
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    - closed: 正常放行，连续失败 failure_threshold 次后打开
+    - open: 直接拒绝，recovery_timeout 秒后进入半开
+    - half_open: 最多放行 half_open_max 个探测请求，成功则关闭，失败则重新打开
+
+    示例：
+    >>> breaker = CircuitBreaker('make_webhook', failure_threshold=5, recovery_timeout=30)
+    >>> if breaker.allow():
+    ...     try:
+    ...         call()
+    ...     except Exception:
+    ...         breaker.record_failure()
+    ...     else:
+    ...         breaker.record_success()
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0,
+                 half_open_max: int = 1, clock: Callable[[], float] = time.monotonic):
+        """
+        :param name: 名称，用于指标
+        :param failure_threshold: 连续失败多少次后打开
+        :param recovery_timeout: 打开后多少秒进入半开
+        :param half_open_max: 半开状态下同时放行的探测请求数
+        :param clock: 时间函数
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max = half_open_max
+        self.clock = clock
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        _breakers.append(self)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def allow(self) -> bool:
+        """是否放行本次调用，放行后必须调用 record_success 或 record_failure(调用被取消时也要调用)"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes < self.half_open_max:
+                self._probes += 1
+                return True
+        REJECTED_TOTAL.inc(self.name, 'open')
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def record_failure(self):
+        with self._lock:
+            state = self._current_state()
+            self._failures += 1
+            if state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = self.clock()
+                self._probes = 0
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            return {'state': self._current_state(), 'failures': self._failures}
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and self.clock() - self._opened_at >= self.recovery_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+
+class Bulkhead:
+    """
+    并发上限，超过上限的调用直接拒绝，不排队
+
+    示例：
+    >>> bulkhead = Bulkhead('make_webhook', max_concurrent=20)
+    >>> if bulkhead.try_acquire():
+    ...     try:
+    ...         call()
+    ...     finally:
+    ...         bulkhead.release()
+    """
+
+    def __init__(self, name: str, max_concurrent: int = 20):
+        """
+        :param name: 名称，用于指标
+        :param max_concurrent: 最大并发数
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self._inflight = 0
+        self._lock = threading.Lock()
+        _bulkheads.append(self)
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._inflight < self.max_concurrent:
+                self._inflight += 1
+                return True
+        REJECTED_TOTAL.inc(self.name, 'full')
+        return False
+
+    def release(self):
+        with self._lock:
+            self._inflight -= 1
+
+
+def _breaker_states() -> Dict[Tuple[str], int]:
+    return {(breaker.name,): STATE_VALUES[breaker.state] for breaker in _breakers}
+
+
+def _bulkhead_inflight() -> Dict[Tuple[str], int]:
+    return {(bulkhead.name,): bulkhead.inflight for bulkhead in _bulkheads}
+
+
+BREAKER_STATE.set_function(_breaker_states)
+BULKHEAD_INFLIGHT.set_function(_bulkhead_inflight)
@@ -0,0 +1,351 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .api import RequestException
+from .config import DB_NAME
+from .dispatcher import run_blocking
+from .sql import SQLiteHelper, ThreadLocalSQLiteHelper
+from .user import _send_msg_chunk
+
+logger = logging.getLogger(__name__)
+
+# message/send 单次请求的接收者上限
+MAX_USERS = 1000
+MAX_PARTIES = 100
+MAX_TAGS = 100
+# 可以重试的错误码：系统繁忙、接口调用超过限制
+RETRY_ERRCODES = (-1, 45009)
+
+BROADCAST_COLUMNS = ('id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, content TEXT NOT NULL, '
+                     'created_at REAL NOT NULL, finished_at REAL')
+CHUNK_COLUMNS = ("broadcast_id INTEGER NOT NULL, seq INTEGER NOT NULL, touser TEXT NOT NULL DEFAULT '', "
+                 "toparty TEXT NOT NULL DEFAULT '', totag TEXT NOT NULL DEFAULT '', "
+                 "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                 'errcode INTEGER, errmsg TEXT, result TEXT, updated_at REAL, PRIMARY KEY (broadcast_id, seq)')
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class BroadcastConflict(ValueError):
+    """同名任务已存在，但文本内容或接收者不同"""
+
+
+def chunk_recipients(users: Iterable[str] = (), parties: Iterable[str] = (),
+                     tags: Iterable[str] = ()) -> List[Dict[str, str]]:
+    """
+    按接口限制把接收者分片，成员、部门、标签分别分组后按序合并到同一个请求中
+    :return: [{'touser': 'a|b', 'toparty': '1|2', 'totag': ''}, ...]
+    """
+    groups = []
+    for key, values, size in (('touser', users, MAX_USERS), ('toparty', parties, MAX_PARTIES),
+                              ('totag', tags, MAX_TAGS)):
+        # 去重并保持顺序
+        values = [str(value) for value in dict.fromkeys(values) if str(value)]
+        groups.append((key, [values[i:i + size] for i in range(0, len(values), size)]))
+    count = max((len(batches) for _, batches in groups), default=0)
+    return [{key: '|'.join(batches[i]) if i < len(batches) else '' for key, batches in groups}
+            for i in range(count)]
+
+
+def _split(value: Optional[str]) -> List[str]:
+    return [item for item in (value or '').split('|') if item]
+
+
+class ChunkResult:
+    """一个分片的发送结果"""
+
+    __slots__ = ('seq', 'touser', 'toparty', 'totag', 'status', 'attempts', 'errcode', 'errmsg',
+                 'invaliduser', 'invalidparty', 'invalidtag', 'msgid')
+
+    def __init__(self, seq: int, touser: str = '', toparty: str = '', totag: str = '', status: str = PENDING,
+                 attempts: int = 0, errcode: Optional[int] = None, errmsg: Optional[str] = None,
+                 result: Optional[Dict[str, Any]] = None):
+        self.seq = seq
+        self.touser = touser
+        self.toparty = toparty
+        self.totag = totag
+        self.status = status
+        self.attempts = attempts
+        self.errcode = errcode
+        self.errmsg = errmsg
+        self.update(result or {})
+
+    def update(self, result: Dict[str, Any]):
+        """记录接口返回的无效接收者和消息ID"""
+        self.invaliduser = _split(result.get('invaliduser'))
+        self.invalidparty = _split(result.get('invalidparty'))
+        self.invalidtag = _split(result.get('invalidtag'))
+        self.msgid = result.get('msgid')
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'seq': self.seq, 'status': self.status, 'attempts': self.attempts, 'errcode': self.errcode,
+                'errmsg': self.errmsg, 'users': len(_split(self.touser)), 'parties': len(_split(self.toparty)),
+                'tags': len(_split(self.totag)), 'invaliduser': self.invaliduser,
+                'invalidparty': self.invalidparty, 'invalidtag': self.invalidtag, 'msgid': self.msgid}
+
+
+class BroadcastReport:
+    """群发结果：各分片的结果和合并后的无效接收者"""
+
+    def __init__(self, broadcast_id: int, name: Optional[str], chunks: List[ChunkResult]):
+        self.broadcast_id = broadcast_id
+        self.name = name
+        self.chunks = chunks
+
+    def count(self, status: str) -> int:
+        return sum(1 for chunk in self.chunks if chunk.status == status)
+
+    @property
+    def finished(self) -> bool:
+        return self.count(PENDING) == 0
+
+    def merged(self, field: str) -> List[str]:
+        """合并各分片的 invaliduser/invalidparty/invalidtag"""
+        return list(dict.fromkeys(value for chunk in self.chunks for value in getattr(chunk, field)))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'broadcast_id': self.broadcast_id,
+            'name': self.name,
+            'chunks': len(self.chunks),
+            'sent': self.count(SENT),
+            'failed': self.count(FAILED),
+            'pending': self.count(PENDING),
+            'invaliduser': self.merged('invaliduser'),
+            'invalidparty': self.merged('invalidparty'),
+            'invalidtag': self.merged('invalidtag'),
+            'results': [chunk.to_dict() for chunk in self.chunks],
+        }
+
+
+class BroadcastStore:
+    """群发任务和分片状态，保存在 wechat.db 中，进程重启后可以继续发送未完成的分片"""
+
+    def __init__(self, db_name: str = DB_NAME, table: str = 'broadcasts'):
+        self.table = table
+        self.chunk_table = f"{table}_chunks"
+        self._db = ThreadLocalSQLiteHelper(db_name)
+        db_helper = self._helper()
+        db_helper.create_table(self.table, BROADCAST_COLUMNS)
+        db_helper.create_table(self.chunk_table, CHUNK_COLUMNS)
+
+    def _helper(self) -> SQLiteHelper:
+        return self._db.get()
+
+    def create(self, content: str, chunks: List[Dict[str, str]], name: Optional[str] = None) -> int:
+        """
+        保存群发任务及其全部分片；name 已存在时不重复创建，返回已有任务的ID
+
+        :raises BroadcastConflict: name 已存在，但文本内容或分片后的接收者与已有任务不同，
+                                   避免改了内容或名单后沿用旧任务名时静默继续发送旧任务
+        """
+        conn = self._helper().conn
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if name is not None:
+                row = conn.execute(f"SELECT id, content FROM {self.table} WHERE name = ?", (name,)).fetchone()
+                if row:
+                    stored = conn.execute(
+                        f"SELECT touser, toparty, totag FROM {self.chunk_table} WHERE broadcast_id = ? ORDER BY seq",
+                        (row[0],)).fetchall()
+                    conn.commit()
+                    if row[1] != content:
+                        raise BroadcastConflict(f"broadcast '{name}' ({row[0]}) already exists with different content")
+                    if stored != [(chunk['touser'], chunk['toparty'], chunk['totag']) for chunk in chunks]:
+                        raise BroadcastConflict(
+                            f"broadcast '{name}' ({row[0]}) already exists with different recipients")
+                    return row[0]
+            broadcast_id = conn.execute(
+                f"INSERT INTO {self.table} (name, content, created_at) VALUES (?, ?, ?)",
+                (name, content, time.time())).lastrowid
+            conn.executemany(
+                f"INSERT INTO {self.chunk_table} (broadcast_id, seq, touser, toparty, totag) VALUES (?, ?, ?, ?, ?)",
+                [(broadcast_id, seq, chunk['touser'], chunk['toparty'], chunk['totag'])
+                 for seq, chunk in enumerate(chunks)])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return broadcast_id
+
+    def find(self, name: str) -> Optional[int]:
+        row = self._helper().conn.execute(f"SELECT id FROM {self.table} WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, broadcast_id: int) -> Optional[Tuple[Optional[str], str]]:
+        """:return: (任务名, 文本内容)"""
+        row = self._helper().conn.execute(
+            f"SELECT name, content FROM {self.table} WHERE id = ?", (broadcast_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def chunks(self, broadcast_id: int) -> List[ChunkResult]:
+        rows = self._helper().conn.execute(
+            f"SELECT seq, touser, toparty, totag, status, attempts, errcode, errmsg, result "
+            f"FROM {self.chunk_table} WHERE broadcast_id = ? ORDER BY seq", (broadcast_id,)).fetchall()
+        return [ChunkResult(*row[:8], result=json.loads(row[8]) if row[8] else None) for row in rows]
+
+    def save(self, broadcast_id: int, chunk: ChunkResult, result: Optional[Dict[str, Any]] = None):
+        conn = self._helper().conn
+        conn.execute(
+            f"UPDATE {self.chunk_table} SET status = ?, attempts = ?, errcode = ?, errmsg = ?, result = ?, "
+            f"updated_at = ? WHERE broadcast_id = ? AND seq = ?",
+            (chunk.status, chunk.attempts, chunk.errcode, chunk.errmsg,
+             json.dumps(result, ensure_ascii=False) if result is not None else None, time.time(),
+             broadcast_id, chunk.seq))
+        conn.commit()
+
+    def finish(self, broadcast_id: int):
+        conn = self._helper().conn
+        conn.execute(f"UPDATE {self.table} SET finished_at = ? WHERE id = ?", (time.time(), broadcast_id))
+        conn.commit()
+
+    def report(self, broadcast_id: int) -> BroadcastReport:
+        broadcast = self.get(broadcast_id)
+        return BroadcastReport(broadcast_id, broadcast[0] if broadcast else None, self.chunks(broadcast_id))
+
+
+class Broadcaster:
+    """
+    应用消息群发
+
+    功能：
+    - 按接口限制(成员 1000、部门 100、标签 100)把接收者分片，每个分片一次 message/send
+    - 分片并发发送，总并发不超过 concurrency，调用频率由 user.py 中客户端的限流器控制
+    - 每个分片的结果落盘，中断后再次调用 send(同名)或 resume 只发送未完成的分片；
+      发送中被中断的分片会重发，由企业微信的重复消息检查去重
+    - 系统繁忙(-1)、频率超限(45009)和请求失败按指数退避重试，其他错误码直接记为失败
+
+    示例：
+    >>> broadcaster = Broadcaster(concurrency=8)
+    >>> report = await broadcaster.send('系统将于今晚 22:00 维护', users=userids, parties=['2'], name='maintain-0601')
+    >>> print(report.to_dict()['invaliduser'])
+    """
+
+    def __init__(
+        self,
+        store: Optional[BroadcastStore] = None,
+        send: Callable[..., Awaitable[Optional[Dict[str, Any]]]] = _send_msg_chunk,
+        concurrency: int = 8,
+        max_attempts: int = 3,
+        retry_backoff: float = 1.0
+    ):
+        """
+        :param store: 分片状态存储，默认保存在 wechat.db
+        :param send: send(content, touser, toparty, totag) -> 接口返回的 JSON 字典
+        :param concurrency: 同时发送的分片数
+        :param max_attempts: 每个分片的最大尝试次数
+        :param retry_backoff: 第 n 次重试前等待 retry_backoff * 2 ** (n - 1) 秒
+        """
+        self.store = store or BroadcastStore()
+        self.send_chunk = send
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+
+    async def send(self, content: str, users: Iterable[str] = (), parties: Iterable[str] = (),
+                   tags: Iterable[str] = (), name: Optional[str] = None) -> BroadcastReport:
+        """
+        创建并执行群发；name 相同的任务已存在时继续发送其未完成的分片，内容或接收者不同时抛出 BroadcastConflict
+        :param content: 文本内容
+        :param users: 成员ID
+        :param parties: 部门ID
+        :param tags: 标签ID
+        :param name: 任务名，用于中断后恢复
+        """
+        chunks = chunk_recipients(users, parties, tags)
+        broadcast_id = await run_blocking(self.store.create, content, chunks, name)
+        return await self.resume(broadcast_id)
+
+    async def resume(self, broadcast_id: int) -> BroadcastReport:
+        """继续发送未完成的分片，返回全部分片的结果"""
+        broadcast = await run_blocking(self.store.get, broadcast_id)
+        if broadcast is None:
+            raise LookupError(f"unknown broadcast {broadcast_id}")
+        name, content = broadcast
+        chunks = await run_blocking(self.store.chunks, broadcast_id)
+        pending = [chunk for chunk in chunks if chunk.status == PENDING]
+        logger.info("Broadcast %s: %d of %d chunks to send", broadcast_id, len(pending), len(chunks))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(chunk: ChunkResult):
+            async with semaphore:
+                await self._send(broadcast_id, content, chunk)
+
+        await asyncio.gather(*(run(chunk) for chunk in pending))
+        await run_blocking(self.store.finish, broadcast_id)
+        return BroadcastReport(broadcast_id, name, chunks)
+
+    async def _send(self, broadcast_id: int, content: str, chunk: ChunkResult):
+        result = None
+        while chunk.status == PENDING:
+            chunk.attempts += 1
+            try:
+                result = await self.send_chunk(content, chunk.touser, chunk.toparty, chunk.totag)
+            except RequestException as e:
+                result = None
+                chunk.errcode, chunk.errmsg = None, str(e)
+            else:
+                if result is None:
+                    chunk.errcode, chunk.errmsg = None, 'no response'
+                else:
+                    chunk.errcode, chunk.errmsg = result.get('errcode'), result.get('errmsg')
+            retryable = result is None or chunk.errcode in RETRY_ERRCODES
+            if chunk.errcode == 0:
+                chunk.status = SENT
+            elif not retryable or chunk.attempts >= self.max_attempts:
+                chunk.status = FAILED
+            if result is not None:
+                chunk.update(result)
+            await run_blocking(self.store.save, broadcast_id, chunk, result)
+            if chunk.status == PENDING:
+                logger.warning("Broadcast %s chunk %d attempt %d failed: %s %s", broadcast_id, chunk.seq,
+                               chunk.attempts, chunk.errcode, chunk.errmsg)
+                await asyncio.sleep(self.retry_backoff * 2 ** (chunk.attempts - 1))
+        if chunk.status == FAILED:
+            logger.error("Broadcast %s chunk %d failed: %s %s", broadcast_id, chunk.seq, chunk.errcode, chunk.errmsg)
+
+
+# 群发：python -m api.broadcast --name <任务名> --content <内容> --users-file users.txt [--parties 1,2] [--tags 3]
+# 恢复：python -m api.broadcast --resume <任务ID>；查看结果：python -m api.broadcast --report <任务ID>
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description='企业微信应用消息群发')
+    parser.add_argument('--name', default=None, help='任务名，中断后用相同的任务名重新执行只发送未完成的分片')
+    parser.add_argument('--content', default=None, help='文本内容')
+    parser.add_argument('--users', default='', help='成员ID，逗号分隔')
+    parser.add_argument('--users-file', default=None, help='成员ID文件，每行一个')
+    parser.add_argument('--parties', default='', help='部门ID，逗号分隔')
+    parser.add_argument('--tags', default='', help='标签ID，逗号分隔')
+    parser.add_argument('--concurrency', default=8, type=int, help='同时发送的分片数')
+    parser.add_argument('--resume', default=None, type=int, help='继续发送指定任务ID的未完成分片')
+    parser.add_argument('--report', default=None, type=int, help='输出指定任务ID的结果')
+    args = parser.parse_args()
+
+    if args.report is not None:
+        result = BroadcastStore().report(args.report)
+    else:
+        broadcaster = Broadcaster(concurrency=args.concurrency)
+        if args.resume is not None:
+            result = asyncio.run(broadcaster.resume(args.resume))
+        elif args.content:
+            users = [user for user in args.users.split(',') if user]
+            if args.users_file:
+                with open(args.users_file, encoding='utf-8') as f:
+                    users += [line.strip() for line in f if line.strip()]
+            try:
+                result = asyncio.run(broadcaster.send(args.content, users, args.parties.split(','),
+                                                      args.tags.split(','), name=args.name))
+            except BroadcastConflict as e:
+                print(f"{e}，请换一个 --name 或用 --resume 继续原任务")
+                sys.exit(1)
+        else:
+            parser.print_usage()
+            sys.exit(1)
+    print(json.dumps(result.to_dict(), ensure_ascii=False, indent=2))
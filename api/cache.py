@@ -0,0 +1,149 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class ReplayCache:
+    """
+    回调重放/重复请求缓存
+
+    企业微信认为回调超时后会用相同的 (timestamp, nonce, msg_signature) 重试，
+    命中缓存时直接返回第一次的处理结果，不再解密和路由。
+
+    功能：
+    - 按时间窗口(ttl)和容量(max_size)双重淘汰
+    - 首次请求处理期间到达的重复请求视为命中，返回空结果
+    - 统计命中、未命中及淘汰次数
+
+    示例：
+    >>> cache = ReplayCache(max_size=10000, ttl=300)
+    >>> hit, value = cache.check(key)
+    >>> if not hit:
+    ...     cache.put(key, handle())
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0, clock=time.monotonic):
+        """
+        :param max_size: 最多缓存的请求数
+        :param ttl: 缓存有效期(秒)
+        :param clock: 时间函数
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (写入时间, 处理结果)，处理中的请求结果为 None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(request_data: Dict) -> Tuple[str, str, str]:
+        """由回调参数生成缓存键"""
+        return request_data['timestamp'], request_data['nonce'], request_data['msg_signature']
+
+    def check(self, key: Hashable) -> Tuple[bool, Optional[Any]]:
+        """
+        查询缓存，未命中时为该请求占位
+
+        :param key: 缓存键
+        :return: (是否命中, 缓存的处理结果)，命中但首次请求仍在处理时结果为 None
+        """
+        with self._lock:
+            now = self.clock()
+            self._evict(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            self._entries[key] = (now, None)
+            self._evict_overflow()
+            return False, None
+
+    def put(self, key: Hashable, value: Any):
+        """写入处理结果，时间窗口从首次到达算起"""
+        with self._lock:
+            entry = self._entries.get(key)
+            self._entries[key] = (entry[0] if entry else self.clock(), value)
+            self._evict_overflow()
+
+    def discard(self, key: Hashable):
+        """删除占位，处理失败时允许重试请求重新处理"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓存统计"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _evict(self, now: float):
+        """按写入顺序淘汰过期项"""
+        deadline = now - self.ttl
+        while self._entries:
+            key, (created, _) = next(iter(self._entries.items()))
+            if created > deadline:
+                break
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _evict_overflow(self):
+        """超出容量时淘汰最早写入的项"""
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class SharedReplayCache:
+    """
+    多进程共享的回调重放缓存，接口与 ReplayCache 相同
+
+    占位和处理结果保存在 SharedStore 中，重试请求落到其他 worker 进程时同样能命中。
+    命中/未命中计数为本进程的统计。
+    """
+
+    def __init__(self, store, ttl: float = 300.0, purge_every: int = 1000):
+        """
+        :param store: SharedStore实例
+        :param ttl: 缓存有效期(秒)
+        :param purge_every: 每处理多少次查询清理一次过期项
+        """
+        self.store = store
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.hits = 0
+        self.misses = 0
+
+    make_key = staticmethod(ReplayCache.make_key)
+
+    def check(self, key: Hashable) -> Tuple[bool, Optional[Any]]:
+        if (self.hits + self.misses) % self.purge_every == 0:
+            self.store.purge_expired()
+        skey = self._store_key(key)
+        if self.store.add(skey, None, self.ttl):
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        value = self.store.get(skey)
+        return True, tuple(value) if value is not None else None
+
+    def put(self, key: Hashable, value: Any):
+        self.store.set(self._store_key(key), list(value), self.ttl)
+
+    def discard(self, key: Hashable):
+        self.store.delete(self._store_key(key))
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    @staticmethod
+    def _store_key(key: Hashable) -> str:
+        return 'replay:' + ':'.join(key)
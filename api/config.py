@@ -1,3 +1,5 @@
+import os
+
 # 数据库配置
 DB_NAME = 'wechat.db'
 
@@ -13,4 +15,10 @@ AGENT_ID = 1000005
 # 微信客服相关配置
 WECHAT_SECRECT = 'WBnyX70zQf6OkUpJjfA8AVth819SMk46Wf3vnfYgXKY'
 # 微信客服账号ID
-ACCOUNT_ID = 'kfc2c53b979a9f380b2'
\ No newline at end of file
+ACCOUNT_ID = 'kfc2c53b979a9f380b2'
+
+# 上游接口地址，压测/联调时可以指向本地模拟服务(bench/standin.py)，也可以用 web.py 的 --qyapi-base-url/--make-webhook-url 修改
+# 企业微信接口
+QYAPI_BASE_URL = os.environ.get('WXROBOT_QYAPI_BASE_URL', 'https://qyapi.weixin.qq.com')
+# make.com webhook(AI 回复)
+MAKE_WEBHOOK_URL = os.environ.get('WXROBOT_MAKE_WEBHOOK_URL', 'https://hook.us2.make.com/ur6hy470w5jk32stv8a3yk99qt6b86og')
@@ -0,0 +1,245 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .api import RequestException
+from .user import _wechat_batchget_customers, _wechat_batchget_customers_async
+
+# kf/customer/batchget 每次最多查询的客户数
+BATCH_LIMIT = 100
+
+
+class CustomerProfile:
+    """微信客服客户的基础信息"""
+
+    __slots__ = ('external_userid', 'nickname', 'avatar', 'gender', 'unionid')
+
+    def __init__(self, external_userid: str, nickname: str = '', avatar: str = '', gender: int = 0, unionid: str = ''):
+        self.external_userid = external_userid
+        self.nickname = nickname
+        self.avatar = avatar
+        self.gender = gender
+        self.unionid = unionid
+
+    @classmethod
+    def from_dict(cls, item: Dict[str, Any]) -> 'CustomerProfile':
+        return cls(item['external_userid'], item.get('nickname', ''), item.get('avatar', ''),
+                   item.get('gender', 0), item.get('unionid', ''))
+
+    def __repr__(self):
+        return f"CustomerProfile({self.external_userid!r}, nickname={self.nickname!r})"
+
+
+class CustomerCache:
+    """
+    客户信息缓存(external_userid -> CustomerProfile)
+
+    功能：
+    - 按有效期(ttl)和容量(max_size，LRU)淘汰
+    - invalid_external_userid 中的客户缓存为 None(negative_ttl)，不反复查询
+    - 未命中的客户合并为一次 batchget，每次最多 batch_size 个
+    - 同一个客户正在查询时，其他调用等待同一个结果，不重复请求
+    - batch_window 大于 0 时先等待一小段时间，把其他调用方同时未命中的客户并入同一批
+
+    同步和异步调用共用一个缓存和查询中的结果，同步调用在线程中发起 batchget，异步调用在事件循环中发起。
+
+    示例：
+    >>> cache = CustomerCache(max_size=10000, ttl=3600)
+    >>> profile = cache.get('wmxxxx')
+    >>> profiles = await cache.aget_many(['wmxxxx', 'wmyyyy'])
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[List[str]], Dict[str, Any]] = _wechat_batchget_customers,
+        afetch: Callable[[List[str]], Awaitable[Dict[str, Any]]] = _wechat_batchget_customers_async,
+        max_size: int = 10000,
+        ttl: float = 3600.0,
+        negative_ttl: float = 300.0,
+        batch_size: int = BATCH_LIMIT,
+        batch_window: float = 0.0,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        :param fetch: 同步 batchget 函数，参数为客户ID列表，失败时抛出异常
+        :param afetch: 异步 batchget 函数
+        :param max_size: 最多缓存的客户数
+        :param ttl: 客户信息有效期(秒)
+        :param negative_ttl: 无效客户的缓存有效期(秒)
+        :param batch_size: 每次 batchget 的客户数上限，不超过接口限制
+        :param batch_window: 合并其他调用方请求的等待时间(秒)
+        :param clock: 时间函数
+        """
+        self.fetch = fetch
+        self.afetch = afetch
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.batch_size = min(batch_size, BATCH_LIMIT)
+        self.batch_window = batch_window
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.batches = 0
+        # external_userid -> (过期时间, 客户信息)，无效客户的信息为 None
+        self._entries: 'OrderedDict[str, Tuple[float, Optional[CustomerProfile]]]' = OrderedDict()
+        # 查询中的客户 -> 结果
+        self._inflight: Dict[str, Future] = {}
+        # 已登记但还没有发出请求的客户，由登记了客户的调用方取出
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+
+    def get(self, external_userid: str) -> Optional[CustomerProfile]:
+        """查询一个客户，无效客户返回 None，查询失败时抛出异常"""
+        return self.get_many([external_userid])[external_userid]
+
+    def get_many(self, external_userids: Iterable[str]) -> Dict[str, Optional[CustomerProfile]]:
+        """查询多个客户，返回 {external_userid: 客户信息或None}"""
+        result, waiting, claimed = self._claim(external_userids)
+        if claimed:
+            batch = None
+            try:
+                if self.batch_window > 0:
+                    time.sleep(self.batch_window)
+                for batch in iter(self._take_batch, None):
+                    try:
+                        response = self.fetch(batch)
+                    except Exception as e:
+                        self._fail(batch, e)
+                    else:
+                        self._complete(batch, response)
+                    batch = None
+            except BaseException as e:
+                # 被中断时结束已取出和还没取出的查询，否则等待这些客户的调用方会一直等下去
+                self._abort(batch, e)
+                raise
+        for external_userid, future in waiting.items():
+            result[external_userid] = future.result()
+        return result
+
+    async def aget(self, external_userid: str) -> Optional[CustomerProfile]:
+        """get 的异步版本"""
+        return (await self.aget_many([external_userid]))[external_userid]
+
+    async def aget_many(self, external_userids: Iterable[str]) -> Dict[str, Optional[CustomerProfile]]:
+        """get_many 的异步版本"""
+        result, waiting, claimed = self._claim(external_userids)
+        if claimed:
+            batch = None
+            try:
+                if self.batch_window > 0:
+                    await asyncio.sleep(self.batch_window)
+                for batch in iter(self._take_batch, None):
+                    try:
+                        response = await self.afetch(batch)
+                    except Exception as e:
+                        self._fail(batch, e)
+                    else:
+                        self._complete(batch, response)
+                    batch = None
+            except BaseException as e:
+                # 被取消时结束已取出和还没取出的查询，否则等待这些客户的调用方会一直等下去
+                self._abort(batch, e)
+                raise
+        for external_userid, future in waiting.items():
+            # 本调用方被取消时不能取消共用的结果，其他调用方还在等待
+            result[external_userid] = await asyncio.shield(asyncio.wrap_future(future))
+        return result
+
+    def invalidate(self, external_userid: str):
+        with self._lock:
+            self._entries.pop(external_userid, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'batches': self.batches,
+            }
+
+    def _claim(self, external_userids: Iterable[str]) -> Tuple[Dict[str, Optional[CustomerProfile]], Dict[str, Future], bool]:
+        """
+        查缓存，未命中且没有在查询中的客户登记到待查询列表
+        :return: (命中的结果, 需要等待的结果, 是否登记了新的客户)
+        """
+        result = {}
+        waiting = {}
+        claimed = False
+        with self._lock:
+            now = self.clock()
+            for external_userid in external_userids:
+                if external_userid in result or external_userid in waiting:
+                    continue
+                entry = self._entries.get(external_userid)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(external_userid)
+                    self.hits += 1
+                    result[external_userid] = entry[1]
+                    continue
+                self.misses += 1
+                future = self._inflight.get(external_userid)
+                if future is None:
+                    future = self._inflight[external_userid] = Future()
+                    self._pending.append(external_userid)
+                    claimed = True
+                waiting[external_userid] = future
+        return result, waiting, claimed
+
+    def _take_batch(self) -> Optional[List[str]]:
+        with self._lock:
+            if not self._pending:
+                return None
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            self.batches += 1
+            return batch
+
+    def _complete(self, batch: List[str], response: Dict[str, Any]):
+        profiles = {item['external_userid']: CustomerProfile.from_dict(item)
+                    for item in response.get('customer_list', [])}
+        invalid = set(response.get('invalid_external_userid', []))
+        with self._lock:
+            now = self.clock()
+            for external_userid, profile in profiles.items():
+                self._entries[external_userid] = (now + self.ttl, profile)
+                self._entries.move_to_end(external_userid)
+            for external_userid in invalid:
+                self._entries[external_userid] = (now + self.negative_ttl, None)
+                self._entries.move_to_end(external_userid)
+            self._evict_overflow()
+            futures = [(self._inflight.pop(external_userid), profiles.get(external_userid)) for external_userid in batch]
+        for future, profile in futures:
+            future.set_result(profile)
+
+    def _fail(self, batch: List[str], error: Exception):
+        """查询失败时不缓存，等待该批结果的调用方都收到同一个异常"""
+        with self._lock:
+            futures = [self._inflight.pop(external_userid, None) for external_userid in batch]
+        for future in futures:
+            if future is not None:
+                future.set_exception(error)
+
+    def _abort(self, batch: Optional[List[str]], error: BaseException):
+        """发起查询的调用方被取消或中断：已取出的一批和还没有取出的客户都以 RequestException 结束，之后可以重新查询"""
+        with self._lock:
+            batch = (batch or []) + self._pending
+            self._pending = []
+        self._fail(batch, RequestException(f"kf/customer/batchget aborted: {error!r}"))
+
+    def _evict_overflow(self):
+        """超出容量时淘汰最久未使用的项"""
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+# 进程内共享的客户信息缓存，容量和有效期由 web.create_app 配置
+customer_cache = CustomerCache()
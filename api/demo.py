@@ -1,29 +1,251 @@
-from .api import RequestClient
+from .api import RequestClient, AsyncRequestClient
 from .api import RequestException
-from .user import _send_msg,_wechat_send_msg
+from .user import _send_msg
+from .outbox import asend_kf_text
 import json
+import time
+import uuid
 import asyncio
+import logging
+from contextlib import AsyncExitStack
+from .log import log_payload
+from .metrics import UPSTREAM_SECONDS, AI_REPLY_SECONDS
+from .segment import ReplySegmenter
+from .breaker import CircuitBreaker, Bulkhead
+from .customer import customer_cache
+from . import config
+
+logger = logging.getLogger(__name__)
 # 创建客户端实例
 client = RequestClient(max_retries=3, timeout=200)
+async_client = AsyncRequestClient(max_retries=3, timeout=200)
+
+# make.com 调用的熔断器与并发上限，make.com 变慢时快速失败，避免堆积大量长时间挂起的请求
+make_breaker = CircuitBreaker('make_webhook', failure_threshold=5, recovery_timeout=30)
+make_bulkhead = Bulkhead('make_webhook', max_concurrent=20)
+# 单次调用的截止时间(秒)，流式回复时为从发出请求到读完整个回答的时间，不含发给用户的时间
+make_deadline = 30.0
+# 是否以流的方式读取 make.com 的回答，逐句发给客户
+make_stream = False
+# 熔断或超过并发上限时发给客户的回复
+FALLBACK_REPLY = '当前咨询人数较多，请稍后再试。'
+
+
+def configure_make_backend(deadline=None, max_inflight=None, failure_threshold=None, recovery_timeout=None,
+                           stream=None):
+    '''
+    配置 make.com 调用
+    @param deadline 单次调用的截止时间(秒)
+    @param max_inflight 同时进行的调用数上限
+    @param failure_threshold 连续失败多少次后熔断
+    @param recovery_timeout 熔断多少秒后放行探测请求
+    @param stream 是否流式读取回答并逐句发送
+    '''
+    global make_deadline, make_stream
+    if deadline is not None:
+        make_deadline = deadline
+    if stream is not None:
+        make_stream = stream
+    if max_inflight is not None:
+        make_bulkhead.max_concurrent = max_inflight
+    if failure_threshold is not None:
+        make_breaker.failure_threshold = failure_threshold
+    if recovery_timeout is not None:
+        make_breaker.recovery_timeout = recovery_timeout
+
+
+def make_backend_stats():
+    return {**make_breaker.snapshot(), 'inflight': make_bulkhead.inflight,
+            'max_inflight': make_bulkhead.max_concurrent}
+
 
 # 测试
+'''
+询问 make.com 并把回答发给用户
+@param touser 客服消息为客户的 external_userid，应用消息为成员的 userid
+@param msg_id 用户消息的ID，用作回复的业务键
+@param open_kfid 客服账号ID，为 None 时是应用消息，通过 message/send 回复
+@param option 用户发送的内容
+'''
 async def _test_make(touser, msg_id, open_kfid,option)->str:
-    webhook_url = 'https://hook.us2.make.com/ur6hy470w5jk32stv8a3yk99qt6b86og'
+    webhook_url = config.MAKE_WEBHOOK_URL
     jsondata = {'name': touser,'option': option}
-   
+    # AI 回复和默认回复共用一个业务键，同一条客户消息只回复一次
+    reply_key = f"reply:{msg_id}" if msg_id else f"reply:{uuid.uuid4().hex}"
+    # 客户昵称/unionid 供 make.com 个性化回复，查询失败不影响回复；应用消息的发送者是成员，没有客户信息
+    profile = None
+    if open_kfid:
+        try:
+            profile = await customer_cache.aget(touser)
+        except Exception as e:
+            logger.warning(f"获取客户信息失败: {e!r}")
+    if profile is not None:
+        jsondata['nickname'] = profile.nickname
+        jsondata['unionid'] = profile.unionid
+
+    # 先占并发名额再询问熔断器，避免半开状态的探测名额被并发上限拒绝后无法归还
+    if not make_bulkhead.try_acquire():
+        logger.warning("make.com 并发已满，返回默认回复")
+        return await _send_fallback(touser, open_kfid, reply_key)
     try:
-        response = client.post(webhook_url, json_data=jsondata)
-        response.encoding = "utf-8"  # 确保编码正确
-        raw_text = response.text
-        text = {
-            'content':raw_text
-        }
-        print("make传递的数据",raw_text)
-        _wechat_send_msg(touser,None,open_kfid,text)
-        return raw_text
-    except RequestException as e:
-        return f"请求失败: {e}"
-        
+        if not make_breaker.allow():
+            logger.warning("make.com 已熔断，返回默认回复")
+            return await _send_fallback(touser, open_kfid, reply_key)
+        reply = _SegmentedReply(touser, open_kfid, reply_key)
+        failed = await _ask_make(reply, webhook_url, jsondata)
+    finally:
+        make_bulkhead.release()
+
+    # 已经发出部分回答时把收到的剩余内容发完，不再发送默认回复
+    if failed and not reply.sent:
+        return await _send_fallback(touser, open_kfid, reply_key)
+    raw_text = await reply.finish()
+    log_payload(logger, "Make webhook reply", touser=touser, reply=raw_text)
+    return raw_text
+
+
+'''
+读取 make.com 的回答，熔断器和 make_webhook 耗时只统计 make.com 本身，流式读取时发给用户的耗时和错误不计入
+@return make.com 调用是否失败
+'''
+async def _ask_make(reply, webhook_url, jsondata)->bool:
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        # 异步请求，不占用事件循环和线程池
+        if make_stream:
+            await reply.stream(webhook_url, jsondata)
+        else:
+            response = await asyncio.wait_for(
+                async_client.post(webhook_url, json_data=jsondata, timeout=make_deadline), make_deadline)
+            response.encoding = "utf-8"  # 确保编码正确
+            reply.whole(response.text)
+        outcome = 'ok'
+    except _ReplySendError as e:
+        # make.com 正常返回，是发给用户失败：不打开熔断器，也不再经同一条路径发送默认回复，
+        # 与 finish 中的发送失败一样抛给调用方(任务队列中的 ai_reply 任务会重试)
+        outcome = 'ok'
+        make_breaker.record_success()
+        raise e.__cause__
+    except (RequestException, asyncio.TimeoutError) as e:
+        make_breaker.record_failure()
+        logger.error(f"请求失败: {e!r}")
+        return True
+    except BaseException:
+        # 被取消或其他异常时同样按失败处理，归还半开状态的探测名额，否则熔断器会一直停在半开状态拒绝调用
+        make_breaker.record_failure()
+        raise
+    else:
+        make_breaker.record_success()
+        return False
+    finally:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started - reply.send_seconds, 'make_webhook', outcome)
+
+
+class _ReplySendError(Exception):
+    '''流式读取中发给用户失败，__cause__ 为发送时的异常'''
+
+
+class _SegmentedReply:
+    '''
+    把 make.com 的回答按句子切段发给客户，每段不超过 kf/send_msg 的字节上限
+    流式读取时每收到完整的句子就发送，客户不必等待整个回答生成完毕
+    '''
+
+    def __init__(self, touser, open_kfid, reply_key):
+        self.touser = touser
+        self.open_kfid = open_kfid
+        self.reply_key = reply_key
+        self.segmenter = ReplySegmenter()
+        self.parts = []
+        self.tail = ''
+        self.sent = 0
+        # 发送各段的累计耗时，不计入 make.com 的耗时
+        self.send_seconds = 0.0
+        self.started = time.perf_counter()
+
+    async def stream(self, webhook_url, jsondata):
+        '''逐块读取回答，text/event-stream 时取每个事件的 data 字段；整个回答须在 make_deadline 秒内读完'''
+        started = time.perf_counter()
+
+        def remaining():
+            # 发给用户的时间不占用 make.com 的截止时间
+            return started + make_deadline + self.send_seconds - time.perf_counter()
+
+        async with AsyncExitStack() as stack:
+            response = await asyncio.wait_for(stack.enter_async_context(
+                async_client.stream('POST', webhook_url, json_data=jsondata, timeout=make_deadline)), remaining())
+            response.encoding = "utf-8"  # 确保编码正确，跨块的多字节字符由增量解码器拼接
+            if response.headers.get('content-type', '').startswith('text/event-stream'):
+                chunks = _iter_events(response)
+            else:
+                chunks = response.aiter_text()
+            try:
+                while True:
+                    try:
+                        text = await asyncio.wait_for(chunks.__anext__(), remaining())
+                    except StopAsyncIteration:
+                        break
+                    self.parts.append(text)
+                    send_started = time.perf_counter()
+                    try:
+                        await self._send(self.segmenter.feed(text))
+                    except Exception as e:
+                        raise _ReplySendError(repr(e)) from e
+                    finally:
+                        self.send_seconds += time.perf_counter() - send_started
+            finally:
+                # 超时或出错时先结束读取中的生成器，再关闭响应
+                await chunks.aclose()
+
+    def whole(self, text):
+        '''非流式读取的完整回答，在 finish 时按字节上限切段'''
+        self.parts.append(text)
+        self.tail = text
+
+    async def finish(self):
+        '''发送剩余内容，返回完整回答'''
+        await self._send(self.segmenter.flush(self.tail))
+        if self.sent:
+            AI_REPLY_SECONDS.observe(time.perf_counter() - self.started, 'last')
+        return ''.join(self.parts)
+
+    async def _send(self, segments):
+        for segment in segments:
+            # 第一段与默认回复共用业务键，之后的段按序号区分
+            key = self.reply_key if self.sent == 0 else f"{self.reply_key}:{self.sent}"
+            await _send_text(self.touser, self.open_kfid, segment, key)
+            if self.sent == 0:
+                AI_REPLY_SECONDS.observe(time.perf_counter() - self.started, 'first')
+            self.sent += 1
+
+
+async def _iter_events(response):
+    '''解析 text/event-stream，返回每个事件的 data 字段(多行以换行连接)，遇到 [DONE] 结束'''
+    data = []
+    async for line in response.aiter_lines():
+        if line.startswith('data:'):
+            data.append(line[6:] if line.startswith('data: ') else line[5:])
+        elif not line and data:
+            event, data = '\n'.join(data), []
+            if event == '[DONE]':
+                return
+            yield event
+    if data and '\n'.join(data) != '[DONE]':
+        yield '\n'.join(data)
+
+
+async def _send_fallback(touser, open_kfid, reply_key):
+    await _send_text(touser, open_kfid, FALLBACK_REPLY, reply_key)
+    return FALLBACK_REPLY
+
+
+async def _send_text(touser, open_kfid, content, key):
+    '''客服消息经发件箱或 kf/send_msg 发送，应用消息通过 message/send 发给成员'''
+    if open_kfid:
+        return await asend_kf_text(touser, open_kfid, content, key)
+    return await _send_msg(touser, content)
+
 # _test_make()
 # # POST JSON数据
 # try:
@@ -0,0 +1,222 @@
+import sys
+import time
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .config import DB_NAME
+from .sql import ThreadLocalSQLiteHelper
+from .user import _iter_user_pages
+
+logger = logging.getLogger(__name__)
+
+DIRECTORY_COLUMNS = 'userid TEXT NOT NULL, department INTEGER NOT NULL, PRIMARY KEY (userid, department)'
+# SharedStore 中的目录版本号，其他进程发现版本变化后从数据库重新加载
+VERSION_KEY = 'directory:version'
+
+
+class Employee:
+    """成员记录"""
+
+    __slots__ = ('userid', 'departments')
+
+    def __init__(self, userid: str, departments: Tuple[int, ...]):
+        self.userid = userid
+        self.departments = departments
+
+    def __repr__(self):
+        return f"Employee({self.userid!r}, {self.departments!r})"
+
+
+class Directory:
+    """
+    成员目录(userid -> 所在部门)
+
+    功能：
+    - 查询只读内存中的索引，不访问网络和数据库，可以在消息处理中直接调用
+    - refresh 通过 user/list_id 按 next_cursor 逐页拉取，完成后整体替换索引，
+      只把新增、删除和部门变化的成员写入 wechat.db 的 directory 表
+    - 启动时从数据库加载，不必等待第一次拉取
+    - 设置 store(SharedStore) 后只有取得租约的进程拉取，其他进程在版本号变化后从数据库重新加载
+
+    示例：
+    >>> directory = Directory()
+    >>> directory.load()
+    >>> directory.refresh()
+    >>> directory.departments('zhangsan')
+    (1, 2)
+    """
+
+    def __init__(
+        self,
+        pages: Callable[[], Iterable[List[Dict]]] = _iter_user_pages,
+        db_name: str = DB_NAME,
+        table: str = 'directory',
+        store=None,
+        clock: Callable[[], float] = time.time
+    ):
+        """
+        :param pages: 返回成员分页的生成器函数，每页为 [{'userid': ..., 'department': ...}]
+        :param db_name: 数据库文件
+        :param table: 表名
+        :param store: SharedStore，多进程部署时由 web.create_app 设置
+        :param clock: 时间函数
+        """
+        self.pages = pages
+        self.db_name = db_name
+        self.table = table
+        self.store = store
+        self.clock = clock
+        self.refreshed_at: Optional[float] = None
+        self._by_id: Dict[str, Employee] = {}
+        self._version = None
+        self._db: Optional[ThreadLocalSQLiteHelper] = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, userid: str):
+        return userid in self._by_id
+
+    def get(self, userid: str) -> Optional[Employee]:
+        return self._by_id.get(userid)
+
+    def departments(self, userid: str) -> Tuple[int, ...]:
+        employee = self._by_id.get(userid)
+        return employee.departments if employee is not None else ()
+
+    def members(self, department: int) -> List[str]:
+        """部门下的成员ID(遍历整个索引)"""
+        return [employee.userid for employee in self._by_id.values() if department in employee.departments]
+
+    def load(self):
+        """从数据库加载索引"""
+        version = self.store.get(VERSION_KEY) if self.store is not None else None
+        rows = self._helper().cursor.execute(
+            f"SELECT userid, department FROM {self.table} ORDER BY userid, department").fetchall()
+        self._by_id = self._build((userid, department) for userid, department in rows)
+        self._version = version
+        logger.info("Loaded %d employees from %s", len(self._by_id), self.table)
+
+    def refresh(self, lease_ttl: float = 600.0) -> Dict[str, int]:
+        """
+        从 user/list_id 拉取全部成员并更新索引，拉取失败时保留原索引
+        :param lease_ttl: 多进程时拉取租约的超时(秒)，需大于一次完整拉取的耗时
+        :return: {'total': 成员数, 'added': 新增, 'removed': 删除, 'changed': 部门变化}，未取得租约时为空
+        """
+        if self.store is None:
+            return self._refresh()
+        with self.store.lease('directory_refresh', ttl=lease_ttl) as acquired:
+            if acquired:
+                return self._refresh()
+        self.reload_if_changed()
+        return {}
+
+    def reload_if_changed(self) -> bool:
+        """其他进程更新了目录时从数据库重新加载"""
+        if self.store is None or self.store.get(VERSION_KEY) == self._version:
+            return False
+        self.load()
+        return True
+
+    def _refresh(self) -> Dict[str, int]:
+        with self._lock:
+            start = time.perf_counter()
+            by_id = self._build((item['userid'], int(item['department']))
+                                for page in self.pages() for item in page if item.get('userid'))
+            current = self._by_id
+            added = [userid for userid in by_id if userid not in current]
+            removed = [userid for userid in current if userid not in by_id]
+            changed = [userid for userid, employee in by_id.items()
+                       if userid in current and current[userid].departments != employee.departments]
+            self._save(by_id, added + changed, removed + changed)
+            self._by_id = by_id
+            self.refreshed_at = self.clock()
+            if self.store is not None:
+                self._version = self.refreshed_at
+                self.store.set(VERSION_KEY, self._version)
+        logger.info("Directory refreshed in %.2fs: %d employees, %d added, %d removed, %d changed",
+                    time.perf_counter() - start, len(by_id), len(added), len(removed), len(changed))
+        return {'total': len(by_id), 'added': len(added), 'removed': len(removed), 'changed': len(changed)}
+
+    def _build(self, rows: Iterable[Tuple[str, int]]) -> Dict[str, Employee]:
+        # 同一个用户可能出现在多个部门中，部门组合相同的成员共用一个元组
+        departments: Dict[str, List[int]] = {}
+        for userid, department in rows:
+            departments.setdefault(userid, []).append(department)
+        shared: Dict[Tuple[int, ...], Tuple[int, ...]] = {}
+        by_id = {}
+        for userid, items in departments.items():
+            key = tuple(sorted(set(items)))
+            userid = sys.intern(userid)
+            by_id[userid] = Employee(userid, shared.setdefault(key, key))
+        return by_id
+
+    def _save(self, by_id: Dict[str, Employee], upserts: List[str], deletes: List[str]):
+        if not upserts and not deletes:
+            return
+        conn = self._helper().conn
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(f"DELETE FROM {self.table} WHERE userid = ?", [(userid,) for userid in deletes])
+            conn.executemany(f"INSERT OR REPLACE INTO {self.table} (userid, department) VALUES (?, ?)",
+                             [(userid, department) for userid in upserts for department in by_id[userid].departments])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _helper(self):
+        if self._db is None:
+            self._db = ThreadLocalSQLiteHelper(self.db_name)
+            self._db.get().create_table(self.table, DIRECTORY_COLUMNS)
+        return self._db.get()
+
+
+class DirectoryRefresher:
+    """
+    后台线程定期刷新成员目录；启动时目录为空则立即拉取一次
+
+    示例：
+    >>> refresher = DirectoryRefresher(directory, interval=3600)
+    >>> refresher.start()
+    >>> refresher.stop()
+    """
+
+    def __init__(self, directory: Directory, interval: float = 3600.0):
+        """
+        :param directory: Directory实例
+        :param interval: 刷新间隔(秒)
+        """
+        self.directory = directory
+        self.interval = interval
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop, name='directory-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_once(self):
+        try:
+            self.directory.refresh()
+        except Exception as e:
+            logger.error(f"刷新成员目录失败: {e}", exc_info=True)
+
+    def _loop(self):
+        if not len(self.directory):
+            self.run_once()
+        while not self._stopping.wait(self.interval):
+            self.run_once()
+
+
+# 进程内共享的成员目录，由 web.create_app 加载并启动定期刷新
+directory = Directory()
@@ -0,0 +1,147 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Coroutine, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DispatcherBusy(Exception):
+    """排队任务已达上限"""
+
+
+class Dispatcher:
+    """
+    回调处理调度器
+
+    功能：
+    - 有界线程池执行阻塞的上游请求与数据库操作，不占用事件循环
+    - 限制排队任务数，超出时抛出 DispatcherBusy，让企业微信稍后重试
+    - 在任意线程中把协程调度回主事件循环执行
+
+    示例：
+    >>> dispatcher = Dispatcher(max_workers=32, max_pending=1000)
+    >>> dispatcher.submit(handler.route, msg)          # 在事件循环中调用，立即返回
+    >>> result = await dispatcher.run_blocking(client.post, url, json_data=data)
+    """
+
+    def __init__(self, max_workers: int = 32, max_pending: int = 1000):
+        """
+        :param max_workers: 线程池大小
+        :param max_pending: 允许同时排队和执行的任务数
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        # 持有后台任务的引用，避免被垃圾回收
+        self._tasks = set()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='dispatcher')
+        return self._executor
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def configure(self, max_workers: Optional[int] = None, max_pending: Optional[int] = None):
+        """在线程池创建前调整大小"""
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if max_pending is not None:
+            self.max_pending = max_pending
+
+    def bind_loop(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """记录主事件循环，供其他线程调度协程"""
+        self.loop = loop or asyncio.get_running_loop()
+
+    def submit(self, func: Callable, *args, **kwargs) -> asyncio.Future:
+        """
+        在线程池中执行 func，不等待结果，必须在事件循环中调用
+
+        :raises: DispatcherBusy 当排队任务数达到上限时
+        """
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise DispatcherBusy(f"{self._pending} tasks pending")
+            self._pending += 1
+        future = loop.run_in_executor(self.executor, self._run, functools.partial(func, *args, **kwargs))
+        self._track(future)
+        return future
+
+    async def run_blocking(self, func: Callable, *args, **kwargs) -> Any:
+        """在线程池中执行阻塞函数并等待结果"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def spawn(self, coro: Coroutine):
+        """
+        在主事件循环中运行协程，可以在事件循环或线程池中调用
+
+        :return: 事件循环中调用时返回 Task，其他线程中调用时返回 concurrent.futures.Future
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            task = loop.create_task(coro)
+            self._track(task)
+            return task
+        if self.loop is None or self.loop.is_closed():
+            coro.close()
+            raise RuntimeError("dispatcher has no running event loop")
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_exception)
+        return future
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def _run(self, func: Callable):
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _track(self, future):
+        self._tasks.add(future)
+        future.add_done_callback(self._tasks.discard)
+        future.add_done_callback(self._log_exception)
+
+    @staticmethod
+    def _log_exception(future):
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            logger.error(f"Background task failed: {exc!r}", exc_info=exc)
+
+
+# 进程内共享的调度器
+dispatcher = Dispatcher()
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """在共享线程池中执行阻塞函数"""
+    return await dispatcher.run_blocking(func, *args, **kwargs)
+
+
+def spawn(coro: Coroutine):
+    """在主事件循环中运行协程"""
+    return dispatcher.spawn(coro)
@@ -0,0 +1,289 @@
+import json
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .config import DB_NAME
+from .sql import SQLiteHelper, ThreadLocalSQLiteHelper
+
+logger = logging.getLogger(__name__)
+
+JOB_COLUMNS = ('id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL, '
+               "status TEXT NOT NULL DEFAULT 'ready', attempts INTEGER NOT NULL DEFAULT 0, "
+               'available_at REAL NOT NULL, lease_until REAL, created_at REAL NOT NULL, '
+               'dedup_key TEXT UNIQUE, last_error TEXT')
+
+
+class Job:
+    """从队列中领取的任务"""
+
+    __slots__ = ('id', 'kind', 'payload', 'attempts', 'created_at')
+
+    def __init__(self, id: int, kind: str, payload: Any, attempts: int, created_at: float):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.created_at = created_at
+
+
+class JobQueue:
+    """
+    基于 SQLite(wechat.db, WAL 模式) 的持久化任务队列
+
+    功能：
+    - 入队即落盘，进程重启后未完成的任务会被重新领取
+    - 批量领取，领取后在 visibility_timeout 内对其他工作线程不可见，超时未确认则重新可见
+    - 失败按指数退避重试，超过 max_attempts 后标记为 dead
+    - 通过 dedup_key 防止同一条消息重复入队
+
+    示例：
+    >>> queue = JobQueue()
+    >>> queue.enqueue('wechat_msg', {'tenant': 'default', 'msg': msg})
+    >>> for job in queue.claim(limit=10):
+    ...     handle(job.payload)
+    ...     queue.ack(job)
+    """
+
+    def __init__(
+        self,
+        db_name: str = DB_NAME,
+        table: str = 'jobs',
+        max_attempts: int = 5,
+        visibility_timeout: float = 300.0,
+        retry_backoff: float = 2.0,
+        clock: Callable[[], float] = time.time
+    ):
+        """
+        :param db_name: 数据库文件
+        :param table: 任务表名
+        :param max_attempts: 最大尝试次数
+        :param visibility_timeout: 领取后多长时间(秒)内未确认则重新可见，需大于单个任务的最长执行时间
+        :param retry_backoff: 重试间隔的底数，第 n 次失败后等待 retry_backoff ** n 秒
+        :param clock: 时间函数(墙上时间，多进程共享时需一致)
+        """
+        self.db_name = db_name
+        self.table = table
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+        self.retry_backoff = retry_backoff
+        self.clock = clock
+        self._db = ThreadLocalSQLiteHelper(db_name)
+        self._ready = threading.Condition()
+        db_helper = self._helper()
+        db_helper.create_table(table, JOB_COLUMNS)
+        db_helper.cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_ready ON {table} (status, available_at)")
+        db_helper.conn.commit()
+
+    def _helper(self) -> SQLiteHelper:
+        """每个线程使用自己的连接"""
+        return self._db.get()
+
+    def enqueue(self, kind: str, payload: Any, dedup_key: Optional[str] = None, delay: float = 0) -> Optional[int]:
+        """
+        任务入队并落盘
+
+        :param kind: 任务类型，对应 JobWorkerPool 中的处理函数
+        :param payload: 可 JSON 序列化的任务数据
+        :param dedup_key: 去重键，已存在相同键的任务时不再入队
+        :param delay: 延迟多少秒后可被领取
+        :return: 任务ID，重复时返回 None
+        """
+        db_helper = self._helper()
+        now = self.clock()
+        db_helper.cursor.execute(
+            f"INSERT OR IGNORE INTO {self.table} (kind, payload, available_at, created_at, dedup_key) "
+            f"VALUES (?, ?, ?, ?, ?)",
+            (kind, json.dumps(payload, ensure_ascii=False), now + delay, now, dedup_key))
+        db_helper.conn.commit()
+        job_id = db_helper.cursor.lastrowid if db_helper.cursor.rowcount else None
+        if job_id is not None:
+            with self._ready:
+                self._ready.notify()
+        return job_id
+
+    def enqueue_many(self, kind: str, items: List[Tuple[Any, Optional[str]]], delay: float = 0) -> int:
+        """
+        批量入队，在一个事务中落盘
+
+        :param kind: 任务类型
+        :param items: [(任务数据, 去重键)]
+        :param delay: 延迟多少秒后可被领取
+        :return: 实际入队的任务数，不含重复的任务
+        """
+        if not items:
+            return 0
+        db_helper = self._helper()
+        now = self.clock()
+        db_helper.cursor.executemany(
+            f"INSERT OR IGNORE INTO {self.table} (kind, payload, available_at, created_at, dedup_key) "
+            f"VALUES (?, ?, ?, ?, ?)",
+            [(kind, json.dumps(payload, ensure_ascii=False), now + delay, now, dedup_key)
+             for payload, dedup_key in items])
+        db_helper.conn.commit()
+        added = db_helper.cursor.rowcount
+        if added:
+            # 只唤醒与新任务数相同的工作线程，避免所有线程同时争抢写锁
+            with self._ready:
+                self._ready.notify(added)
+        return added
+
+    def claim(self, limit: int = 10, visibility_timeout: Optional[float] = None) -> List[Job]:
+        """
+        批量领取可执行的任务
+
+        :param limit: 最多领取的任务数
+        :param visibility_timeout: 本次领取的可见性超时，默认使用构造参数
+        """
+        db_helper = self._helper()
+        now = self.clock()
+        lease_until = now + (visibility_timeout or self.visibility_timeout)
+        conn = db_helper.conn
+        try:
+            # IMMEDIATE 事务保证多个线程/进程不会领取到同一批任务
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                f"SELECT id, kind, payload, attempts, created_at FROM {self.table} "
+                f"WHERE status = 'ready' AND available_at <= ? ORDER BY available_at, id LIMIT ?",
+                (now, limit)).fetchall()
+            if rows:
+                conn.executemany(
+                    f"UPDATE {self.table} SET attempts = attempts + 1, available_at = ?, lease_until = ? WHERE id = ?",
+                    [(lease_until, lease_until, row[0]) for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return [Job(row[0], row[1], json.loads(row[2]), row[3] + 1, row[4]) for row in rows]
+
+    def ack(self, job: Job):
+        """任务完成，从队列中删除"""
+        db_helper = self._helper()
+        db_helper.cursor.execute(f"DELETE FROM {self.table} WHERE id = ?", (job.id,))
+        db_helper.conn.commit()
+
+    def retry(self, job: Job, error: str = ''):
+        """任务失败，按退避时间重新可见，超过最大次数则标记为 dead"""
+        db_helper = self._helper()
+        if job.attempts >= self.max_attempts:
+            db_helper.cursor.execute(
+                f"UPDATE {self.table} SET status = 'dead', lease_until = NULL, last_error = ? WHERE id = ?",
+                (error, job.id))
+        else:
+            db_helper.cursor.execute(
+                f"UPDATE {self.table} SET available_at = ?, lease_until = NULL, last_error = ? WHERE id = ?",
+                (self.clock() + self.retry_backoff ** job.attempts, error, job.id))
+        db_helper.conn.commit()
+
+    def wait(self, timeout: float):
+        """等待新任务入队(仅能感知同一进程内的入队)"""
+        with self._ready:
+            self._ready.wait(timeout)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        队列指标
+        :return: depth 待完成任务数, inflight 已领取未确认数, dead 失败任务数, oldest_age 最早待完成任务的等待秒数
+        """
+        db_helper = self._helper()
+        now = self.clock()
+        row = db_helper.cursor.execute(
+            f"SELECT "
+            f"COALESCE(SUM(status = 'ready'), 0), "
+            f"COALESCE(SUM(status = 'ready' AND lease_until > ?), 0), "
+            f"COALESCE(SUM(status = 'dead'), 0), "
+            f"MIN(CASE WHEN status = 'ready' THEN created_at END) "
+            f"FROM {self.table}", (now,)).fetchone()
+        depth, inflight, dead, oldest = row
+        return {
+            'depth': depth,
+            'inflight': inflight,
+            'dead': dead,
+            'oldest_age': round(now - oldest, 3) if oldest is not None else 0.0,
+        }
+
+
+class JobWorkerPool:
+    """
+    任务队列的工作线程池
+
+    每个工作线程循环批量领取任务，按任务类型调用处理函数，成功确认、失败重试。
+    线程数即同时访问上游接口的并发上限。
+
+    示例：
+    >>> pool = JobWorkerPool(queue, {'wechat_msg': handle_msg}, workers=4)
+    >>> pool.start()
+    >>> pool.stop()
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handlers: Dict[str, Callable[[Any], Any]],
+        workers: int = 4,
+        batch_size: int = 10,
+        poll_interval: float = 1.0
+    ):
+        """
+        :param queue: JobQueue实例
+        :param handlers: 任务类型 -> 处理函数，处理函数抛出异常视为失败
+        :param workers: 工作线程数
+        :param batch_size: 每次领取的任务数
+        :param poll_interval: 队列为空时的轮询间隔(秒)
+        """
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        """
+        停止领取新任务，已领取未完成的任务在可见性超时后由其他进程重新领取
+        :param timeout: 等待全部工作线程退出的总时间(秒)
+        """
+        self._stopping.set()
+        with self.queue._ready:
+            self.queue._ready.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        self._threads = []
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                jobs = self.queue.claim(limit=self.batch_size)
+            except Exception as e:
+                logger.error(f"Claim jobs failed: {str(e)}", exc_info=True)
+                jobs = []
+            if not jobs:
+                self.queue.wait(self.poll_interval)
+                continue
+            for job in jobs:
+                if self._stopping.is_set():
+                    return
+                self._run(job)
+
+    def _run(self, job: Job):
+        handler = self.handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise LookupError(f"no handler for job kind '{job.kind}'")
+            handler(job.payload)
+        except Exception as e:
+            logger.error(f"Job {job.id} ({job.kind}) failed on attempt {job.attempts}: {str(e)}", exc_info=True)
+            self.queue.retry(job, repr(e))
+        else:
+            self.queue.ack(job)
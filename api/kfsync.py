@@ -0,0 +1,190 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from .config import DB_NAME
+from .sql import SQLiteHelper, ThreadLocalSQLiteHelper
+from .user import _wechat_get_msg
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CURSOR_COLUMNS = 'open_kfid TEXT PRIMARY KEY, cursor TEXT NOT NULL, updated_at REAL NOT NULL'
+# kf/sync_msg 每页最多返回的消息数
+PAGE_LIMIT = 1000
+# 预取下一页的线程数，所有租户、客服账号共用
+PREFETCH_WORKERS = 4
+
+KF_SYNC_PAGES_TOTAL = REGISTRY.counter(
+    'wechat_kf_sync_pages_total', 'kf/sync_msg pages fetched by outcome.', ('outcome',))
+KF_SYNC_MESSAGES_TOTAL = REGISTRY.counter(
+    'wechat_kf_sync_messages_total', 'Messages read from kf/sync_msg pages.')
+
+
+class CursorStore:
+    """
+    各客服账号 kf/sync_msg 的 cursor，保存在 wechat.db 的 kf_cursors 表中
+
+    还没有记录的客服账号沿用旧版 cursors 表中最新的 cursor(旧版不区分客服账号)。
+    """
+
+    def __init__(self, db_name: str = DB_NAME, table: str = 'kf_cursors', legacy_table: str = 'cursors',
+                 clock: Callable[[], float] = time.time):
+        """
+        :param db_name: 数据库文件
+        :param table: 表名
+        :param legacy_table: 旧版 cursor 表名
+        :param clock: 时间函数
+        """
+        self.db_name = db_name
+        self.table = table
+        self.legacy_table = legacy_table
+        self.clock = clock
+        self._db: Optional[ThreadLocalSQLiteHelper] = None
+        self._lock = threading.Lock()
+
+    def load(self, open_kfid: str) -> str:
+        db_helper = self._helper()
+        row = db_helper.cursor.execute(
+            f"SELECT cursor FROM {self.table} WHERE open_kfid = ?", (open_kfid,)).fetchone()
+        if row is not None:
+            return row[0]
+        exists = db_helper.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self.legacy_table,)).fetchone()
+        if exists:
+            row = db_helper.cursor.execute(
+                f"SELECT value FROM {self.legacy_table} ORDER BY id DESC LIMIT 1").fetchone()
+            if row is not None:
+                return row[0]
+        return ''
+
+    def save(self, open_kfid: str, cursor: str):
+        db_helper = self._helper()
+        db_helper.cursor.execute(
+            f"INSERT OR REPLACE INTO {self.table} (open_kfid, cursor, updated_at) VALUES (?, ?, ?)",
+            (open_kfid, cursor, self.clock()))
+        db_helper.conn.commit()
+
+    def _helper(self) -> SQLiteHelper:
+        with self._lock:
+            if self._db is None:
+                self._db = ThreadLocalSQLiteHelper(self.db_name)
+                self._db.get().create_table(self.table, CURSOR_COLUMNS)
+        return self._db.get()
+
+
+class KfSyncEngine:
+    """
+    微信客服消息同步：按 next_cursor 拉取客服账号的全部新消息
+
+    功能：
+    - 每一页的全部消息交给 handoff 处理(入队、发送确认或调度 AI 回复)
+    - 处理当前页的同时在后台线程中拉取下一页，积压的消息只需少数几次往返即可取完
+    - 一页消息交接完成后才保存该页的 next_cursor；中途失败或进程退出时从上一次保存的 cursor 重新拉取，
+      重复交接的消息由下游的去重键(ai_reply 任务、发件箱 msgid)去重
+
+    示例：
+    >>> engine = KfSyncEngine(handoff=lambda open_kfid, msg_list: ...)
+    >>> engine.sync(open_kfid, token)
+    {'pages': 3, 'messages': 2500, 'seconds': 0.8}
+    """
+
+    def __init__(
+        self,
+        handoff: Callable[[str, List[Dict[str, Any]]], Any],
+        fetch: Callable[[str, str, str, int], Optional[Dict[str, Any]]] = _wechat_get_msg,
+        store: Optional[CursorStore] = None,
+        limit: int = PAGE_LIMIT,
+        max_pages: int = 100
+    ):
+        """
+        :param handoff: handoff(open_kfid, msg_list)，抛出异常时不保存该页的 cursor 并停止本次同步
+        :param fetch: fetch(cursor, open_kfid, token, limit)，返回 kf/sync_msg 的结果
+        :param store: CursorStore实例，默认使用进程内共享的 cursor_store
+        :param limit: 每页消息数
+        :param max_pages: 一次同步最多拉取的页数，剩余消息由下一次回调继续拉取
+        """
+        self.handoff = handoff
+        self.fetch = fetch
+        self.store = store or cursor_store
+        self.limit = limit
+        self.max_pages = max_pages
+
+    def sync(self, open_kfid: str, token: str, renew: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+        """
+        拉取并交接客服账号的新消息，直到没有更多消息
+
+        :param open_kfid: 客服账号ID
+        :param token: 回调事件中的 Token，拉取消息时使用
+        :param renew: 每页交接前调用，返回 False 时停止(如多进程互斥的租约已丢失)
+        :return: {'pages': 页数, 'messages': 消息数, 'seconds': 耗时, 'error': 出错时的原因}
+        """
+        start = time.perf_counter()
+        stats: Dict[str, Any] = {'pages': 0, 'messages': 0}
+        cursor = self.store.load(open_kfid)
+        executor = _prefetch_executor()
+        pending = executor.submit(self.fetch, cursor, open_kfid, token, self.limit)
+        try:
+            while pending is not None:
+                result = pending.result()
+                pending = None
+                if not result or result.get('errcode') != 0:
+                    KF_SYNC_PAGES_TOTAL.inc('error')
+                    stats['error'] = f"kf/sync_msg failed: {result}"
+                    logger.error("kf/sync_msg for %s failed: %s", open_kfid, result)
+                    break
+                KF_SYNC_PAGES_TOTAL.inc('ok')
+                msg_list = result.get('msg_list') or []
+                next_cursor = result.get('next_cursor') or cursor
+                stats['pages'] += 1
+                # 交接当前页之前先发出下一页的请求
+                if result.get('has_more') and stats['pages'] < self.max_pages:
+                    pending = executor.submit(self.fetch, next_cursor, open_kfid, token, self.limit)
+                if renew is not None and not renew():
+                    stats['error'] = 'lease lost'
+                    logger.warning("Kf sync lease for %s lost, stop syncing", open_kfid)
+                    break
+                if msg_list:
+                    self.handoff(open_kfid, msg_list)
+                    KF_SYNC_MESSAGES_TOTAL.inc(amount=len(msg_list))
+                    stats['messages'] += len(msg_list)
+                if next_cursor != cursor:
+                    self.store.save(open_kfid, next_cursor)
+                    cursor = next_cursor
+        finally:
+            # 出错时丢弃已发出的预取请求，其结果不会被交接，cursor 也没有前进
+            if pending is not None:
+                pending.cancel()
+        stats['seconds'] = round(time.perf_counter() - start, 3)
+        logger.info("Kf sync for %s: %d pages, %d messages in %.3fs",
+                    open_kfid, stats['pages'], stats['messages'], stats['seconds'])
+        return stats
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _prefetch_executor() -> ThreadPoolExecutor:
+    """进程内共用的预取线程池，第一次同步时创建"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='kf-sync-prefetch')
+    return _executor
+
+
+def shutdown_prefetch(wait: bool = False):
+    """关闭预取线程池，应用退出时调用"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+# 进程内共享的 cursor 存储
+cursor_store = CursorStore()
@@ -0,0 +1,175 @@
+import sys
+import copy
+import json
+import queue
+import random
+import logging
+import logging.handlers
+from typing import Dict, Optional
+
+# LogRecord 自带的属性，其余属性(通过 extra 传入)作为结构化字段输出
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.Handler] = None
+_payload_sample_rate = 0.01
+_trace_listener: Optional[logging.handlers.QueueListener] = None
+# RequestClient 请求记录，只写入 --trace-file，不进入普通日志
+trace_logger = logging.getLogger('api.trace')
+trace_logger.propagate = False
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    JSON Lines 日志格式
+
+    每条日志一行：{"ts": ..., "level": ..., "logger": ..., "msg": ..., 其他 extra 字段}
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=repr)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    非阻塞的队列日志处理器
+
+    调用线程(事件循环)只做消息拼接并放入有界队列，JSON 序列化和 I/O 在后台线程中进行；
+    队列满时丢弃日志并计数，不阻塞请求。
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 只合并消息参数，保留 extra 字段，格式化交给后台线程
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(
+    level: str = 'INFO',
+    levels: Optional[Dict[str, str]] = None,
+    payload_sample_rate: float = 0.01,
+    filename: Optional[str] = None,
+    queue_size: int = 10000
+) -> NonBlockingQueueHandler:
+    """
+    配置结构化异步日志，重复调用时替换之前的配置
+
+    :param level: 根日志级别
+    :param levels: 按模块设置的日志级别，如 {'api.utils': 'DEBUG', 'WXBizMsgCrypt3': 'WARNING'}
+    :param payload_sample_rate: 请求体、消息列表等大数据日志的采样比例(0~1)，仅在 DEBUG 级别下生效
+    :param filename: 日志文件，为 None 时输出到标准输出
+    :param queue_size: 日志队列长度，队列满时丢弃
+    :return: 安装在根日志记录器上的队列处理器
+    """
+    global _listener, _queue_handler, _payload_sample_rate
+    shutdown_logging()
+    output = logging.FileHandler(filename, encoding='utf-8') if filename else logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(level.upper())
+    for name, module_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(module_level.upper())
+    _payload_sample_rate = payload_sample_rate
+    return _queue_handler
+
+
+def shutdown_logging():
+    """停止后台线程并写出队列中剩余的日志"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+
+
+def setup_request_trace(filename: str, queue_size: int = 10000) -> NonBlockingQueueHandler:
+    """
+    将 RequestClient 的请求记录以 JSON Lines 写入文件，由后台线程写出，重复调用时替换之前的文件
+    :param filename: 记录文件
+    :param queue_size: 队列长度，队列满时丢弃
+    """
+    global _trace_listener
+    shutdown_request_trace()
+    output = logging.FileHandler(filename, encoding='utf-8')
+    output.setFormatter(JsonFormatter())
+    handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    _trace_listener = logging.handlers.QueueListener(handler.queue, output)
+    _trace_listener.start()
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+    return handler
+
+
+def shutdown_request_trace():
+    global _trace_listener
+    if _trace_listener is not None:
+        _trace_listener.stop()
+        _trace_listener = None
+    for handler in list(trace_logger.handlers):
+        trace_logger.removeHandler(handler)
+
+
+def log_request_trace(trace):
+    """RequestHooks 的 post 钩子，trace 为 api.api.RequestTrace"""
+    if trace_logger.handlers:
+        trace_logger.info("http", extra=trace.to_dict())
+
+def parse_levels(spec: Optional[str]) -> Dict[str, str]:
+    """
+    解析按模块的日志级别
+    :param spec: 形如 "api.utils=DEBUG,WXBizMsgCrypt3=WARNING"
+    """
+    levels = {}
+    for item in (spec or '').split(','):
+        if '=' in item:
+            name, module_level = item.split('=', 1)
+            levels[name.strip()] = module_level.strip()
+    return levels
+
+
+def log_payload(logger: logging.Logger, msg: str, *args, **fields):
+    """
+    按采样比例记录请求体等大数据，未开启 DEBUG 或未被采样时不创建日志记录
+
+    :param logger: 日志记录器
+    :param msg: 日志消息
+    :param fields: 结构化字段
+    """
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < _payload_sample_rate:
+        logger.debug(msg, *args, extra=fields)
+
@@ -0,0 +1,253 @@
+import time
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import ierror
+
+# 默认的耗时分桶(秒)，覆盖微秒级的验签解密到秒级的上游请求
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# ierror 中的错误码 -> 名称
+ERROR_NAMES = {value: name.replace('WXBizMsgCrypt_', '') for name, value in vars(ierror).items()
+               if name.startswith('WXBizMsgCrypt_') and isinstance(value, int)}
+ERROR_NAMES.update({-1: 'ServerError', -2: 'ParseXml_Error'})
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """计数器，按标签值分别累加"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues: str) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    直方图
+
+    observe 只做一次二分查找和计数累加，分位数等计算留给 Prometheus 在抓取后完成。
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各桶计数..., +Inf 桶计数, 总和]
+        self._children: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            child = self._children.get(labelvalues)
+            if child is None:
+                child = self._children[labelvalues] = [0] * (len(self.buckets) + 2)
+            child[index] += 1
+            child[-1] += value
+
+    def time(self, *labelvalues: str, outcome: bool = False) -> '_Timer':
+        """
+        计时上下文
+        :param labelvalues: 标签值
+        :param outcome: 为 True 时在标签值末尾追加 ok/error，表示代码块是否抛出异常
+        """
+        return _Timer(self, labelvalues, outcome)
+
+    def count(self, *labelvalues: str) -> int:
+        child = self._children.get(labelvalues)
+        return sum(child[:-1]) if child else 0
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labelvalues, list(child)) for labelvalues, child in self._children.items())
+        for labelvalues, child in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, child):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            cumulative += child[-2]
+            labels = _format_labels(self.labelnames, labelvalues, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {child[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """当前值，可以直接设置，也可以注册在抓取时才计算的回调"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._functions: List[Callable[[], Dict[Tuple[str, ...], float]]] = []
+
+    def set(self, value: float, *labelvalues: str):
+        self._values[labelvalues] = value
+
+    def set_function(self, function: Callable[[], Dict[Tuple[str, ...], float]]):
+        """
+        注册抓取时计算的回调
+        :param function: 返回 {标签值元组: 值}
+        """
+        self._functions.append(function)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        values = dict(self._values)
+        for function in self._functions:
+            values.update(function())
+        for labelvalues, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {value}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labelvalues', 'outcome', 'start')
+
+    def __init__(self, histogram: Histogram, labelvalues: Tuple[str, ...], outcome: bool):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+        self.outcome = outcome
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labelvalues = self.labelvalues + (('error' if exc_type else 'ok'),) if self.outcome else self.labelvalues
+        self.histogram.observe(time.perf_counter() - self.start, *labelvalues)
+        return False
+
+
+class Registry:
+    """指标注册表，抓取时才生成 Prometheus 文本"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        metric = Gauge(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format(0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# 回调处理各阶段耗时：xml_extract(提取密文), signature(验签), decrypt(AES解密), xml_parse(解析明文), route(路由处理)
+CALLBACK_STAGE_SECONDS = REGISTRY.histogram(
+    'wechat_callback_stage_seconds', 'Time spent in each stage of the callback pipeline.', ('stage',))
+# 上游接口耗时：gettoken, kf/sync_msg, kf/send_msg, message/send, make_webhook
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'wechat_upstream_request_seconds', 'Time spent in upstream HTTP calls.', ('api', 'outcome'))
+MESSAGES_TOTAL = REGISTRY.counter(
+    'wechat_messages_total', 'Routed callback messages by MsgType and Event.', ('msg_type', 'event'))
+ERRORS_TOTAL = REGISTRY.counter(
+    'wechat_callback_errors_total', 'Failed callbacks by error code.', ('code', 'name'))
+# access_token 刷新耗时，trigger 为 request(请求路径上同步刷新) 或 background(后台提前刷新)
+TOKEN_REFRESH_SECONDS = REGISTRY.histogram(
+    'wechat_token_refresh_seconds', 'Time spent refreshing access tokens.', ('token', 'trigger', 'outcome'))
+TOKEN_AGE_SECONDS = REGISTRY.gauge(
+    'wechat_token_age_seconds', 'Seconds since the cached access token was fetched.', ('token',))
+TOKEN_EXPIRES_IN_SECONDS = REGISTRY.gauge(
+    'wechat_token_expires_in_seconds', 'Seconds until the cached access token expires.', ('token',))
+# RequestClient 请求记录，phase 为 dns/connect/ttfb/total
+HTTP_CLIENT_SECONDS = REGISTRY.histogram(
+    'wechat_http_client_seconds', 'Outbound HTTP time by endpoint and phase.', ('endpoint', 'phase'))
+HTTP_CLIENT_RESPONSE_BYTES = REGISTRY.histogram(
+    'wechat_http_client_response_bytes', 'Outbound HTTP response body size.', ('endpoint',),
+    buckets=(100, 1000, 10000, 100000, 1000000, 10000000))
+HTTP_CLIENT_REQUESTS_TOTAL = REGISTRY.counter(
+    'wechat_http_client_requests_total', 'Outbound HTTP requests by endpoint and status.', ('endpoint', 'status'))
+HTTP_CLIENT_RETRIES_TOTAL = REGISTRY.counter(
+    'wechat_http_client_retries_total', 'Outbound HTTP retries done by urllib3 Retry.', ('endpoint',))
+
+# AI 回复耗时：从调用 make.com 到第一段(first)、最后一段(last)回复交给 kf/send_msg 或发件箱
+AI_REPLY_SECONDS = REGISTRY.histogram(
+    'wechat_ai_reply_seconds', 'Time from calling the AI backend to handing off the first/last reply segment.',
+    ('segment',))
+
+
+def observe_stage(stage: str, seconds: float):
+    """WXBizMsgCrypt.stage_observer 回调"""
+    CALLBACK_STAGE_SECONDS.observe(seconds, stage)
+
+
+def count_error(code: int):
+    ERRORS_TOTAL.inc(str(code), ERROR_NAMES.get(code, 'Unknown'))
+
+
+def time_upstream(api: str) -> _Timer:
+    """上游接口计时上下文，按是否抛出异常记录 ok/error"""
+    return UPSTREAM_SECONDS.time(api, outcome=True)
+
+
+def observe_request(trace):
+    """RequestHooks 的 post 钩子，trace 为 api.api.RequestTrace"""
+    endpoint = trace.endpoint
+    if trace.dns:
+        HTTP_CLIENT_SECONDS.observe(trace.dns, endpoint, 'dns')
+    if trace.connect:
+        HTTP_CLIENT_SECONDS.observe(trace.connect, endpoint, 'connect')
+    if trace.ttfb:
+        HTTP_CLIENT_SECONDS.observe(trace.ttfb, endpoint, 'ttfb')
+    HTTP_CLIENT_SECONDS.observe(trace.total, endpoint, 'total')
+    HTTP_CLIENT_RESPONSE_BYTES.observe(trace.bytes, endpoint)
+    HTTP_CLIENT_REQUESTS_TOTAL.inc(endpoint, str(trace.status or trace.error))
+    if trace.attempts > 1:
+        HTTP_CLIENT_RETRIES_TOTAL.inc(endpoint, amount=trace.attempts - 1)
@@ -0,0 +1,382 @@
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .config import DB_NAME
+from .sql import SQLiteHelper, ThreadLocalSQLiteHelper
+from .user import _wechat_send_text, _wechat_send_msg, _wechat_send_msg_async
+from .dispatcher import run_blocking
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_COLUMNS = ('id INTEGER PRIMARY KEY AUTOINCREMENT, open_kfid TEXT NOT NULL, touser TEXT NOT NULL, '
+                  'msgid TEXT NOT NULL UNIQUE, content TEXT NOT NULL, '
+                  "status TEXT NOT NULL DEFAULT 'ready', attempts INTEGER NOT NULL DEFAULT 0, "
+                  'available_at REAL NOT NULL, created_at REAL NOT NULL, sent_at REAL, last_error TEXT')
+# 可重试的错误码：系统繁忙、调用频率/并发超限
+RETRY_ERRCODES = (-1, 45009, 45033)
+
+
+def make_msgid(key: str) -> str:
+    """由业务键生成稳定的消息ID(kf/send_msg 的 msgid 最长 32 字节，只能包含字母数字)"""
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:32]
+
+
+class OutboxMessage:
+    """从发件箱中领取的消息"""
+
+    __slots__ = ('id', 'open_kfid', 'touser', 'msgid', 'content', 'attempts', 'created_at')
+
+    def __init__(self, id: int, open_kfid: str, touser: str, msgid: str, content: str, attempts: int,
+                 created_at: float):
+        self.id = id
+        self.open_kfid = open_kfid
+        self.touser = touser
+        self.msgid = msgid
+        self.content = content
+        self.attempts = attempts
+        self.created_at = created_at
+
+
+class Outbox:
+    """
+    微信客服消息发件箱，基于 SQLite(wechat.db, WAL 模式)
+
+    功能：
+    - 入队即落盘，进程重启后未发送的消息继续发送
+    - 同一个 (open_kfid, 客户) 的消息按入队顺序逐条发送，前一条发送成功或放弃之前后一条不会被领取；
+      不同客户的消息由多个工作线程并行发送
+    - msgid 由业务键生成，同一个键只入队一次；重试使用相同的 msgid，企业微信不会重复投递
+    - 可重试的错误按指数退避重试，超过 max_attempts 或不可重试的错误标记为 dead
+
+    示例：
+    >>> outbox = Outbox()
+    >>> outbox.enqueue(open_kfid, external_userid, '处理中...', key=f"ack:{msgid}")
+    >>> for message in outbox.claim(limit=10):
+    ...     outbox.deliver(message, _wechat_send_text)
+    """
+
+    def __init__(
+        self,
+        db_name: str = DB_NAME,
+        table: str = 'outbox',
+        max_attempts: int = 8,
+        visibility_timeout: float = 60.0,
+        retry_backoff: float = 2.0,
+        retention: float = 86400.0,
+        clock: Callable[[], float] = time.time
+    ):
+        """
+        :param db_name: 数据库文件
+        :param table: 表名
+        :param max_attempts: 最大尝试次数
+        :param visibility_timeout: 领取后多长时间(秒)内未完成则重新可见，需大于单条消息的最长发送时间
+        :param retry_backoff: 重试间隔的底数，第 n 次失败后等待 retry_backoff ** n 秒
+        :param retention: 已发送消息保留多少秒，期间相同的业务键不会再次入队
+        :param clock: 时间函数(墙上时间，多进程共享时需一致)
+        """
+        self.db_name = db_name
+        self.table = table
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+        self.retry_backoff = retry_backoff
+        self.retention = retention
+        self.clock = clock
+        self._db = ThreadLocalSQLiteHelper(db_name)
+        self._ready = threading.Condition()
+        db_helper = self._helper()
+        db_helper.create_table(table, OUTBOX_COLUMNS)
+        db_helper.cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_ready ON {table} (status, available_at)")
+        db_helper.cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_customer ON {table} (open_kfid, touser, status, id)")
+        db_helper.conn.commit()
+
+    def _helper(self) -> SQLiteHelper:
+        """每个线程使用自己的连接"""
+        return self._db.get()
+
+    def enqueue(self, open_kfid: str, touser: str, content: str, key: str) -> Optional[int]:
+        """
+        消息入队并落盘
+
+        :param open_kfid: 客服账号ID
+        :param touser: 客户的 external_userid
+        :param content: 文本内容
+        :param key: 业务键(如 f"ack:{收到的msgid}")，用于生成 msgid 和去重
+        :return: 消息ID，重复时返回 None
+        """
+        db_helper = self._helper()
+        now = self.clock()
+        db_helper.cursor.execute(
+            f"INSERT OR IGNORE INTO {self.table} (open_kfid, touser, msgid, content, available_at, created_at) "
+            f"VALUES (?, ?, ?, ?, ?, ?)",
+            (open_kfid, touser, make_msgid(key), content, now, now))
+        db_helper.conn.commit()
+        message_id = db_helper.cursor.lastrowid if db_helper.cursor.rowcount else None
+        if message_id is not None:
+            with self._ready:
+                self._ready.notify()
+        return message_id
+
+    def enqueue_many(self, messages: List[Tuple[str, str, str, str]]) -> int:
+        """
+        批量入队，在一个事务中落盘，同一客户的消息按列表顺序发送
+
+        :param messages: [(open_kfid, touser, content, key)]
+        :return: 实际入队的消息数，不含重复的消息
+        """
+        if not messages:
+            return 0
+        db_helper = self._helper()
+        now = self.clock()
+        db_helper.cursor.executemany(
+            f"INSERT OR IGNORE INTO {self.table} (open_kfid, touser, msgid, content, available_at, created_at) "
+            f"VALUES (?, ?, ?, ?, ?, ?)",
+            [(open_kfid, touser, make_msgid(key), content, now, now) for open_kfid, touser, content, key in messages])
+        db_helper.conn.commit()
+        added = db_helper.cursor.rowcount
+        if added:
+            # 只唤醒与新任务数相同的工作线程，避免所有线程同时争抢写锁
+            with self._ready:
+                self._ready.notify(added)
+        return added
+
+    def claim(self, limit: int = 10, visibility_timeout: Optional[float] = None) -> List[OutboxMessage]:
+        """
+        领取可发送的消息，每个客户最多一条(该客户最早的未完成消息)
+
+        :param limit: 最多领取的消息数
+        :param visibility_timeout: 本次领取的可见性超时，默认使用构造参数
+        """
+        db_helper = self._helper()
+        now = self.clock()
+        lease_until = now + (visibility_timeout or self.visibility_timeout)
+        conn = db_helper.conn
+        try:
+            # 领取中或等待重试的消息仍为 ready，同一客户的后续消息因不是最早的一条而不会被领取
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                f"SELECT id, open_kfid, touser, msgid, content, attempts, created_at FROM {self.table} AS o "
+                f"WHERE status = 'ready' AND available_at <= ? AND id = ("
+                f"SELECT MIN(id) FROM {self.table} WHERE open_kfid = o.open_kfid AND touser = o.touser "
+                f"AND status = 'ready') ORDER BY available_at, id LIMIT ?",
+                (now, limit)).fetchall()
+            if rows:
+                conn.executemany(
+                    f"UPDATE {self.table} SET attempts = attempts + 1, available_at = ? WHERE id = ?",
+                    [(lease_until, row[0]) for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return [OutboxMessage(*row[:5], row[5] + 1, row[6]) for row in rows]
+
+    def deliver(self, message: OutboxMessage, send: Callable[[str, str, str, str], Dict[str, Any]]) -> bool:
+        """
+        发送一条已领取的消息并记录结果
+
+        :param send: send(touser, open_kfid, content, msgid)，返回接口结果，请求失败时抛出异常
+        :return: 是否发送成功
+        """
+        try:
+            result = send(message.touser, message.open_kfid, message.content, message.msgid)
+        except Exception as e:
+            logger.warning(f"Outbox message {message.id} attempt {message.attempts} failed: {e!r}")
+            self._retry(message, repr(e))
+            return False
+        errcode = result.get('errcode', -1)
+        if errcode == 0:
+            self._finish(message, 'sent')
+            return True
+        error = f"{errcode} {result.get('errmsg', '')}"
+        logger.warning(f"Outbox message {message.id} attempt {message.attempts} failed: {error}")
+        if errcode in RETRY_ERRCODES:
+            self._retry(message, error)
+        else:
+            self._finish(message, 'dead', error)
+        return False
+
+    def purge(self) -> int:
+        """删除超过保留时间的已发送消息"""
+        db_helper = self._helper()
+        db_helper.cursor.execute(
+            f"DELETE FROM {self.table} WHERE status = 'sent' AND sent_at < ?", (self.clock() - self.retention,))
+        db_helper.conn.commit()
+        return db_helper.cursor.rowcount
+
+    def wait(self, timeout: float):
+        """等待新消息入队(仅能感知同一进程内的入队)"""
+        with self._ready:
+            self._ready.wait(timeout)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        发件箱指标
+        :return: depth 待发送消息数, customers 有待发送消息的客户数, dead 放弃的消息数, oldest_age 最早待发送消息的等待秒数
+        """
+        db_helper = self._helper()
+        now = self.clock()
+        row = db_helper.cursor.execute(
+            f"SELECT "
+            f"COALESCE(SUM(status = 'ready'), 0), "
+            f"COUNT(DISTINCT CASE WHEN status = 'ready' THEN open_kfid || ':' || touser END), "
+            f"COALESCE(SUM(status = 'dead'), 0), "
+            f"MIN(CASE WHEN status = 'ready' THEN created_at END) "
+            f"FROM {self.table}").fetchone()
+        depth, customers, dead, oldest = row
+        return {
+            'depth': depth,
+            'customers': customers,
+            'dead': dead,
+            'oldest_age': round(now - oldest, 3) if oldest is not None else 0.0,
+        }
+
+    def _retry(self, message: OutboxMessage, error: str):
+        if message.attempts >= self.max_attempts:
+            self._finish(message, 'dead', error)
+            return
+        db_helper = self._helper()
+        db_helper.cursor.execute(
+            f"UPDATE {self.table} SET available_at = ?, last_error = ? WHERE id = ?",
+            (self.clock() + self.retry_backoff ** message.attempts, error, message.id))
+        db_helper.conn.commit()
+
+    def _finish(self, message: OutboxMessage, status: str, error: Optional[str] = None):
+        """发送成功或放弃，该客户的下一条消息可以被领取"""
+        db_helper = self._helper()
+        db_helper.cursor.execute(
+            f"UPDATE {self.table} SET status = ?, sent_at = ?, last_error = ? WHERE id = ?",
+            (status, self.clock(), error, message.id))
+        db_helper.conn.commit()
+        with self._ready:
+            self._ready.notify()
+
+
+class OutboxWorkerPool:
+    """
+    发件箱的工作线程池
+
+    每个工作线程循环领取消息并发送，线程数即同时发送的客户数上限。
+
+    示例：
+    >>> pool = OutboxWorkerPool(outbox, workers=4)
+    >>> pool.start()
+    >>> pool.stop()
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        send: Callable[[str, str, str, str], Dict[str, Any]] = _wechat_send_text,
+        workers: int = 4,
+        batch_size: int = 10,
+        poll_interval: float = 1.0,
+        purge_interval: float = 3600.0
+    ):
+        """
+        :param outbox: Outbox实例
+        :param send: 发送函数，见 Outbox.deliver
+        :param workers: 工作线程数
+        :param batch_size: 每次领取的消息数
+        :param poll_interval: 没有可发送消息时的轮询间隔(秒)，也是等待重试的最小粒度
+        :param purge_interval: 清理已发送消息的间隔(秒)
+        """
+        self.outbox = outbox
+        self.send = send
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._purged_at = 0.0
+
+    def start(self):
+        self._stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'outbox-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        """停止领取新消息，已领取未完成的消息在可见性超时后重新发送(msgid 不变)"""
+        self._stopping.set()
+        with self.outbox._ready:
+            self.outbox._ready.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                self._maybe_purge()
+                messages = self.outbox.claim(limit=self.batch_size)
+            except Exception as e:
+                logger.error(f"Claim outbox messages failed: {str(e)}", exc_info=True)
+                messages = []
+            if not messages:
+                self.outbox.wait(self.poll_interval)
+                continue
+            for message in messages:
+                if self._stopping.is_set():
+                    return
+                try:
+                    self.outbox.deliver(message, self.send)
+                except Exception as e:
+                    logger.error(f"Outbox message {message.id} failed: {str(e)}", exc_info=True)
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if now - self._purged_at < self.purge_interval:
+            return
+        self._purged_at = now
+        purged = self.outbox.purge()
+        if purged:
+            logger.info("Purged %d sent outbox messages", purged)
+
+
+# 进程内的发件箱，由 web.create_app 按 --outbox-workers 配置；为 None 时直接调用 kf/send_msg
+outbox: Optional[Outbox] = None
+
+
+def configure_outbox(instance: Optional[Outbox]):
+    global outbox
+    outbox = instance
+
+
+def outbox_enabled() -> bool:
+    """是否配置了发件箱，配置后发出的消息先落盘再按客户顺序发送"""
+    return outbox is not None
+
+
+def send_kf_text(touser: str, open_kfid: str, content: str, key: str):
+    """
+    给微信客服客户发送文本消息：配置了发件箱时入队，否则直接发送
+    :param key: 业务键，同一个键只发送一次
+    """
+    if outbox is not None:
+        return outbox.enqueue(open_kfid, touser, content, key)
+    return _wechat_send_msg(touser, make_msgid(key), open_kfid, {'content': content})
+
+
+def send_kf_texts(messages: List[Tuple[str, str, str, str]]):
+    """
+    批量发送文本消息：配置了发件箱时在一个事务中入队，否则逐条直接发送
+    :param messages: [(touser, open_kfid, content, key)]
+    """
+    if outbox is not None:
+        return outbox.enqueue_many([(open_kfid, touser, content, key) for touser, open_kfid, content, key in messages])
+    for touser, open_kfid, content, key in messages:
+        send_kf_text(touser, open_kfid, content, key)
+    return len(messages)
+
+
+async def asend_kf_text(touser: str, open_kfid: str, content: str, key: str):
+    """send_kf_text 的异步版本，入队在线程池中执行，直接发送时使用异步客户端"""
+    if outbox is not None:
+        return await run_blocking(outbox.enqueue, open_kfid, touser, content, key)
+    return await _wechat_send_msg_async(touser, make_msgid(key), open_kfid, {'content': content})
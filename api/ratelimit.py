@@ -0,0 +1,209 @@
+import time
+import asyncio
+import threading
+from urllib.parse import urlsplit
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .metrics import REGISTRY
+
+# 默认限制：{接口: {限流维度: (每秒请求数, 突发容量)}}，'*' 对所有接口生效
+# 企业微信对每个企业调用单个接口的频率约为 1万次/分钟，客服消息对单个客户另有限制
+DEFAULT_LIMITS = {
+    '*': {'corp': (150.0, 300)},
+    'kf/send_msg': {'external_userid': (1.0, 5)},
+}
+
+RATELIMIT_WAIT_SECONDS = REGISTRY.histogram(
+    'wechat_ratelimit_wait_seconds', 'Time outbound calls waited for a rate limit slot.', ('endpoint',))
+RATELIMIT_WAITING = REGISTRY.gauge(
+    'wechat_ratelimit_waiting', 'Outbound calls currently waiting for a rate limit slot.', ('endpoint',))
+
+
+class TokenBucket:
+    """
+    令牌桶
+
+    reserve 预约一个令牌，令牌不足时余额为负，返回需要等待的秒数；
+    先预约的调用方先拿到令牌(FIFO)，超限的调用排队而不是被拒绝。
+    """
+
+    __slots__ = ('rate', 'burst', '_tokens', '_updated', '_lock')
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = now
+        self._lock = threading.Lock()
+
+    def reserve(self, now: float) -> float:
+        with self._lock:
+            self._refill(now)
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def cancel(self, now: float):
+        """归还未使用的预约"""
+        with self._lock:
+            self._refill(now)
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def idle(self, now: float) -> bool:
+        """令牌已满，可以回收"""
+        return self._tokens + (now - self._updated) * self.rate >= self.burst
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RateLimiter:
+    """
+    按接口和维度(corp, open_kfid, external_userid 等)限流的请求调度器
+
+    同一次调用在各个匹配的令牌桶中预约，等待其中最长的时间后发出；
+    等待时间计入 wechat_ratelimit_wait_seconds，正在等待的调用数计入 wechat_ratelimit_waiting。
+
+    示例：
+    >>> limiter = RateLimiter()
+    >>> limiter.configure('kf/send_msg', 'external_userid', rate=0.5, burst=5)
+    >>> limiter.acquire('https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg', {'corp': corpid, 'external_userid': userid})
+    """
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, Tuple[float, int]]]] = None,
+                 clock: Callable[[], float] = time.monotonic, sweep_every: int = 1000):
+        """
+        :param limits: {接口: {维度: (每秒请求数, 突发容量)}}，默认 DEFAULT_LIMITS
+        :param clock: 时间函数
+        :param sweep_every: 每预约多少次回收一次空闲的令牌桶
+        """
+        self.clock = clock
+        self.sweep_every = sweep_every
+        self._limits: Dict[str, Dict[str, Tuple[float, int]]] = {}
+        self._buckets: Dict[Tuple[str, str, str], TokenBucket] = {}
+        self._waiting: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._reservations = 0
+        for endpoint, rules in (DEFAULT_LIMITS if limits is None else limits).items():
+            for per, (rate, burst) in rules.items():
+                self.configure(endpoint, per, rate, burst)
+
+    def configure(self, endpoint: str, per: str, rate: float, burst: int):
+        """
+        设置限制，rate 为 0 时删除该限制
+        :param endpoint: 接口，如 kf/send_msg，'*' 表示所有接口
+        :param per: 限流维度，如 corp, open_kfid, external_userid
+        :param rate: 每秒请求数
+        :param burst: 突发容量
+        """
+        with self._lock:
+            rules = self._limits.setdefault(endpoint, {})
+            if rate > 0:
+                rules[per] = (float(rate), max(int(burst), 1))
+            else:
+                rules.pop(per, None)
+            # 已有的令牌桶按新配置重建
+            for bucket_key in [k for k in self._buckets if k[1] == per and endpoint in ('*', k[0])]:
+                del self._buckets[bucket_key]
+
+    @staticmethod
+    def endpoint_of(url: str) -> str:
+        """https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token=... -> kf/send_msg"""
+        parts = urlsplit(url.strip())
+        path = parts.path
+        if '/cgi-bin/' in path:
+            return path.split('/cgi-bin/', 1)[1].strip('/')
+        return parts.netloc + path
+
+    def reserve(self, endpoint: str, keys: Optional[Dict[str, str]] = None) -> Tuple[float, List[TokenBucket]]:
+        """
+        在所有匹配的令牌桶中预约
+        :return: (需要等待的秒数, 预约过的令牌桶)
+        """
+        keys = keys or {}
+        now = self.clock()
+        wait = 0.0
+        reserved = []
+        with self._lock:
+            rules = {**self._limits.get('*', {}), **self._limits.get(endpoint, {})}
+            for per, (rate, burst) in rules.items():
+                # '*' 规则也按接口分别计数，未提供的维度共用一个令牌桶
+                bucket_key = (endpoint, per, str(keys.get(per, '')))
+                bucket = self._buckets.get(bucket_key)
+                if bucket is None:
+                    bucket = self._buckets[bucket_key] = TokenBucket(rate, burst, now)
+                reserved.append(bucket)
+            self._reservations += 1
+            if self._reservations % self.sweep_every == 0:
+                self._sweep(now)
+        for bucket in reserved:
+            wait = max(wait, bucket.reserve(now))
+        return wait, reserved
+
+    def acquire(self, url: str, keys: Optional[Dict[str, str]] = None) -> float:
+        """同步等待，返回等待的秒数"""
+        endpoint = self.endpoint_of(url)
+        wait, _ = self.reserve(endpoint, keys)
+        if wait > 0:
+            self._enter(endpoint)
+            try:
+                time.sleep(wait)
+            finally:
+                self._leave(endpoint)
+        RATELIMIT_WAIT_SECONDS.observe(wait, endpoint)
+        return wait
+
+    async def aacquire(self, url: str, keys: Optional[Dict[str, str]] = None) -> float:
+        """异步等待，不占用事件循环；等待中被取消时归还预约"""
+        endpoint = self.endpoint_of(url)
+        wait, reserved = self.reserve(endpoint, keys)
+        if wait > 0:
+            self._enter(endpoint)
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                now = self.clock()
+                for bucket in reserved:
+                    bucket.cancel(now)
+                raise
+            finally:
+                self._leave(endpoint)
+        RATELIMIT_WAIT_SECONDS.observe(wait, endpoint)
+        return wait
+
+    def waiting(self) -> Dict[Tuple[str], int]:
+        """各接口正在等待的调用数，供 /metrics 抓取"""
+        return {(endpoint,): count for endpoint, count in list(self._waiting.items())}
+
+    def _enter(self, endpoint: str):
+        with self._lock:
+            self._waiting[endpoint] = self._waiting.get(endpoint, 0) + 1
+
+    def _leave(self, endpoint: str):
+        with self._lock:
+            self._waiting[endpoint] -= 1
+
+    def _sweep(self, now: float):
+        for bucket_key in [k for k, bucket in self._buckets.items() if bucket.idle(now)]:
+            del self._buckets[bucket_key]
+
+
+def parse_limit(spec: str) -> Tuple[str, str, float, int]:
+    """
+    解析命令行中的限制
+    :param spec: 形如 "kf/send_msg:external_userid=0.5/5"，表示每秒 0.5 次、突发 5 次
+    :return: (接口, 维度, 每秒请求数, 突发容量)
+    """
+    try:
+        endpoint, rule = spec.rsplit(':', 1)
+        per, value = rule.split('=', 1)
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        return endpoint.strip(), per.strip(), rate, int(burst) if burst else max(int(rate), 1)
+    except ValueError:
+        raise ValueError(f"invalid rate limit '{spec}', expected endpoint:per=rate/burst")
+
+
+# 进程内共享的限流器，多进程部署时每个进程各自计数
+rate_limiter = RateLimiter()
+RATELIMIT_WAITING.set_function(rate_limiter.waiting)
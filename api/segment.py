@@ -0,0 +1,109 @@
+from typing import List
+
+# kf/send_msg 文本消息内容的最大字节数
+MAX_TEXT_BYTES = 2048
+# 可以在其后断开的字符：句末标点、分号和换行
+SENTENCE_ENDS = frozenset('。！？!?；;…\n')
+# 单条消息内找不到句末标点时，退而在这些字符后断开
+SOFT_BREAKS = frozenset('，,、：: \t')
+
+
+def split_utf8(text: str, limit: int = MAX_TEXT_BYTES) -> List[str]:
+    """
+    把文本切成 UTF-8 编码不超过 limit 字节的若干段，不会切断多字节字符，
+    优先在句末标点处断开，其次在逗号、空格处断开，都没有时按字节上限断开
+    """
+    pieces = []
+    while len(text.encode('utf-8')) > limit:
+        # 截取 limit 字节后丢弃末尾不完整的字符，得到不超过上限的最长前缀
+        head = text.encode('utf-8')[:limit].decode('utf-8', 'ignore')
+        cut = _last_break(head, SENTENCE_ENDS) or _last_break(head, SOFT_BREAKS) or len(head)
+        pieces.append(text[:cut])
+        text = text[cut:]
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def _last_break(text: str, breaks: frozenset) -> int:
+    """最后一个断开字符之后的位置，只在后半段查找，避免切出过短的片段"""
+    for index in range(len(text) - 1, len(text) // 2 - 1, -1):
+        if text[index] in breaks:
+            return index + 1
+    return 0
+
+
+class ReplySegmenter:
+    """
+    把流式返回的 AI 回答切成适合逐条发送的片段
+
+    - feed 追加收到的文本，返回已经可以发送的片段：缓冲区中最后一个句末标点之前的内容，
+      且不短于 min_bytes(第一段除外，尽快让客户看到回复)
+    - 缓冲区超过 limit 字节时即使没有句末标点也按字节上限切出
+    - 已发出 max_segments - 1 段后不再提前发送，剩余内容在 flush 时作为最后一段，
+      超出字节上限的部分被截断
+    - flush 在回答结束时调用，返回剩余的片段；非流式读取时把整个回答传给 flush，按字节上限切成尽量少的段
+
+    示例：
+    >>> segmenter = ReplySegmenter()
+    >>> for chunk in stream:
+    ...     for segment in segmenter.feed(chunk):
+    ...         send(segment)
+    >>> for segment in segmenter.flush():
+    ...     send(segment)
+    """
+
+    def __init__(self, limit: int = MAX_TEXT_BYTES, min_bytes: int = 120, max_segments: int = 4):
+        """
+        :param limit: 每段的最大字节数
+        :param min_bytes: 第二段起每段的最小字节数，较短的句子会与后面的句子合并
+        :param max_segments: 最多发送的段数(客户每发一条消息，客服最多可回复 5 条)
+        """
+        self.limit = limit
+        self.min_bytes = min_bytes
+        self.max_segments = max_segments
+        self.emitted = 0
+        self._buffer = ''
+
+    def feed(self, text: str) -> List[str]:
+        self._buffer += text
+        segments = []
+        while self.emitted < self.max_segments - 1:
+            segment = self._take()
+            if not segment:
+                break
+            segments.append(segment)
+            self.emitted += 1
+        return segments
+
+    def flush(self, text: str = '') -> List[str]:
+        text, self._buffer = self._buffer + text, ''
+        if not text.strip():
+            return []
+        pieces = split_utf8(text, self.limit)
+        remaining = self.max_segments - self.emitted
+        if len(pieces) > remaining:
+            # 超出条数限制，最后一段截断并加省略号
+            last = ''.join(pieces[remaining - 1:])
+            pieces = pieces[:remaining - 1] + [split_utf8(last, self.limit - len('…'.encode('utf-8')))[0] + '…']
+        self.emitted += len(pieces)
+        return pieces
+
+    def _take(self) -> str:
+        """从缓冲区切出一段，没有可发送的内容时返回空字符串"""
+        buffer = self._buffer
+        if len(buffer.encode('utf-8')) > self.limit:
+            segment = split_utf8(buffer, self.limit)[0]
+        else:
+            cut = 0
+            for index in range(len(buffer) - 1, -1, -1):
+                if buffer[index] in SENTENCE_ENDS:
+                    cut = index + 1
+                    break
+            segment = buffer[:cut]
+            if not segment.strip():
+                return ''
+            if self.emitted and len(segment.encode('utf-8')) < self.min_bytes:
+                return ''
+        self._buffer = buffer[len(segment):]
+        return segment
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+from .config import DB_NAME
+from .sql import ThreadLocalSQLiteHelper
+
+SHARED_COLUMNS = 'key TEXT PRIMARY KEY, value TEXT, expires_at REAL'
+
+
+def owner_id() -> str:
+    """当前进程+线程的唯一标识，用作租约持有者"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+class SharedStore:
+    """
+    跨进程共享的键值存储
+
+    基于 wechat.db(WAL 模式)，同一台机器上的多个 worker 进程共享：
+    - 带过期时间的键值，值为可 JSON 序列化的对象
+    - add 仅在键不存在或已过期时写入，可用于去重占位
+    - 租约(lease)提供带超时的跨进程互斥，持有者崩溃后自动失效
+
+    示例：
+    >>> store = SharedStore()
+    >>> store.set('k', {'a': 1}, ttl=60)
+    >>> with store.lease('kf_sync:wk123', ttl=60) as acquired:
+    ...     if acquired:
+    ...         sync()
+    """
+
+    def __init__(self, db_name: str = DB_NAME, table: str = 'shared_kv', clock: Callable[[], float] = time.time):
+        """
+        :param db_name: 数据库文件
+        :param table: 表名
+        :param clock: 时间函数(墙上时间，各进程需一致)
+        """
+        self.db_name = db_name
+        self.table = table
+        self.clock = clock
+        self._db = ThreadLocalSQLiteHelper(db_name)
+        self._db.get().create_table(table, SHARED_COLUMNS)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        db_helper = self._db.get()
+        row = db_helper.cursor.execute(
+            f"SELECT value FROM {self.table} WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, self.clock())).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        db_helper = self._db.get()
+        db_helper.cursor.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), self._expires_at(ttl)))
+        db_helper.conn.commit()
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """键不存在或已过期时写入，返回是否写入成功"""
+        db_helper = self._db.get()
+        now = self.clock()
+        db_helper.cursor.execute(
+            f"INSERT INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?) "
+            f"ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+            f"WHERE {self.table}.expires_at IS NOT NULL AND {self.table}.expires_at <= ?",
+            (key, json.dumps(value, ensure_ascii=False), self._expires_at(ttl), now))
+        db_helper.conn.commit()
+        return db_helper.cursor.rowcount == 1
+
+    def delete(self, key: str):
+        db_helper = self._db.get()
+        db_helper.cursor.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        db_helper.conn.commit()
+
+    def purge_expired(self) -> int:
+        """清理过期的键"""
+        db_helper = self._db.get()
+        db_helper.cursor.execute(
+            f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (self.clock(),))
+        db_helper.conn.commit()
+        return db_helper.cursor.rowcount
+
+    def acquire_lease(self, name: str, ttl: float, owner: Optional[str] = None) -> bool:
+        """获取租约，已持有时续期"""
+        owner = owner or owner_id()
+        key = f"lease:{name}"
+        if self.add(key, owner, ttl):
+            return True
+        db_helper = self._db.get()
+        db_helper.cursor.execute(
+            f"UPDATE {self.table} SET expires_at = ? WHERE key = ? AND value = ?",
+            (self._expires_at(ttl), key, json.dumps(owner)))
+        db_helper.conn.commit()
+        return db_helper.cursor.rowcount == 1
+
+    def release_lease(self, name: str, owner: Optional[str] = None):
+        owner = owner or owner_id()
+        db_helper = self._db.get()
+        db_helper.cursor.execute(
+            f"DELETE FROM {self.table} WHERE key = ? AND value = ?", (f"lease:{name}", json.dumps(owner)))
+        db_helper.conn.commit()
+
+    @contextmanager
+    def lease(self, name: str, ttl: float = 60.0):
+        """租约上下文，yield 是否获取成功；未获取成功时不做任何释放"""
+        owner = owner_id()
+        acquired = self.acquire_lease(name, ttl, owner)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release_lease(name, owner)
+
+    def _expires_at(self, ttl: Optional[float]) -> Optional[float]:
+        return self.clock() + ttl if ttl is not None else None
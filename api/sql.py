@@ -1,6 +1,10 @@
 #!/usr/bin/python
 
+import logging
 import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
 
 class SQLiteHelper:
     def __init__(self, db_name):
@@ -14,16 +18,23 @@ class SQLiteHelper:
         self.conn = None
         self.cursor = None
 
-    def connect(self):
+    def connect(self, wal=False, timeout=5.0):
         """
         连接到SQLite数据库。
+
+        Args:
+            wal (bool, optional): 是否启用 WAL 模式，读写可以并发，适合多线程/多进程共享。
+            timeout (float, optional): 等待其他连接释放写锁的秒数。
         """
         try:
-            self.conn = sqlite3.connect(self.db_name)
+            self.conn = sqlite3.connect(self.db_name, timeout=timeout)
             self.cursor = self.conn.cursor()
-            print(f"成功连接到数据库: {self.db_name}")
+            if wal:
+                self.cursor.execute("PRAGMA journal_mode=WAL")
+                self.cursor.execute("PRAGMA synchronous=NORMAL")
+            logger.debug(f"成功连接到数据库: {self.db_name}")
         except sqlite3.Error as e:
-            print(f"连接数据库失败: {e}")
+            logger.error(f"连接数据库失败: {e}")
             self.conn = None
             self.cursor = None
         return self.conn
@@ -35,7 +46,7 @@ class SQLiteHelper:
         if self.conn:
             self.cursor.close()
             self.conn.close()
-            print(f"成功关闭数据库连接: {self.db_name}")
+            logger.debug(f"成功关闭数据库连接: {self.db_name}")
 
     def create_table(self, table_name, columns):
         """
@@ -47,14 +58,14 @@ class SQLiteHelper:
         """
         try:
             if not self.conn:
-                print("请先连接数据库。")
+                logger.warning("请先连接数据库。")
                 return
             sql = f"CREATE TABLE IF NOT EXISTS {table_name} ({columns})"
             self.cursor.execute(sql)
             self.conn.commit()
-            print(f"表 '{table_name}' 创建成功或已存在。")
+            logger.debug(f"表 '{table_name}' 创建成功或已存在。")
         except sqlite3.Error as e:
-            print(f"创建表 '{table_name}' 失败: {e}")
+            logger.error(f"创建表 '{table_name}' 失败: {e}")
 
     def insert_data(self, table_name, data):
         """
@@ -66,7 +77,7 @@ class SQLiteHelper:
         """
         try:
             if not self.conn:
-                print("请先连接数据库。")
+                logger.warning("请先连接数据库。")
                 return
             columns = ', '.join(data.keys())
             placeholders = ', '.join(['?'] * len(data))
@@ -74,11 +85,11 @@ class SQLiteHelper:
             sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
             self.cursor.execute(sql, values)
             self.conn.commit()
-            print("数据插入成功。")
+            logger.debug("数据插入成功。")
         except sqlite3.Error as e:
-            print(f"数据插入失败: {e}")
+            logger.error(f"数据插入失败: {e}")
 
-    def select_data(self, table_name, columns='*', condition=None, order_by=None):
+    def select_data(self, table_name, columns='*', condition=None, order_by=None, params=()):
         """
         查询数据。
 
@@ -87,24 +98,25 @@ class SQLiteHelper:
             columns (str, optional): 要查询的列名，默认为 '*' (所有列)。
             condition (str, optional): 查询条件，例如 "age > 20"。默认为 None (无条件)。
             order_by (str, optional): 排序字段，例如 "timestamp"。默认为 None (不排序)。
+            params (tuple, optional): 条件中 ? 占位符对应的参数。
 
         Returns:
             list: 查询结果，每一行是一个元组。
         """
         try:
             if not self.conn:
-                print("请先连接数据库。")
+                logger.warning("请先连接数据库。")
                 return None
             sql = f"SELECT {columns} FROM {table_name}"
             if condition:
                 sql += f" WHERE {condition}"
             if order_by:
                 sql += f" ORDER BY {order_by}"
-            self.cursor.execute(sql)
+            self.cursor.execute(sql, params)
             results = self.cursor.fetchall()
             return results
         except sqlite3.Error as e:
-            print(f"查询数据失败: {e}")
+            logger.error(f"查询数据失败: {e}")
             return None
     def update_data(self, table_name, data, condition):
         """
@@ -117,35 +129,63 @@ class SQLiteHelper:
         """
         try:
             if not self.conn:
-                print("请先连接数据库。")
+                logger.warning("请先连接数据库。")
                 return
             set_clause = ', '.join([f"{key} = ?" for key in data])
             values = tuple(data.values())
             sql = f"UPDATE {table_name} SET {set_clause} WHERE {condition}"
             self.cursor.execute(sql, values)
             self.conn.commit()
-            print("数据更新成功。")
+            logger.debug("数据更新成功。")
         except sqlite3.Error as e:
-            print(f"数据更新失败: {e}")
+            logger.error(f"数据更新失败: {e}")
 
-    def delete_data(self, table_name, condition):
+    def delete_data(self, table_name, condition, params=()):
         """
         删除数据。
 
         Args:
             table_name (str): 表名。
             condition (str): 删除条件，例如 "id = 1"。
+            params (tuple, optional): 条件中 ? 占位符对应的参数。
         """
         try:
             if not self.conn:
-                print("请先连接数据库。")
+                logger.warning("请先连接数据库。")
                 return
             sql = f"DELETE FROM {table_name} WHERE {condition}"
-            self.cursor.execute(sql)
+            self.cursor.execute(sql, params)
             self.conn.commit()
-            print("数据删除成功。")
+            logger.debug("数据删除成功。")
         except sqlite3.Error as e:
-            print(f"数据删除失败: {e}")
+            logger.error(f"数据删除失败: {e}")
+
+class ThreadLocalSQLiteHelper:
+    """
+    为每个线程各自维护一个 SQLiteHelper 连接，供多线程共享的组件使用。
+    """
+
+    def __init__(self, db_name, wal=True):
+        """
+        Args:
+            db_name (str): 数据库文件名。
+            wal (bool, optional): 是否启用 WAL 模式。
+        """
+        self.db_name = db_name
+        self.wal = wal
+        self._local = threading.local()
+
+    def get(self):
+        """
+        获取当前线程的 SQLiteHelper，首次调用时建立连接。
+        """
+        db_helper = getattr(self._local, 'db_helper', None)
+        if db_helper is None:
+            db_helper = SQLiteHelper(self.db_name)
+            if not db_helper.connect(wal=self.wal):
+                raise sqlite3.Error(f"无法连接数据库: {self.db_name}")
+            self._local.db_helper = db_helper
+        return db_helper
 
 # 示例用法
 # if __name__ == "__main__":
@@ -0,0 +1,161 @@
+import time
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+from WXBizMsgCrypt3 import WXBizMsgCrypt
+from .config import DB_NAME, CORPID
+from .dispatcher import run_blocking
+from .sql import SQLiteHelper
+
+logger = logging.getLogger(__name__)
+
+TENANT_TABLE = 'tenants'
+TENANT_COLUMNS = ('name TEXT PRIMARY KEY, corpid TEXT NOT NULL, token TEXT NOT NULL, aeskey TEXT NOT NULL, '
+                  'timestamp DATETIME DEFAULT CURRENT_TIMESTAMP')
+
+
+class Tenant:
+    """
+    单个租户(企业/应用)的回调处理状态，密钥相关对象在构造时一次性准备好
+
+    租户只有回调的 token/aeskey；调用上游接口使用的 secret 只有 config 中的一套，
+    企业ID与 config.CORPID 不同的租户只处理回调，不调用上游接口
+    """
+
+    __slots__ = ('name', 'corpid', 'token', 'aeskey', 'wxcpt', 'handler')
+
+    def __init__(self, name: str, corpid: str, token: str, aeskey: str, handler_factory: Callable):
+        self.name = name
+        self.corpid = corpid
+        self.token = token
+        self.aeskey = aeskey
+        self.wxcpt = WXBizMsgCrypt(token, aeskey, corpid)
+        self.handler = handler_factory(self.wxcpt, name)
+
+
+class TenantRegistry:
+    """
+    多租户注册表
+
+    功能：
+    - 按名称(URL路径)或企业ID查找租户
+    - 租户配置保存在 wechat.db 的 tenants 表中，新增租户无需重启：
+      查找不到时会重新加载数据库(最多每 reload_interval 秒一次)，事件循环中使用 aget/aget_by_corpid，
+      重新加载在线程池中进行
+    - 每个租户只构建一次 WXBizMsgCrypt 和 WeChatMsgHandler
+
+    示例：
+    >>> registry = TenantRegistry(lambda wxcpt, name: WeChatMsgHandler(wxcpt, name=name))
+    >>> registry.add('default', corpid, token, aeskey, persist=False)
+    >>> tenant = registry.get('default')
+    """
+
+    def __init__(self, handler_factory: Callable, db_name: str = DB_NAME, reload_interval: float = 5.0):
+        """
+        :param handler_factory: 接收 (WXBizMsgCrypt 实例, 租户名)、返回消息处理器的函数
+        :param db_name: 保存租户配置的数据库
+        :param reload_interval: 查找不到租户时重新加载数据库的最小间隔(秒)
+        """
+        self.handler_factory = handler_factory
+        self.db_name = db_name
+        self.reload_interval = reload_interval
+        self._by_name: Dict[str, Tenant] = {}
+        self._by_corpid: Dict[str, Tenant] = {}
+        self._lock = threading.Lock()
+        self._loaded_at = float('-inf')
+
+    def add(self, name: str, corpid: str, token: str, aeskey: str, persist: bool = True) -> Tenant:
+        """
+        新增或替换租户
+
+        :param persist: 为 True 时写入数据库，其他进程在下次加载时也能看到
+        """
+        tenant = Tenant(name, corpid, token, aeskey, self.handler_factory)
+        if persist:
+            db_helper = SQLiteHelper(self.db_name)
+            if db_helper.connect():
+                db_helper.create_table(TENANT_TABLE, TENANT_COLUMNS)
+                db_helper.delete_data(TENANT_TABLE, 'name = ?', params=(name,))
+                db_helper.insert_data(TENANT_TABLE, {'name': name, 'corpid': corpid, 'token': token, 'aeskey': aeskey})
+                db_helper.close()
+        self._register(tenant)
+        return tenant
+
+    def get(self, name: str) -> Optional[Tenant]:
+        """按名称查找租户"""
+        tenant = self._by_name.get(name)
+        if tenant is None and self._maybe_reload():
+            tenant = self._by_name.get(name)
+        return tenant
+
+    def get_by_corpid(self, corpid: str) -> Optional[Tenant]:
+        """按企业ID查找租户"""
+        tenant = self._by_corpid.get(corpid)
+        if tenant is None and self._maybe_reload():
+            tenant = self._by_corpid.get(corpid)
+        return tenant
+
+    async def aget(self, name: str) -> Optional[Tenant]:
+        """get 的异步版本，查找不到时在线程池中重新加载数据库，不阻塞事件循环"""
+        tenant = self._by_name.get(name)
+        if tenant is None:
+            tenant = await run_blocking(self.get, name)
+        return tenant
+
+    async def aget_by_corpid(self, corpid: str) -> Optional[Tenant]:
+        """get_by_corpid 的异步版本"""
+        tenant = self._by_corpid.get(corpid)
+        if tenant is None:
+            tenant = await run_blocking(self.get_by_corpid, corpid)
+        return tenant
+
+    def names(self):
+        return list(self._by_name)
+
+    def reload(self):
+        """从数据库加载租户配置，配置未变化的租户沿用已有对象"""
+        db_helper = SQLiteHelper(self.db_name)
+        if not db_helper.connect():
+            return
+        db_helper.create_table(TENANT_TABLE, TENANT_COLUMNS)
+        rows = db_helper.select_data(TENANT_TABLE, columns='name, corpid, token, aeskey') or []
+        db_helper.close()
+        for name, corpid, token, aeskey in rows:
+            current = self._by_name.get(name)
+            if current and (current.corpid, current.token, current.aeskey) == (corpid, token, aeskey):
+                continue
+            try:
+                self._register(Tenant(name, corpid, token, aeskey, self.handler_factory))
+            except Exception as e:
+                logger.error(f"加载租户 {name} 失败: {e}", exc_info=True)
+
+    def _maybe_reload(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._loaded_at < self.reload_interval:
+                return False
+            self._loaded_at = now
+        self.reload()
+        return True
+
+    def _register(self, tenant: Tenant):
+        # 复制后整体替换，读取方无需加锁；同一企业ID下先注册的租户优先
+        with self._lock:
+            by_name = dict(self._by_name)
+            by_name[tenant.name] = tenant
+            by_corpid = {}
+            for item in by_name.values():
+                by_corpid.setdefault(item.corpid, item)
+            self._by_name, self._by_corpid = by_name, by_corpid
+
+
+# 新增租户：python -m api.tenant <name> <corpid> <token> <aeskey>
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 5:
+        print("使用方法: python -m api.tenant <name> <corpid> <token> <aeskey>")
+        sys.exit(1)
+    if sys.argv[2] != CORPID:
+        print(f"注意: 企业ID不是 {CORPID}，该租户只处理回调，客服消息同步和回复等上游调用会被跳过")
+    TenantRegistry(lambda wxcpt, name: None).add(*sys.argv[1:5])
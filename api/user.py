@@ -1,36 +1,93 @@
-from .api import RequestClient
+from .api import RequestClient, AsyncRequestClient
 from .api import RequestException
-from .auth import _get_contact_access_token,_get_access_token,_get_wechat_access_token
-from .config import AGENT_ID,ACCOUNT_ID
+from .auth import _call_with_access_token,_call_with_contact_token,_call_with_wechat_token
+from .auth import _acall_with_access_token,_acall_with_wechat_token
+from .ratelimit import rate_limiter
+from .config import AGENT_ID,ACCOUNT_ID,CORPID
+from . import config
+from .log import log_payload
+from .metrics import time_upstream
+import logging
+
+logger = logging.getLogger(__name__)
 # 创建客户端实例
-client = RequestClient(max_retries=3, timeout=15)
+client = RequestClient(max_retries=3, timeout=15, limiter=rate_limiter)
+async_client = AsyncRequestClient(max_retries=3, timeout=15, limiter=rate_limiter)
+
+
+def _post(api, url, data, **rate_keys):
+    '''
+    生成 request(access_token) 函数，供 token 失效时刷新重试
+    @param api 指标中的接口名
+    @param url 以 access_token= 结尾的接口地址
+    @param data JSON数据
+    @param rate_keys 限流维度(open_kfid, external_userid)，默认按企业限流
+    '''
+    rate_keys = {'corp': CORPID, **rate_keys}
+    def request(token):
+        with time_upstream(api):
+            response = client.post(url + token, json_data=data, rate_keys=rate_keys)
+        logger.debug("%s result: %s", api, response.text)
+        if response.status_code == 200:
+            return response.json()
+    return request
+
+
+def _apost(api, url, data, **rate_keys):
+    '''_post 的异步版本，使用共享连接池的异步客户端'''
+    rate_keys = {'corp': CORPID, **rate_keys}
+    async def request(token):
+        with time_upstream(api):
+            response = await async_client.post(url + token, json_data=data, rate_keys=rate_keys)
+        logger.debug("%s result: %s", api, response.text)
+        if response.status_code == 200:
+            return response.json()
+    return request
+
+
+def _text_message(content, touser='', toparty='', totag='', duplicate_check=False, duplicate_check_interval=1800):
+    '''
+    message/send 的文本消息
+    @param touser 成员ID，多个用 | 分隔，最多 1000 个
+    @param toparty 部门ID，多个用 | 分隔，最多 100 个
+    @param totag 标签ID，多个用 | 分隔，最多 100 个
+    @param duplicate_check 是否开启重复消息检查，duplicate_check_interval 秒内相同内容不会重复发给同一成员
+    '''
+    return {
+        "touser" : touser,
+        "toparty" : toparty,
+        "totag" : totag,
+        "msgtype" : "text",
+        "agentid" : AGENT_ID,
+        "text" : {
+            "content" : content
+        },
+        "safe":0,
+        "enable_id_trans": 0,
+        "enable_duplicate_check": 1 if duplicate_check else 0,
+        "duplicate_check_interval": duplicate_check_interval
+        }
 
 
 # 企业微信机器人给指定用户发送消息
 async def _send_msg(username,content):
     try:
-        response = _get_access_token()
-        token = response.get('access_token')
-        json_data = {
-            "touser" : username,
-            "toparty" : "",
-            "totag" : "",
-            "msgtype" : "text",
-            "agentid" : AGENT_ID,
-            "text" : {
-                "content" : content
-            },
-            "safe":0,
-            "enable_id_trans": 0,
-            "enable_duplicate_check": 0,
-            "duplicate_check_interval": 1800
-            }
-        response = client.post('https://qyapi.weixin.qq.com/cgi-bin/message/send?access_token='+token, json_data=json_data)
-        code = response.status_code
-        if code == 200:
-            return response.json()
+        return await _acall_with_access_token(
+            _apost('message/send', config.QYAPI_BASE_URL + '/cgi-bin/message/send?access_token=',
+                   _text_message(content, touser=username)))
     except RequestException as e:
-        print(f"请求失败: {e}")
+        logger.warning(f"message/send 请求失败: {e}")
+
+
+# 群发的一个分片，失败时抛出 RequestException
+'''
+@param touser/toparty/totag 以 | 分隔的接收者，数量不超过接口限制
+'''
+async def _send_msg_chunk(content, touser='', toparty='', totag=''):
+    # 中断后恢复时可能重发已经成功的分片，由企业微信的重复消息检查去重(最长 4 小时)
+    return await _acall_with_access_token(
+        _apost('message/send', config.QYAPI_BASE_URL + '/cgi-bin/message/send?access_token=',
+               _text_message(content, touser, toparty, totag, duplicate_check=True, duplicate_check_interval=14400)))
 
 # 获取本企业
 '''
@@ -38,19 +95,34 @@ async def _send_msg(username,content):
 '''
 def _get_users(limit:int)->str:
     try:
-        contact_response = _get_contact_access_token()
-        contact_token = contact_response.get('access_token')
-        print()
-        response = client.post('https://qyapi.weixin.qq.com/cgi-bin/user/list_id?access_token='+contact_token, 
-                            json_data={
-                                "cursor" : "",
-                                "limit" : limit
-                            })
-        code = response.status_code
-        if code == 200:
-            return response.json()
+        return _call_with_contact_token(_post('user/list_id', config.QYAPI_BASE_URL + '/cgi-bin/user/list_id?access_token=',
+                                              {
+                                                  "cursor" : "",
+                                                  "limit" : limit
+                                              }))
     except RequestException as e:
-        print(f"请求失败: {e}")
+        logger.warning(f"user/list_id 请求失败: {e}")
+
+# 按 next_cursor 逐页获取成员ID及所在部门，迭代到下一页时才发起请求
+'''
+for page in _iter_user_pages():
+    for item in page:  # {'userid': 'zhangsan', 'department': 1}
+        ...
+'''
+def _iter_user_pages(limit:int=10000):
+    cursor = ""
+    while True:
+        result = _call_with_contact_token(_post('user/list_id', config.QYAPI_BASE_URL + '/cgi-bin/user/list_id?access_token=',
+                                                {
+                                                    "cursor" : cursor,
+                                                    "limit" : limit
+                                                }))
+        if not result or result.get('errcode') != 0:
+            raise RequestException(f"user/list_id failed: {result}")
+        yield result.get('dept_user', [])
+        cursor = result.get('next_cursor')
+        if not cursor:
+            return
 
 # 获取客户主动发给微信客服的消息
 '''
@@ -59,7 +131,6 @@ print("获取到用户列表", users)
 '''
 def _wechat_get_msg(cursor, open_kfid, token, limit:int)->str:
     try:
-        response = _get_wechat_access_token()
         data = {
             "cursor": cursor,
             "token": token,
@@ -67,26 +138,43 @@ def _wechat_get_msg(cursor, open_kfid, token, limit:int)->str:
             "voice_format": 0,
             "open_kfid": open_kfid
         }
-        token = response.get('access_token')
-        response = client.post(' https://qyapi.weixin.qq.com/cgi-bin/kf/sync_msg?access_token='+token, json_data=data)
-        code = response.status_code
-        if code == 200:
-            return response.json()
+        return _call_with_wechat_token(_post('kf/sync_msg', config.QYAPI_BASE_URL + '/cgi-bin/kf/sync_msg?access_token=', data,
+                                             open_kfid=open_kfid))
     except RequestException as e:
-        print(f"请求失败: {e}")   
+        logger.warning(f"kf/sync_msg 请求失败: {e}")
 
 # 获取最近 48 小时内有触发用户进入会话事件或向该客服账号发过消息的客户，否则在 invalid_external_userid 返回
 def _wechat_get_users(limit:int)->str:
     try:
-        response = _get_wechat_access_token()
         data = {}
-        token = response.get('access_token')
-        response = client.post('https://qyapi.weixin.qq.com/cgi-bin/kf/customer/batchget?access_token='+token, json_data=data)
-        code = response.status_code
-        if code == 200:
-            return response.json()
+        return _call_with_wechat_token(_post('kf/customer/batchget', config.QYAPI_BASE_URL + '/cgi-bin/kf/customer/batchget?access_token=', data))
     except RequestException as e:
-        print(f"请求失败: {e}")        
+        logger.warning(f"kf/customer/batchget 请求失败: {e}")
+
+# 批量获取客户基础信息，一次最多 100 个，失败时抛出 RequestException
+'''
+@param external_userids 客户的EXTERNAL_USERID列表
+'''
+def _wechat_batchget_customers(external_userids):
+    result = _call_with_wechat_token(_post('kf/customer/batchget', config.QYAPI_BASE_URL + '/cgi-bin/kf/customer/batchget?access_token=',
+                                           _batchget_body(external_userids)))
+    return _check_batchget(result)
+
+async def _wechat_batchget_customers_async(external_userids):
+    result = await _acall_with_wechat_token(_apost('kf/customer/batchget', config.QYAPI_BASE_URL + '/cgi-bin/kf/customer/batchget?access_token=',
+                                                   _batchget_body(external_userids)))
+    return _check_batchget(result)
+
+def _batchget_body(external_userids):
+    return {
+        "external_userid_list": list(external_userids),
+        "need_enter_session_context": 0
+    }
+
+def _check_batchget(result):
+    if not result or result.get('errcode') != 0:
+        raise RequestException(f"kf/customer/batchget failed: {result}")
+    return result
 
 # 微信客服给客户发送消息
 '''
@@ -94,10 +182,8 @@ def _wechat_get_users(limit:int)->str:
 @param text 文本对象
 '''
 def _wechat_send_msg(touser,msg_id,open_kfid,text):
-    print("发送消息的客户信息:",touser,text,'\n')
+    log_payload(logger, "Send kf message", touser=touser, text=text)
     try:
-        response = _get_wechat_access_token()
-        token = response.get('access_token')
         data = {
             "touser": touser,
             "open_kfid": open_kfid,
@@ -110,10 +196,49 @@ def _wechat_send_msg(touser,msg_id,open_kfid,text):
         if msg_id is not None:
             data["msgid"] = msg_id
         
-        response = client.post('https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token='+token,json_data = data)
-        print("消息发送结果:", response.json())
-        code = response.status_code
-        if code == 200:
-            return response.json()
+        return _call_with_wechat_token(_post('kf/send_msg', config.QYAPI_BASE_URL + '/cgi-bin/kf/send_msg?access_token=', data,
+                                             open_kfid=open_kfid, external_userid=touser))
+    except RequestException as e:
+        logger.warning(f"kf/send_msg 请求失败: {e}")
+
+
+# 微信客服给客户发送文本消息，返回接口结果，请求失败时抛出 RequestException(供发件箱判断是否重试)
+'''
+@param msgid 指定的消息ID，重试时使用相同的ID
+'''
+def _wechat_send_text(touser, open_kfid, content, msgid):
+    log_payload(logger, "Send kf message", touser=touser, text=content)
+    result = _call_with_wechat_token(_post('kf/send_msg', config.QYAPI_BASE_URL + '/cgi-bin/kf/send_msg?access_token=',
+                                           {
+                                               "touser": touser,
+                                               "open_kfid": open_kfid,
+                                               "msgid": msgid,
+                                               "msgtype": "text",
+                                               "text": {
+                                                   "content": content
+                                               }
+                                           },
+                                           open_kfid=open_kfid, external_userid=touser))
+    if result is None:
+        raise RequestException("kf/send_msg returned no result")
+    return result
+
+
+# 微信客服给客户发送消息(异步版本，不占用线程池)
+async def _wechat_send_msg_async(touser,msg_id,open_kfid,text):
+    log_payload(logger, "Send kf message", touser=touser, text=text)
+    try:
+        data = {
+            "touser": touser,
+            "open_kfid": open_kfid,
+            "msgtype": "text",
+            "text": {
+                "content": text['content']
+            }
+        }
+        if msg_id is not None:
+            data["msgid"] = msg_id
+        return await _acall_with_wechat_token(_apost('kf/send_msg', config.QYAPI_BASE_URL + '/cgi-bin/kf/send_msg?access_token=', data,
+                                                      open_kfid=open_kfid, external_userid=touser))
     except RequestException as e:
-        print(f"请求失败: {e}")
+        logger.warning(f"kf/send_msg 请求失败: {e}")
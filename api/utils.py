@@ -1,13 +1,30 @@
 import time
 import logging
-from typing import Dict, Tuple, Union
-import xml.etree.ElementTree as ET
-from .demo import _test_make
-from .config import DB_NAME
-from .sql import SQLiteHelper
+from typing import Dict, List, Tuple, Union
 import asyncio
-from .user import _wechat_send_msg, _wechat_get_msg
+import weakref
+import threading
+from contextlib import contextmanager
+import xml.etree.ElementTree as ET
+from .demo import _test_make, make_bulkhead
+from .log import log_payload
+from .metrics import CALLBACK_STAGE_SECONDS, MESSAGES_TOTAL, observe_stage, count_error
+from .api import connection_manager
+from .dispatcher import DispatcherBusy
+from .dispatcher import dispatcher as default_dispatcher
+from .outbox import send_kf_texts, asend_kf_text, outbox_enabled
+from .kfsync import KfSyncEngine
 from .enum import MessageType, EventType
+from . import config
+
+# 没有发件箱时同时发送的"处理中..."数
+KF_ACK_CONCURRENCY = 20
+# 同步请求的有效期，与回调中 Token 的有效期(10分钟)一致
+KF_RESYNC_TTL = 600
+# 会调用上游接口(make.com、message/send、kf/sync_msg、kf/send_msg)的消息类型
+UPSTREAM_MSG_TYPES = ('text', 'event')
+
+
 class WeChatMsgHandler:
     """
     企业微信消息统一处理器
@@ -17,13 +34,39 @@ class WeChatMsgHandler:
     3. 自动生成符合规范的回复
     """
     
-    def __init__(self, wxcpt, logger=None):
+    def __init__(self, wxcpt, logger=None, replay_cache=None, dispatcher=None, job_queue=None, name='default',
+                 shared_store=None, reply_queue=None):
         """
         :param wxcpt: WXBizMsgCrypt实例
         :param logger: 日志记录器
+        :param replay_cache: ReplayCache实例，用于拦截企业微信的重试回调，为None时不去重
+        :param dispatcher: Dispatcher实例，异步模式下执行路由处理，默认使用进程内共享的调度器
+        :param job_queue: JobQueue实例，异步模式下消息和AI回复任务落盘后由工作线程处理，为None时直接交给调度器
+        :param name: 租户名，写入任务数据以便工作线程找到对应的处理器
+        :param shared_store: SharedStore实例，多进程部署时用于客服消息同步的跨进程互斥
+        :param reply_queue: JobQueue实例，客服消息的 AI 回复任务落盘后才保存 cursor，默认与 job_queue 相同；
+                            都为None时由事件循环回复，交接不落盘
         """
         self.wxcpt = wxcpt
         self.logger = logger or logging.getLogger(__name__)
+        self.replay_cache = replay_cache
+        self.dispatcher = dispatcher or default_dispatcher
+        self.job_queue = job_queue
+        self.reply_queue = reply_queue or job_queue
+        self.name = name
+        self.shared_store = shared_store
+        # 上游接口只使用 config 中企业的 secret 获取 access_token，其他企业的租户只做验签、解密和被动回复
+        self.upstream = getattr(wxcpt, 'm_sReceiveId', config.CORPID) == config.CORPID
+        if not self.upstream:
+            self.logger.warning("Tenant %s is not corp %s, messages that need upstream calls are skipped",
+                                name, config.CORPID)
+        # 租约超时需覆盖拉取并交接一页消息的时间，每页续期一次
+        self.kf_sync_lease_ttl = 60
+        # 客服消息同步：处理每一页的全部消息，交接当前页时预取下一页
+        self.kf_sync = KfSyncEngine(handoff=self._handoff_kf_page)
+        # 验签、解密各阶段耗时计入 /metrics
+        if hasattr(wxcpt, 'stage_observer'):
+            wxcpt.stage_observer = observe_stage
         self._init_msg_handlers()
 
     def _init_msg_handlers(self):
@@ -41,31 +84,70 @@ class WeChatMsgHandler:
         :param request_data: 包含 msg_signature, timestamp, nonce, request_body
         :return: (ret_code, response_data)
         """
-        try:
-            # 1. 解密消息
-            ret, decrypted_msg = self._decrypt_msg(
-                request_data['request_body'],
-                request_data['msg_signature'],
-                request_data['timestamp'],
-                request_data['nonce']
-            )
-            if ret != 0:
-                return ret, "Decrypt failed"
+        if self.replay_cache is None:
+            return self._process_request(request_data)
 
-            # 2. 解析XML
-            ret, parsed_msg = self._parse_wechat_msg(decrypted_msg)
-            if ret != 0:
-                return ret, "Parse XML failed"
+        # 重复回调在解密之前直接返回第一次的结果，首次仍在处理中时返回空
+        key = self.replay_cache.make_key(request_data)
+        hit, cached = self.replay_cache.check(key)
+        if hit:
+            return cached if cached is not None else (0, "")
+        result = self._process_request(request_data)
+        if result[0] == 0:
+            self.replay_cache.put(key, result)
+        else:
+            self.replay_cache.discard(key)
+        return result
 
-            # 3. 路由处理
-            handler = self.msg_handlers.get(parsed_msg.get('MsgType'), self._handle_unknown_msg)
-            print("处理器handler:",handler,'\n')
-            
-            # 使用对应的路由进行处理 如果是消息-> _handle_text_msg 
-            reply_content = handler(parsed_msg)
+    async def process_request_async(self, request_data: Dict) -> Tuple[int, str]:
+        """
+        异步模式入口：在事件循环中完成验签、解密和解析后立即返回，
+        路由处理中的上游请求和数据库操作交给有界线程池执行
+        :param request_data: 包含 msg_signature, timestamp, nonce, request_body
+        :return: (ret_code, response_data)，成功时 response_data 为空
+        """
+        key = None
+        if self.replay_cache is not None:
+            key = self.replay_cache.make_key(request_data)
+            hit, cached = self.replay_cache.check(key)
+            if hit:
+                return cached if cached is not None else (0, "")
+
+        ret, result = self._decode_request(request_data)
+        if ret == 0 and self.job_queue is not None:
+            # 落盘后再应答，重启也不会丢失
+            try:
+                await self.dispatcher.run_blocking(
+                    self.job_queue.enqueue, 'wechat_msg', {'tenant': self.name, 'msg': result},
+                    dedup_key=f"{self.name}:{request_data['msg_signature']}")
+                result = ""
+            except Exception as e:
+                self.logger.error(f"Enqueue failed: {str(e)}", exc_info=True)
+                count_error(-1)
+                ret, result = -1, "Server busy"
+        elif ret == 0:
+            try:
+                self.dispatcher.submit(self._route, result)
+                result = ""
+            except DispatcherBusy as e:
+                self.logger.warning(f"Dispatcher busy: {str(e)}")
+                count_error(-1)
+                ret, result = -1, "Server busy"
 
-            print("微信客服回复的信息:",reply_content)
+        if key is not None:
+            if ret == 0:
+                self.replay_cache.put(key, (ret, result))
+            else:
+                self.replay_cache.discard(key)
+        return ret, result
 
+    def _process_request(self, request_data: Dict) -> Tuple[int, Union[str, Dict]]:
+        """解密、解析并路由一次回调"""
+        ret, parsed_msg = self._decode_request(request_data)
+        if ret != 0:
+            return ret, parsed_msg
+        try:
+            reply_content = self._route(parsed_msg)
             if reply_content:
                 return ret,reply_content
             
@@ -84,8 +166,53 @@ class WeChatMsgHandler:
 
         except Exception as e:
             self.logger.error(f"Process error: {str(e)}", exc_info=True)
+            count_error(-1)
+            return -1, f"Server error: {str(e)}"
+
+    def _decode_request(self, request_data: Dict) -> Tuple[int, Union[str, Dict]]:
+        """验签、解密并解析回调，成功时返回消息字典，失败时返回错误描述"""
+        try:
+            # 1. 解密消息
+            ret, decrypted_msg = self._decrypt_msg(
+                request_data['request_body'],
+                request_data['msg_signature'],
+                request_data['timestamp'],
+                request_data['nonce']
+            )
+            if ret != 0:
+                count_error(ret)
+                return ret, "Decrypt failed"
+
+            # 2. 解析XML
+            ret, parsed_msg = self._parse_wechat_msg(decrypted_msg)
+            if ret != 0:
+                count_error(ret)
+                return ret, "Parse XML failed"
+            return 0, parsed_msg
+
+        except Exception as e:
+            self.logger.error(f"Process error: {str(e)}", exc_info=True)
+            count_error(-1)
             return -1, f"Server error: {str(e)}"
 
+    def _route(self, parsed_msg: Dict) -> str:
+        """3. 按消息类型路由处理"""
+        msg_type = parsed_msg.get('MsgType')
+        MESSAGES_TOTAL.inc(msg_type or '', parsed_msg.get('Event', ''))
+        handler = self.msg_handlers.get(msg_type, self._handle_unknown_msg)
+        if not self.upstream and msg_type in UPSTREAM_MSG_TYPES:
+            # 用本企业的 access_token 调用其他企业的接口只会失败，直接跳过
+            self.logger.warning("Skip %s message for tenant %s without upstream credentials", msg_type, self.name)
+            return ''
+        self.logger.debug("Route %s to %s", parsed_msg.get('MsgType'), handler.__name__)
+        
+        # 使用对应的路由进行处理 如果是消息-> _handle_text_msg 
+        with CALLBACK_STAGE_SECONDS.time('route'):
+            reply_content = handler(parsed_msg)
+
+        log_payload(self.logger, "Reply content", tenant=self.name, reply=reply_content)
+        return reply_content
+
     def _decrypt_msg(self, encrypted_msg: str, msg_signature: str, timestamp: str, nonce: str) -> Tuple[int, str]:
         """统一解密消息"""
         ret, sMsg = self.wxcpt.DecryptMsg(
@@ -101,12 +228,14 @@ class WeChatMsgHandler:
     def _parse_wechat_msg(self, xml_msg: str) -> Tuple[int, Dict]:
         """解析微信XML消息"""
         try:
+            start = time.perf_counter()
             xml_tree = ET.fromstring(xml_msg)
             msg_dict = {
                 elem.tag: elem.text if elem.text else ''
                 for elem in xml_tree
                 if elem.tag not in ['Encrypt']  # 过滤加密字段
             }
+            CALLBACK_STAGE_SECONDS.observe(time.perf_counter() - start, 'xml_parse')
             return 0, msg_dict
         except ET.ParseError as e:
             self.logger.error(f"XML parse error: {str(e)}")
@@ -133,79 +262,102 @@ class WeChatMsgHandler:
     def _handle_text_msg(self, msg: Dict) -> str:
         content = msg.get('Content', '').strip()
         name = msg.get('FromUserName','').strip()
-        print("name:",name,'\n')
-        asyncio.ensure_future(_test_make(name, content))
+        self.logger.debug("Text message from %s", name)
+        # 应用消息没有客服账号，回答通过 message/send 发给成员
+        self.dispatcher.spawn(_test_make(name, msg.get('MsgId'), None, content))
         return '正在响应中,请耐心等待...'
 
     # 当客户给微信客服发送消息
     def _handle_event_msg(self, msg: Dict) -> str:
-        db_helper = SQLiteHelper(DB_NAME)
-        conn = db_helper.connect()
-        if conn:
-            db_helper.create_table('cursors', 'id INTEGER PRIMARY KEY AUTOINCREMENT , value TEXT NOT NULL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP')
-            event = msg.get('Event', '')
-            token = msg.get('Token','').strip()
-            open_kfid = msg.get('OpenKfId','').strip()
-            # TODO 如果是客户发送消息给客服
-            if event == 'kf_msg_or_event':
-                used_cursor = ""
-                has_more = 1
-                # 获取某一个微信客服的消息
-                while has_more != 0:
-                    # 查询已经存在的cursor
-                    exit_cursors = db_helper.select_data('cursors',order_by='timestamp')
-                    # 如果查到的长度不为0
-                    if len(exit_cursors) != 0:
-                        used_cursor = exit_cursors[0][1]
-                        print("使用的cursor:", used_cursor)
-                        db_helper.delete_data('cursors', f"value = '{used_cursor}'")
-                        
-                    result = _wechat_get_msg(used_cursor, open_kfid, token, 1000)
-                    if result['errcode'] == 0 and result['errmsg'] == 'ok':
-                        msg_list = result['msg_list']
-                        cursor = result['next_cursor']
-                        has_more = result['has_more']
-                        print("即将插入的cursor为:",cursor,'\n')
-                        # 将 cursor 存入数据库
-                        if cursor:
-                            db_helper.insert_data('cursors', {'value': cursor})
-                   
-                        print("抓取结果", msg_list,'\n')
-                        # 对结果进行处理
-                        msg_item = msg_list[0]
-                        
-                        # 需要根据不同的消息类型 做出不同的响应
-                        # msg_type = msg_item['msg_type']
-                        
-                        # 如果是文本类型
-                        
-                        
-                        external_userid = msg_item['external_userid']
-                        msg_id = msg_item['msgid']
-                        custom_open_kfid = msg_item['open_kfid']
-                        option = msg_item['text']['content']
-                        text = {
-                            'content':'处理中...'
-                        }
-                        # 给该用户发送消息，目前msg_list只抓取到了一条数据
-                        _wechat_send_msg(touser=external_userid,
-                                         msg_id=msg_id,
-                                         open_kfid=custom_open_kfid,
-                                         text=text)
-                        # 异步给用户发送AI回答
-                        asyncio.ensure_future(
-                            _test_make(touser=external_userid,
-                                        msg_id=msg_id,
-                                        open_kfid=custom_open_kfid,
-                                        option=option
-                                    )
-                        )
+        event = msg.get('Event', '')
+        token = msg.get('Token','').strip()
+        open_kfid = msg.get('OpenKfId','').strip()
+        # 客户发送消息给客服
+        if event == 'kf_msg_or_event':
+            # 先登记同步请求：正在同步的线程/进程可能已经拉完最后一页，释放租约后会看到请求并再同步一轮
+            self._request_kf_resync(open_kfid, token)
+            while True:
+                # 同一个客服账号同时只允许一个线程/进程拉取消息，避免多个 worker 使用同一个 cursor
+                with self._kf_sync_lease(open_kfid) as acquired:
+                    if not acquired:
+                        self.logger.info("Kf sync for %s is running in another worker, resync requested", open_kfid)
                         return 'success'
-            return ''
+                    # 清除请求后再拉取，此前到达的消息都在本轮中
+                    token = self._take_kf_resync(open_kfid) or token
+                    # 按 next_cursor 拉取全部新消息，每一页交接完成后保存 cursor
+                    self.kf_sync.sync(open_kfid, token, renew=self._kf_sync_renewer(open_kfid))
+                if not self._kf_resync_requested(open_kfid):
+                    return 'success'
+        return ''
+
+    def _handoff_kf_page(self, open_kfid: str, msg_list: List[Dict]):
+        """
+        交接 kf/sync_msg 一页中的客户文本消息：先发送(或入队)"处理中..."，再把 AI 回复任务写入任务队列
+        AI 回复任务在一个事务中落盘后才返回，之后才保存该页的 cursor
+        """
+        log_payload(self.logger, "Fetched kf messages", open_kfid=open_kfid, msg_list=msg_list)
+        items = []
+        for msg_item in msg_list:
+            # 只回复客户(origin=3)发来的文本消息，系统事件和接待人员消息跳过
+            if msg_item.get('origin') != 3 or msg_item.get('msgtype') != 'text':
+                self.logger.debug("Skip kf message %s (origin %s, msgtype %s)", msg_item.get('msgid'),
+                                  msg_item.get('origin'), msg_item.get('msgtype'))
+                continue
+            items.append({'touser': msg_item['external_userid'],
+                          'msg_id': msg_item['msgid'],
+                          'open_kfid': msg_item['open_kfid'],
+                          'option': msg_item['text']['content']})
+        if not items:
+            return
+        if self.reply_queue is None:
+            # 没有任务队列：由事件循环确认并回复，进程退出时已保存 cursor 的消息可能得不到回复
+            self.dispatcher.spawn(_reply_page(items))
+            return
+        if outbox_enabled():
+            # 确认消息在 AI 回复任务之前写入发件箱(单独的事务)，按客户顺序先于 AI 回复发出
+            send_kf_texts([(item['touser'], item['open_kfid'], '处理中...', f"ack:{item['msg_id']}")
+                           for item in items])
         else:
-            print("数据库链接错误")
-            return ''
-       
+            # 没有发件箱时由事件循环并发发送确认消息，不阻塞同步，也不等待 AI 回复的工作线程
+            self.dispatcher.spawn(_send_acks(items))
+        self.reply_queue.enqueue_many('ai_reply', [(item, f"ai_reply:{item['msg_id']}") for item in items])
+
+    def _kf_sync_renewer(self, open_kfid: str):
+        """多进程时每拉取一页续期一次租约，续期失败说明租约已过期并被其他进程取得"""
+        if self.shared_store is None:
+            return None
+        name = f"kf_sync:{open_kfid}"
+        return lambda: self.shared_store.acquire_lease(name, ttl=self.kf_sync_lease_ttl)
+
+    def _request_kf_resync(self, open_kfid: str, token: str):
+        """登记客服账号的同步请求，值为最新回调中的 Token(拉取消息时使用)"""
+        if self.shared_store is not None:
+            self.shared_store.set(f"kf_resync:{open_kfid}", token, ttl=KF_RESYNC_TTL)
+        else:
+            with _local_leases_lock:
+                _kf_resync_tokens[open_kfid] = token
+
+    def _take_kf_resync(self, open_kfid: str) -> str:
+        """取出并清除同步请求，返回其中的 Token，没有请求时返回空字符串"""
+        if self.shared_store is not None:
+            token = self.shared_store.get(f"kf_resync:{open_kfid}")
+            if token is not None:
+                self.shared_store.delete(f"kf_resync:{open_kfid}")
+            return token or ''
+        with _local_leases_lock:
+            return _kf_resync_tokens.pop(open_kfid, '')
+
+    def _kf_resync_requested(self, open_kfid: str) -> bool:
+        if self.shared_store is not None:
+            return self.shared_store.get(f"kf_resync:{open_kfid}") is not None
+        return open_kfid in _kf_resync_tokens
+
+    def _kf_sync_lease(self, open_kfid: str):
+        """客服账号消息同步的互斥租约，有共享存储时跨进程生效，否则仅在本进程内生效"""
+        name = f"kf_sync:{open_kfid}"
+        if self.shared_store is not None:
+            return self.shared_store.lease(name, ttl=self.kf_sync_lease_ttl)
+        return _local_lease(name)
 
     # 当用户给机器人发送图片
     def _handle_event_img(self,msg:Dict) -> str:
@@ -217,4 +369,89 @@ class WeChatMsgHandler:
     def _handle_unknown_msg(self, msg: Dict) -> str:
         """处理未知类型消息"""
         self.logger.warning(f"Unhandled message type: {msg.get('MsgType')}")
-        return ''
\ No newline at end of file
+        return ''
+
+
+async def _send_acks(items: List[Dict]):
+    """并发发送一页消息的"处理中..."，同时进行的请求数有上限，积压的消息不会一次占满连接池"""
+    limit = _loop_semaphore(_kf_ack_limits, KF_ACK_CONCURRENCY)
+
+    async def ack(item):
+        async with limit:
+            await asend_kf_text(item['touser'], item['open_kfid'], '处理中...', f"ack:{item['msg_id']}")
+    await _gather_items(ack, items)
+
+
+async def _reply_page(items: List[Dict]):
+    """
+    没有任务队列时回复一页消息：每条消息先发送"处理中..."再调用 AI 回复
+    确认消息只受发送并发上限限制，不等待 make.com；AI 回复的并发不超过 make.com 的并发上限，超出的排队而不是返回默认回复
+    """
+    ack_limit = _loop_semaphore(_kf_ack_limits, KF_ACK_CONCURRENCY)
+    reply_limit = _loop_semaphore(_kf_reply_limits, make_bulkhead.max_concurrent)
+
+    async def reply(item):
+        async with ack_limit:
+            await asend_kf_text(item['touser'], item['open_kfid'], '处理中...', f"ack:{item['msg_id']}")
+        async with reply_limit:
+            await _test_make(**item)
+    await _gather_items(reply, items)
+
+
+async def _gather_items(func, items: List[Dict]):
+    results = await asyncio.gather(*(func(item) for item in items), return_exceptions=True)
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
+            logging.getLogger(__name__).error("Reply to kf message %s failed: %r", item['msg_id'], result)
+
+
+# 各事件循环中的信号量，在事件循环内创建(Python 3.9 的 Semaphore 构造时绑定当前线程的事件循环)
+_kf_ack_limits = weakref.WeakKeyDictionary()
+_kf_reply_limits = weakref.WeakKeyDictionary()
+
+
+def _loop_semaphore(semaphores: weakref.WeakKeyDictionary, size: int) -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = semaphores.get(loop)
+    if semaphore is None:
+        semaphore = semaphores[loop] = asyncio.Semaphore(size)
+    return semaphore
+
+
+def run_ai_reply_job(payload: Dict):
+    """
+    任务队列中 ai_reply 任务的处理函数，在工作线程中运行
+    有主事件循环时交给它执行并等待完成，复用其中的异步连接池
+    """
+    loop = default_dispatcher.loop
+    if loop is not None and loop.is_running():
+        asyncio.run_coroutine_threadsafe(_test_make(**payload), loop).result()
+    else:
+        asyncio.run(_run_and_close(_test_make(**payload)))
+
+
+async def _run_and_close(coro):
+    """在临时事件循环中运行协程，结束后关闭该循环中的异步连接"""
+    try:
+        return await coro
+    finally:
+        await connection_manager.aclose()
+
+
+_local_leases = {}
+_local_leases_lock = threading.Lock()
+# 单进程时各客服账号待处理的同步请求，open_kfid -> Token
+_kf_resync_tokens = {}
+
+
+@contextmanager
+def _local_lease(name: str):
+    """进程内的非阻塞互斥，yield 是否获取成功"""
+    with _local_leases_lock:
+        lock = _local_leases.setdefault(name, threading.Lock())
+    acquired = lock.acquire(blocking=False)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            lock.release()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+WXBizMsgCrypt 单条消息加解密微基准
+
+对比两种实现的每条消息耗时：
+- legacy: 每次调用都新建 XMLParse/SHA1/Prpcrypt 并 AES.new(CBC)（改造前的做法）
+- context: WXBizMsgCrypt 在构造时准备好的可复用上下文
+
+用法：
+python bench/bench_crypto_context.py -n 20000 -s 512
+"""
+import time
+import base64
+import struct
+import socket
+import argparse
+
+from common import TOKEN, AESKEY, CORPID
+from Crypto.Cipher import AES
+from WXBizMsgCrypt3 import WXBizMsgCrypt, SHA1, XMLParse
+
+
+def _legacy_decrypt(key, receiveid, post_data, msg_signature, timestamp, nonce):
+    """改造前 DecryptMsg 的完整路径"""
+    ret, encrypt = XMLParse().extract(post_data)
+    if ret != 0:
+        return ret, None
+    ret, signature = SHA1().getSHA1(TOKEN, timestamp, nonce, encrypt)
+    if signature != msg_signature:
+        return -40001, None
+    cryptor = AES.new(key, AES.MODE_CBC, key[:16])
+    plain_text = cryptor.decrypt(base64.b64decode(encrypt))
+    pad = plain_text[-1]
+    content = plain_text[16:-pad]
+    xml_len = socket.ntohl(struct.unpack("I", content[: 4])[0])
+    xml_content = content[4: xml_len + 4]
+    if content[xml_len + 4:].decode('utf8') != receiveid:
+        return -40005, None
+    return 0, xml_content
+
+
+def _timeit(func, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1e6
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--number', '-n', default=20000, type=int, help='每种实现执行的次数')
+    arg_parser.add_argument('--size', '-s', default=512, type=int, help='明文消息体字节数')
+    args = arg_parser.parse_args()
+
+    wxcpt = WXBizMsgCrypt(TOKEN, AESKEY, CORPID)
+    content = 'x' * max(args.size - 60, 1)
+    reply = '<xml><MsgType>text</MsgType><Content>%s</Content></xml>' % content
+    nonce, timestamp = '1743088447', '1743506245'
+    ret, post_data = wxcpt.EncryptMsg(reply, nonce, timestamp)
+    assert ret == 0
+    signature = post_data.split('<MsgSignature><![CDATA[')[1].split(']]>')[0]
+
+    legacy = _legacy_decrypt(wxcpt.key, CORPID, post_data, signature, timestamp, nonce)
+    current = wxcpt.DecryptMsg(post_data, signature, timestamp, nonce)
+    assert legacy == current and current[1] == reply.encode(), '两种实现结果不一致'
+
+    legacy_us = _timeit(lambda: _legacy_decrypt(wxcpt.key, CORPID, post_data, signature, timestamp, nonce),
+                        args.number)
+    context_us = _timeit(lambda: wxcpt.DecryptMsg(post_data, signature, timestamp, nonce), args.number)
+    view_us = _timeit(lambda: wxcpt.pc.decrypt_view(
+        wxcpt.xmlParse.extract(post_data)[1], wxcpt.m_bReceiveId), args.number)
+
+    print(f"消息大小: {len(reply)} B, 次数: {args.number}")
+    print(f"legacy  DecryptMsg : {legacy_us:8.2f} us/msg")
+    print(f"context DecryptMsg : {context_us:8.2f} us/msg  ({legacy_us / context_us:.2f}x)")
+    print(f"context decrypt_view: {view_us:8.2f} us/msg")
+
+
+if __name__ == "__main__":
+    main()
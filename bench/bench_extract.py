@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+XMLParse.extract 快速扫描与 ElementTree 耗时对比
+
+分别统计两种方式从真实回调（nohup.out）和构造的 1KB / 64KB 数据包中提取 Encrypt 节点的耗时，
+两者结果一致性的对拍在 test/test_xmlparse.py 中
+
+用法：
+python bench/bench_extract.py -n 20000
+"""
+import os
+import re
+import sys
+import time
+import base64
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from WXBizMsgCrypt3 import XMLParse
+
+ENVELOPE = ('<xml><ToUserName><![CDATA[ww4ede9a36781c6e1c]]></ToUserName>'
+            '<Encrypt><![CDATA[%s]]></Encrypt><AgentID><![CDATA[]]></AgentID></xml>')
+
+
+def load_logged_bodies(path=os.path.join(ROOT, 'nohup.out')):
+    """读取 nohup.out 中打印过的回调请求体"""
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8', errors='ignore') as f:
+        return [m.encode() for m in re.findall(r"request_body: b'([^']*)'", f.read())]
+
+
+def _timeit(func, body, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        func(body)
+    return (time.perf_counter() - start) / number * 1e6
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--number', '-n', default=20000, type=int, help='每个请求体执行的次数')
+    args = arg_parser.parse_args()
+
+    tree_parse, fast_parse = XMLParse(), XMLParse(fast=True)
+    logged = load_logged_bodies()
+    samples = [('logged', logged[0])] if logged else []
+    samples += [
+        ('plain', ENVELOPE % base64.b64encode(os.urandom(480)).decode()),
+        ('large-64k', ENVELOPE % base64.b64encode(os.urandom(48 * 1024)).decode()),
+    ]
+    for name, body in samples:
+        number = args.number if len(body) < 8192 else max(args.number // 20, 1)
+        tree_us = _timeit(tree_parse.extract, body, number)
+        fast_us = _timeit(fast_parse.extract, body, number)
+        print(f"{name:10s} {len(body):6d} B  ElementTree {tree_us:8.2f} us  fast {fast_us:8.2f} us"
+              f"  ({tree_us / fast_us:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+回调热路径日志开销基准
+
+按一次文本消息回调中原有的 print 语句(请求体、处理器、回复内容、响应结果)模拟每个请求的日志，
+对比调用线程上的每请求耗时：
+- print: 改造前的同步 print，stdout 重定向到文件
+- json-info: api.log 的队列日志，INFO 级别(请求体等大数据不记录)
+- json-debug: DEBUG 级别，请求体按 --sample-rate 采样记录
+
+用法：
+python bench/bench_logging.py -n 20000 -s 640
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import contextlib
+
+from common import new_wxcpt, text_msg, make_callback, summarize
+from api.log import setup_logging, shutdown_logging, log_payload
+
+logger = logging.getLogger('bench.logging')
+
+
+def _print_request(body, handler, reply, response):
+    """改造前 web.py / api/utils.py 中每个请求的 print"""
+    print("响应体request_body:", body, '\n')
+    print("处理器handler:", handler, '\n')
+    print("微信客服回复的信息:", reply)
+    print("wechat_callback->response:", 0, response, '\n')
+
+
+def _log_request(body, handler, reply, response):
+    """改造后的对应日志"""
+    log_payload(logger, "Callback body", body=body)
+    logger.debug("Route %s to %s", 'text', handler.__name__)
+    log_payload(logger, "Reply content", tenant='default', reply=reply)
+
+
+def _run(func, args, number):
+    latencies = []
+    for _ in range(number):
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--number', '-n', default=20000, type=int, help='每种方式模拟的请求数')
+    arg_parser.add_argument('--size', '-s', default=640, type=int, help='明文消息体字节数')
+    arg_parser.add_argument('--sample-rate', default=0.01, type=float, help='DEBUG 级别下请求体的采样比例')
+    args = arg_parser.parse_args()
+
+    wxcpt = new_wxcpt()
+    body = make_callback(wxcpt, text_msg(args.size))[0].encode()
+    ret, response = wxcpt.EncryptMsg(text_msg(args.size), '1743088447')
+    request = (body, _log_request, '正在响应中,请耐心等待...', response)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'nohup.out'), 'w', encoding='utf-8') as out, \
+                contextlib.redirect_stdout(out):
+            results['print'] = _run(_print_request, request, args.number)
+            out.flush()
+            print_bytes = out.tell()
+
+        for name, level in (('json-info', 'INFO'), ('json-debug', 'DEBUG')):
+            log_file = os.path.join(tmp, f'{name}.log')
+            handler = setup_logging(level, payload_sample_rate=args.sample_rate, filename=log_file)
+            results[name] = _run(_log_request, request, args.number)
+            dropped = handler.dropped
+            shutdown_logging()
+            results[name]['dropped'] = dropped
+            results[name]['bytes'] = os.path.getsize(log_file)
+        results['print']['bytes'] = print_bytes
+
+    sys.stdout.write(f"请求体大小: {len(body)} B, 请求数: {args.number}\n")
+    for name, stats in results.items():
+        sys.stdout.write(f"{name:10s}: mean {stats['mean_us']:8.2f} us  p99 {stats['p99_us']:8.2f} us  "
+                         f"输出 {stats['bytes'] / 1024:9.1f} KB\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试与压测脚本共用的工具：测试用密钥、构造加密回调数据包、统计延迟分位数
+"""
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from WXBizMsgCrypt3 import WXBizMsgCrypt
+
+TOKEN = 'K0p31BNNXyqRCtbupNuURNVu'
+AESKEY = 'VlistlBRh3A7ent3S3rq6A1WYHoyjEuqIU01GeuLzK9'
+CORPID = 'ww4ede9a36781c6e1c'
+
+TEXT_MSG_TEMPLATE = """<xml><ToUserName><![CDATA[%(corpid)s]]></ToUserName>\
+<FromUserName><![CDATA[%(user)s]]></FromUserName><CreateTime>%(create_time)s</CreateTime>\
+<MsgType><![CDATA[text]]></MsgType><Content><![CDATA[%(content)s]]></Content>\
+<MsgId>%(msg_id)s</MsgId><AgentID>1000005</AgentID></xml>"""
+
+IMAGE_MSG_TEMPLATE = """<xml><ToUserName><![CDATA[%(corpid)s]]></ToUserName>\
+<FromUserName><![CDATA[%(user)s]]></FromUserName><CreateTime>%(create_time)s</CreateTime>\
+<MsgType><![CDATA[image]]></MsgType><PicUrl><![CDATA[http://127.0.0.1/%(msg_id)s.jpg]]></PicUrl>\
+<MediaId><![CDATA[media%(msg_id)s]]></MediaId><MsgId>%(msg_id)s</MsgId><AgentID>1000005</AgentID></xml>"""
+
+KF_EVENT_TEMPLATE = """<xml><ToUserName><![CDATA[%(corpid)s]]></ToUserName><CreateTime>%(create_time)s</CreateTime>\
+<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[kf_msg_or_event]]></Event>\
+<Token><![CDATA[%(token)s]]></Token><OpenKfId><![CDATA[%(open_kfid)s]]></OpenKfId></xml>"""
+
+_ENCRYPT_RE = re.compile(r'<Encrypt><!\[CDATA\[(.*?)\]\]></Encrypt>')
+_SIGNATURE_RE = re.compile(r'<MsgSignature><!\[CDATA\[(.*?)\]\]></MsgSignature>')
+
+
+def new_wxcpt(token=TOKEN, aeskey=AESKEY, corpid=CORPID):
+    return WXBizMsgCrypt(token, aeskey, corpid)
+
+
+def text_msg(size, msg_id=1, user='zhangsan', corpid=CORPID):
+    """生成大小约为 size 字节的文本消息xml"""
+    base = len((TEXT_MSG_TEMPLATE % {'corpid': corpid, 'user': user, 'create_time': 1743506245,
+                                     'content': '', 'msg_id': msg_id}).encode())
+    # 中英文混合，贴近真实消息
+    unit = '你好hello,'
+    content = (unit * (max(size - base, 1) // len(unit.encode()) + 1))
+    while len(content.encode()) > max(size - base, 1):
+        content = content[:-1]
+    return TEXT_MSG_TEMPLATE % {'corpid': corpid, 'user': user, 'create_time': int(time.time()),
+                                'content': content, 'msg_id': msg_id}
+
+
+def image_msg(msg_id=1, user='zhangsan', corpid=CORPID):
+    return IMAGE_MSG_TEMPLATE % {'corpid': corpid, 'user': user, 'create_time': int(time.time()), 'msg_id': msg_id}
+
+
+def kf_event(open_kfid='kf1', token='ENC1', corpid=CORPID):
+    """微信客服 kf_msg_or_event 事件，收到后需要调用 kf/sync_msg 拉取消息"""
+    return KF_EVENT_TEMPLATE % {'corpid': corpid, 'create_time': int(time.time()), 'token': token,
+                                'open_kfid': open_kfid}
+
+
+def make_callback(wxcpt, xml, nonce='1743088447', timestamp='1743506245'):
+    """
+    生成企业微信回调请求
+    :return: (请求体, msg_signature, timestamp, nonce, 密文)
+    """
+    ret, reply = wxcpt.EncryptMsg(xml, nonce, timestamp)
+    if ret != 0:
+        raise RuntimeError(f"EncryptMsg failed: {ret}")
+    encrypt = _ENCRYPT_RE.search(reply).group(1)
+    signature = _SIGNATURE_RE.search(reply).group(1)
+    body = ('<xml><ToUserName><![CDATA[%s]]></ToUserName><Encrypt><![CDATA[%s]]></Encrypt>'
+            '<AgentID><![CDATA[]]></AgentID></xml>' % (wxcpt.m_sReceiveId, encrypt))
+    return body, signature, timestamp, nonce, encrypt
+
+
+def percentile(sorted_values, q):
+    """对已排序的数据取分位数(最近秩)"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed=None):
+    """把一组耗时(秒)汇总为吞吐与延迟分位数(微秒)"""
+    values = sorted(latencies)
+    total = elapsed if elapsed is not None else sum(values)
+    count = len(values)
+    return {
+        'count': count,
+        'ops_per_sec': round(count / total, 2) if total else 0.0,
+        'mean_us': round(sum(values) / count * 1e6, 2) if count else 0.0,
+        'p50_us': round(percentile(values, 50) * 1e6, 2),
+        'p90_us': round(percentile(values, 90) * 1e6, 2),
+        'p95_us': round(percentile(values, 95) * 1e6, 2),
+        'p99_us': round(percentile(values, 99) * 1e6, 2),
+        'max_us': round(values[-1] * 1e6, 2) if count else 0.0,
+    }
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+web.py 端到端压测
+
+用 WXBizMsgCrypt.EncryptMsg 生成签名正确的 text / image / kf_msg_or_event 回调，按固定速率(开环)或
+固定并发(闭环)发给 POST /，统计回调响应的延迟分位数、吞吐和状态码；配合 bench/standin.py 模拟上游，
+统计每条客户消息从产生到收到确认和 AI 回复的端到端耗时。结果以 JSON 输出，记录全部参数和随机种子。
+
+开环模式下延迟从计划发送时间算起，服务端排队造成的等待也计入延迟。
+
+用法：
+# 自动启动 bench/standin.py 和 web.py，每秒 200 个回调，持续 30 秒
+python bench/loadtest.py --spawn --rate 200 --duration 30 -o report.json
+# 压测已经启动的服务，64 并发发送 20000 个回调
+python bench/loadtest.py --url http://127.0.0.1:8000/ --standin http://127.0.0.1:9000 -c 64 -n 20000
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import asyncio
+import platform
+import argparse
+import subprocess
+from collections import Counter
+
+import httpx
+
+from common import ROOT, TOKEN, AESKEY, CORPID, new_wxcpt, text_msg, image_msg, kf_event, make_callback, summarize
+
+KINDS = ('text', 'image', 'kf')
+
+
+def parse_mix(spec):
+    """解析 "text=0.2,image=0.1,kf=0.7"，返回 (类型列表, 权重列表)"""
+    weights = {}
+    for item in spec.split(','):
+        kind, weight = item.split('=', 1)
+        if kind.strip() not in KINDS:
+            raise ValueError(f"unknown callback kind '{kind}', expected one of {KINDS}")
+        weights[kind.strip()] = float(weight)
+    return list(weights), list(weights.values())
+
+
+class CallbackFactory:
+    """按种子生成回调请求，同样的参数得到同样的类型、客户和客服账号序列"""
+
+    def __init__(self, mix, seed, users, kf_accounts):
+        self.kinds, self.weights = parse_mix(mix)
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.users = users
+        self.kf_accounts = kf_accounts
+        self.wxcpt = new_wxcpt()
+
+    def build(self, index):
+        """:return: (类型, 请求体, 查询参数)"""
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        user = f"user{self.rng.randrange(self.users)}"
+        if kind == 'text':
+            xml = text_msg(256, msg_id=index, user=user)
+        elif kind == 'image':
+            xml = image_msg(msg_id=index, user=user)
+        else:
+            xml = kf_event(open_kfid=f"kf{self.rng.randrange(self.kf_accounts)}", token=f"ENC{index}")
+        # nonce 每个请求不同，避免被重放缓存拦截
+        body, signature, timestamp, nonce, _ = make_callback(self.wxcpt, xml, nonce=f"{self.seed}{index:010d}",
+                                                            timestamp=str(int(time.time())))
+        return kind, body, {'msg_signature': signature, 'timestamp': timestamp, 'nonce': nonce}
+
+
+class LoadTest:
+    def __init__(self, url, factory):
+        self.url = url
+        self.factory = factory
+        self.latencies = {kind: [] for kind in KINDS}
+        self.status = Counter()
+        self.sent = 0
+
+    async def send(self, client, index, scheduled=None):
+        kind, body, params = self.factory.build(index)
+        self.sent += 1
+        start = time.perf_counter() if scheduled is None else scheduled
+        try:
+            response = await client.post(self.url, params=params, content=body.encode('utf-8'))
+            self.status[str(response.status_code)] += 1
+        except httpx.HTTPError as e:
+            self.status[type(e).__name__] += 1
+            return
+        self.latencies[kind].append(time.perf_counter() - start)
+
+    async def open_loop(self, client, rate, total, max_inflight):
+        """按固定速率发送，最多 max_inflight 个请求同时进行"""
+        semaphore = asyncio.Semaphore(max_inflight)
+        tasks = set()
+        start = time.perf_counter()
+
+        async def run(index, scheduled):
+            try:
+                await self.send(client, index, scheduled)
+            finally:
+                semaphore.release()
+
+        for index in range(total):
+            scheduled = start + index / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await semaphore.acquire()
+            task = asyncio.ensure_future(run(index, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def closed_loop(self, client, concurrency, total, deadline):
+        """concurrency 个发送者各自在上一个请求完成后立即发送下一个"""
+        counter = iter(range(total))
+
+        async def worker():
+            for index in counter:
+                if deadline and time.perf_counter() >= deadline:
+                    return
+                await self.send(client, index)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def wait_ready(url, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} is not ready after {timeout}s")
+
+
+def spawn(args):
+    """启动 bench/standin.py 和 web.py，返回进程列表"""
+    output = None if args.verbose else subprocess.DEVNULL
+    standin = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'bench', 'standin.py'), '--port', str(args.standin_port)]
+        + shlex.split(args.standin_args), cwd=ROOT, stdout=output, stderr=output)
+    standin_url = f"http://127.0.0.1:{args.standin_port}"
+    web = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'web.py'), '-p', str(args.web_port), '-t', TOKEN, '-a', AESKEY,
+         '-c', CORPID, '--qyapi-base-url', standin_url, '--make-webhook-url', f"{standin_url}/make/webhook",
+         '--log-level', 'WARNING'] + shlex.split(args.web_args), cwd=ROOT, stdout=output, stderr=output)
+    return [standin, web], f"http://127.0.0.1:{args.web_port}/", standin_url
+
+
+def collect_e2e(standin_url, drain):
+    """等待上游收到的确认和回复不再增加，返回端到端耗时统计"""
+    deadline = time.time() + drain
+    previous = None
+    while True:
+        result = httpx.get(f"{standin_url}/standin/e2e", timeout=10.0).json()
+        progress = (len(result['ack_seconds']), len(result['reply_seconds']))
+        if progress == (result['messages'], result['messages']) or progress == previous or time.time() >= deadline:
+            break
+        previous = progress
+        time.sleep(1.0)
+    return {
+        'messages': result['messages'],
+        'ack': to_ms(summarize(result['ack_seconds'])),
+        'reply': to_ms(summarize(result['reply_seconds'])),
+        'missing_ack': result['messages'] - len(result['ack_seconds']),
+        'missing_reply': result['messages'] - len(result['reply_seconds']),
+    }
+
+
+def to_ms(summary):
+    """summarize 的结果(微秒)换算为毫秒，去掉与延迟无关的 ops_per_sec"""
+    result = {'count': summary['count']}
+    for key, value in summary.items():
+        if key.endswith('_us'):
+            result[key[:-3] + '_ms'] = round(value / 1000, 3)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run(args, url):
+    factory = CallbackFactory(args.mix, args.seed, args.users, args.kf_accounts)
+    test = LoadTest(url, factory)
+    limit = max(args.concurrency, args.max_inflight)
+    async with httpx.AsyncClient(timeout=args.timeout,
+                                 limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit)) as client:
+        start = time.perf_counter()
+        if args.rate:
+            total = args.requests or int(args.rate * args.duration)
+            await test.open_loop(client, args.rate, total, args.max_inflight)
+        else:
+            total = args.requests or sys.maxsize
+            deadline = start + args.duration if not args.requests else None
+            await test.closed_loop(client, args.concurrency, total, deadline)
+        elapsed = time.perf_counter() - start
+    return test, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000/', help='web.py 的回调地址')
+    parser.add_argument('--standin', default=None, help='bench/standin.py 的地址，用于统计端到端耗时')
+    parser.add_argument('--spawn', action='store_true', help='启动 bench/standin.py 和 web.py')
+    parser.add_argument('--web-port', default=8765, type=int)
+    parser.add_argument('--standin-port', default=9765, type=int)
+    parser.add_argument('--web-args', default='', help='--spawn 时传给 web.py 的其他参数')
+    parser.add_argument('--standin-args', default='', help='--spawn 时传给 standin.py 的其他参数')
+    parser.add_argument('--verbose', '-v', action='store_true', help='--spawn 时显示 web.py 和 standin.py 的输出')
+    parser.add_argument('--rate', '-r', default=0.0, type=float, help='每秒发送的回调数(开环)，不指定时按 --concurrency 闭环发送')
+    parser.add_argument('--concurrency', '-c', default=16, type=int, help='闭环模式的并发数')
+    parser.add_argument('--max-inflight', default=1000, type=int, help='开环模式最多同时进行的请求数')
+    parser.add_argument('--requests', '-n', default=0, type=int, help='发送的回调总数')
+    parser.add_argument('--duration', '-d', default=10.0, type=float, help='未指定 -n 时的持续时间(秒)')
+    parser.add_argument('--mix', default='text=0.2,image=0.1,kf=0.7', help='各类回调的比例')
+    parser.add_argument('--users', default=1000, type=int, help='text/image 回调的发送者数量')
+    parser.add_argument('--kf-accounts', default=10, type=int, help='kf_msg_or_event 回调的客服账号数量')
+    parser.add_argument('--seed', default=1, type=int, help='随机种子')
+    parser.add_argument('--timeout', default=30.0, type=float, help='单个回调的超时时间(秒)')
+    parser.add_argument('--drain', default=30.0, type=float, help='发送结束后等待 AI 回复的最长时间(秒)')
+    parser.add_argument('-o', '--output', default=None, help='JSON 报告文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    processes = []
+    url, standin_url = args.url, args.standin
+    try:
+        if args.spawn:
+            processes, url, standin_url = spawn(args)
+            wait_ready(f"{standin_url}/standin/stats")
+            wait_ready(f"{url.rstrip('/')}/stats")
+        if standin_url:
+            httpx.post(f"{standin_url}/standin/reset", timeout=10.0)
+
+        test, elapsed = asyncio.run(run(args, url))
+
+        all_latencies = [value for values in test.latencies.values() for value in values]
+        overall = summarize(all_latencies, elapsed)
+        report = {
+            'config': vars(args),
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                            'commit': git_commit()},
+            'sent': test.sent,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(test.sent / elapsed, 2) if elapsed else 0.0,
+            'status': dict(sorted(test.status.items())),
+            'latency': to_ms(overall),
+            'by_kind': {kind: to_ms(summarize(values)) for kind, values in test.latencies.items() if values},
+        }
+        if standin_url:
+            report['e2e'] = collect_e2e(standin_url, args.drain)
+            report['upstream'] = httpx.get(f"{standin_url}/standin/stats", timeout=10.0).json()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+    latency = report['latency']
+    print(f"sent {report['sent']} in {report['elapsed_s']}s ({report['throughput_rps']} req/s)  "
+          f"p50 {latency['p50_ms']}ms p95 {latency['p95_ms']}ms p99 {latency['p99_ms']}ms  status {report['status']}",
+          file=sys.stderr)
+    if 'e2e' in report:
+        e2e = report['e2e']
+        print(f"e2e messages {e2e['messages']}  ack p50 {e2e['ack']['p50_ms']}ms p99 {e2e['ack']['p99_ms']}ms  "
+              f"reply p50 {e2e['reply']['p50_ms']}ms p99 {e2e['reply']['p99_ms']}ms", file=sys.stderr)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+企业微信接口与 make.com webhook 的本地模拟服务，用于离线压测和联调
+
+模拟的接口：
+- GET  /cgi-bin/gettoken: 签发 access_token，其余接口校验 token，无效返回 40014，过期返回 42001
+- POST /cgi-bin/kf/sync_msg: 每个 open_kfid 一个消息序列，按 cursor/limit 分页返回 msg_list、next_cursor、has_more；
+  cursor 之后没有消息时自动生成 --auto-messages 条(模拟客户刚发来的消息)
+- POST /cgi-bin/kf/send_msg、/cgi-bin/message/send、/cgi-bin/user/list_id、/cgi-bin/kf/customer/batchget
+- POST /make/{path}: AI webhook，返回纯文本回复；--reply-sentences 大于 0 时以分块传输逐段返回
+  (每 --token-interval 秒一块，模拟大模型逐字输出)，路径以 sse 结尾时按 text/event-stream 返回
+
+故障注入(接口名与 RateLimiter.endpoint_of 一致，如 kf/send_msg，make 表示 webhook，* 表示所有接口)：
+- --latency kf/send_msg=0.05 --jitter 0.02: 固定延迟 + 随机抖动(秒)
+- --error-rate make=0.1: 按比例返回 HTTP 500
+- --rate-limit kf/send_msg=200: 每秒请求数，超限时企业微信接口返回 45009，webhook 返回 HTTP 429
+运行中可以 POST /standin/config 修改，GET /standin/stats 查看各接口的调用、出错和限流次数，
+POST /standin/messages 向某个客服账号追加消息；
+GET /standin/e2e 返回每条客户消息从产生到收到确认(带 msgid 的 kf/send_msg)和回复(不带 msgid 的 kf/send_msg)的耗时，
+POST /standin/reset 清空统计，供 bench/loadtest.py 使用。
+
+用法：
+python bench/standin.py --port 9000 --latency '*=0.02' --error-rate make=0.05
+python web.py -p 8000 ... --qyapi-base-url http://127.0.0.1:9000 --make-webhook-url http://127.0.0.1:9000/make/webhook
+"""
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import deque
+from typing import Any, Dict, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+from common import ROOT  # noqa: F401  把仓库根目录加入 sys.path
+from api.ratelimit import TokenBucket
+from api.outbox import make_msgid
+
+# 每个客服账号保留的消息数，更早的消息按 cursor 读取时跳过
+MAX_MESSAGES = 100000
+
+
+def parse_settings(specs, cast=float) -> Dict[str, Any]:
+    """
+    解析 "kf/send_msg=0.05,make=0.1" 形式的按接口设置
+    :param specs: 字符串列表(命令行参数可重复)
+    """
+    settings = {}
+    for spec in specs or []:
+        for item in spec.split(','):
+            if item.strip():
+                endpoint, value = item.rsplit('=', 1)
+                settings[endpoint.strip()] = cast(value)
+    return settings
+
+
+class StandIn:
+    """模拟服务的状态：签发的 token、各客服账号的消息序列、故障注入配置和调用统计"""
+
+    def __init__(self, latency=None, jitter=0.0, error_rate=None, rate_limit=None, token_ttl=7200,
+                 auto_messages=1, page_size=1000, users=1000, reply_sentences=0, token_interval=0.05,
+                 clock=time.monotonic):
+        """
+        :param latency: {接口: 延迟秒数}
+        :param jitter: 额外的随机延迟上限(秒)
+        :param error_rate: {接口: 返回 HTTP 500 的比例}
+        :param rate_limit: {接口: 每秒请求数}
+        :param token_ttl: access_token 有效期(秒)
+        :param auto_messages: sync_msg 没有新消息时自动生成的消息数
+        :param page_size: sync_msg 每页最多返回的消息数
+        :param users: 自动生成消息时使用的客户数
+        :param reply_sentences: webhook 流式回复的句子数，0 时一次返回整个回复
+        :param token_interval: 流式回复相邻两块之间的间隔(秒)
+        """
+        self.latency = dict(latency or {})
+        self.jitter = jitter
+        self.error_rate = dict(error_rate or {})
+        self.rate_limit = dict(rate_limit or {})
+        self.token_ttl = token_ttl
+        self.auto_messages = auto_messages
+        self.page_size = page_size
+        self.users = users
+        self.reply_sentences = reply_sentences
+        self.token_interval = token_interval
+        self.clock = clock
+        self.tokens: Dict[str, float] = {}
+        # open_kfid -> [第一条消息的序号, 消息]
+        self.messages: Dict[str, list] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        # 端到端耗时：msgid -> 产生时间，客户 -> 等待回复的消息产生时间
+        self._created: Dict[str, float] = {}
+        self._awaiting_reply: Dict[str, deque] = {}
+        # web.py 发送时使用的 msgid(由 ack:/reply: 加客户消息ID生成) -> (类型, 客户消息ID)
+        self._outgoing: Dict[str, tuple] = {}
+        self.ack_seconds: list = []
+        self.reply_seconds: list = []
+        self.created_messages = 0
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._ids = itertools.count(1)
+
+    def configure(self, latency=None, jitter=None, error_rate=None, rate_limit=None, **options):
+        """运行中修改故障注入配置，值为 0 时删除该接口的配置"""
+        for current, update in ((self.latency, latency), (self.error_rate, error_rate),
+                                (self.rate_limit, rate_limit)):
+            for endpoint, value in (update or {}).items():
+                if value:
+                    current[endpoint] = float(value)
+                else:
+                    current.pop(endpoint, None)
+        self._buckets.clear()
+        if jitter is not None:
+            self.jitter = float(jitter)
+        for name in ('token_ttl', 'auto_messages', 'page_size', 'users', 'reply_sentences', 'token_interval'):
+            if options.get(name) is not None:
+                setattr(self, name, type(getattr(self, name))(options[name]))
+
+    def reset(self):
+        self.stats.clear()
+        self._created.clear()
+        self._awaiting_reply.clear()
+        self._outgoing.clear()
+        self.ack_seconds = []
+        self.reply_seconds = []
+        self.created_messages = 0
+
+    def setting(self, settings: Dict[str, float], endpoint: str) -> float:
+        return settings.get(endpoint, settings.get('*', 0.0))
+
+    async def enter(self, endpoint: str) -> Optional[str]:
+        """
+        按配置延迟，并判断本次调用是否被限流或注入错误
+        :return: None 正常处理，'throttled' 限流，'error' 注入错误
+        """
+        stats = self.stats.setdefault(endpoint, {'calls': 0, 'errors': 0, 'throttled': 0})
+        stats['calls'] += 1
+        delay = self.setting(self.latency, endpoint) + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        rate = self.setting(self.rate_limit, endpoint)
+        if rate > 0:
+            now = self.clock()
+            bucket = self._buckets.get(endpoint)
+            if bucket is None:
+                bucket = self._buckets[endpoint] = TokenBucket(rate, max(int(rate), 1), now)
+            if bucket.reserve(now) > 0:
+                bucket.cancel(now)
+                stats['throttled'] += 1
+                return 'throttled'
+        if random.random() < self.setting(self.error_rate, endpoint):
+            stats['errors'] += 1
+            return 'error'
+        return None
+
+    def issue_token(self) -> Dict[str, Any]:
+        token = f"standin-{next(self._ids)}-{random.getrandbits(64):016x}"
+        self.tokens[token] = self.clock() + self.token_ttl
+        return {'errcode': 0, 'errmsg': 'ok', 'access_token': token, 'expires_in': self.token_ttl}
+
+    def check_token(self, token: Optional[str]) -> Optional[Dict[str, Any]]:
+        """token 有效时返回 None，否则返回错误结果"""
+        expires_at = self.tokens.get(token or '')
+        if expires_at is None:
+            return {'errcode': 40014, 'errmsg': 'invalid access_token'}
+        if expires_at <= self.clock():
+            del self.tokens[token]
+            return {'errcode': 42001, 'errmsg': 'access_token expired'}
+        return None
+
+    def add_messages(self, open_kfid: str, count: int = 1, external_userid: Optional[str] = None,
+                     content: Optional[str] = None):
+        """向客服账号追加客户消息"""
+        log = self.messages.setdefault(open_kfid, [0, deque(maxlen=MAX_MESSAGES)])
+        for _ in range(count):
+            n = next(self._ids)
+            if len(log[1]) == MAX_MESSAGES:
+                log[0] += 1
+            msgid = f"msg{n}"
+            userid = external_userid or f"wmstandin{n % self.users}"
+            now = self.clock()
+            self._created[msgid] = now
+            self._awaiting_reply.setdefault(userid, deque()).append(now)
+            self._outgoing[make_msgid(f"ack:{msgid}")] = ('ack', msgid)
+            self._outgoing[make_msgid(f"reply:{msgid}")] = ('reply', msgid)
+            self.created_messages += 1
+            log[1].append({
+                'msgid': msgid,
+                'open_kfid': open_kfid,
+                'external_userid': userid,
+                'send_time': int(time.time()),
+                'origin': 3,
+                'msgtype': 'text',
+                'text': {'content': content if content is not None else f"你好 {n}"},
+            })
+
+    def sync_msg(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        open_kfid = body.get('open_kfid', '')
+        limit = min(int(body.get('limit') or 1000), self.page_size)
+        cursor = body.get('cursor') or ''
+        log = self.messages.setdefault(open_kfid, [0, deque(maxlen=MAX_MESSAGES)])
+        position = max(int(cursor) if cursor.isdigit() else 0, log[0])
+        if position >= log[0] + len(log[1]) and self.auto_messages:
+            self.add_messages(open_kfid, self.auto_messages)
+            position = max(position, log[0])
+        end = min(position + limit, log[0] + len(log[1]))
+        msg_list = [log[1][i - log[0]] for i in range(position, end)]
+        return {'errcode': 0, 'errmsg': 'ok', 'next_cursor': str(end),
+                'has_more': int(end < log[0] + len(log[1])), 'msg_list': msg_list}
+
+    def send_msg(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        按 msgid 区分对客户消息的确认(处理中...)和回复；未知的 msgid 视为直接使用客户消息ID的确认，
+        不带 msgid 的视为对该客户最早一条未回复消息的回复
+        """
+        now = self.clock()
+        msgid = body.get('msgid')
+        kind, origin = self._outgoing.pop(msgid, ('ack', msgid)) if msgid else ('reply', None)
+        if kind == 'ack':
+            created = self._created.pop(origin, None)
+            if created is not None:
+                self.ack_seconds.append(now - created)
+        else:
+            awaiting = self._awaiting_reply.get(body.get('touser', ''))
+            if awaiting:
+                self.reply_seconds.append(now - awaiting.popleft())
+        return {'errcode': 0, 'errmsg': 'ok', 'msgid': f"out{next(self._ids)}"}
+
+    def batchget(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        # 以 invalid 开头的客户ID视为超过 48 小时未咨询的客户
+        userids = body.get('external_userid_list', [])
+        customers = [{'external_userid': userid, 'nickname': f"客户{userid[-4:]}", 'avatar': '', 'gender': 0,
+                      'unionid': ''} for userid in userids if not userid.startswith('invalid')]
+        invalid = [userid for userid in userids if userid.startswith('invalid')]
+        return {'errcode': 0, 'errmsg': 'ok', 'customer_list': customers, 'invalid_external_userid': invalid}
+
+    async def stream_reply(self, option: str, sse: bool = False):
+        """逐块输出 reply_sentences 句回复，每块 4 个字符"""
+        text = ''.join(f"第{n + 1}句：关于“{option}”的模拟回答。" for n in range(self.reply_sentences))
+        for start in range(0, len(text), 4):
+            await asyncio.sleep(self.token_interval)
+            chunk = text[start:start + 4]
+            yield f"data: {chunk}\n\n" if sse else chunk
+
+    def list_id(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        limit = int(body.get('limit') or 1000)
+        start = int(body.get('cursor') or 0)
+        end = min(start + limit, self.users)
+        return {'errcode': 0, 'errmsg': 'ok', 'next_cursor': str(end) if end < self.users else '',
+                'dept_user': [{'userid': f"user{i}", 'department': 1} for i in range(start, end)]}
+
+
+def create_app(standin: StandIn) -> FastAPI:
+    app = FastAPI()
+    app.state.standin = standin
+
+    def failure(outcome: str, webhook: bool = False) -> Response:
+        if outcome == 'throttled':
+            if webhook:
+                return PlainTextResponse('Too Many Requests', status_code=429)
+            return JSONResponse({'errcode': 45009, 'errmsg': 'api freq out of limit'})
+        return PlainTextResponse('Internal Server Error', status_code=500)
+
+    async def qyapi(request: Request, endpoint: str, handle):
+        outcome = await standin.enter(endpoint)
+        if outcome:
+            return failure(outcome)
+        error = standin.check_token(request.query_params.get('access_token'))
+        if error:
+            return error
+        body = await request.json() if request.method == 'POST' else {}
+        return handle(body)
+
+    @app.get("/cgi-bin/gettoken")
+    async def gettoken(corpid: str = '', corpsecret: str = ''):
+        outcome = await standin.enter('gettoken')
+        if outcome:
+            return failure(outcome)
+        if not corpid or not corpsecret:
+            return {'errcode': 40013, 'errmsg': 'invalid corpid'}
+        return standin.issue_token()
+
+    @app.post("/cgi-bin/kf/sync_msg")
+    async def sync_msg(request: Request):
+        return await qyapi(request, 'kf/sync_msg', standin.sync_msg)
+
+    @app.post("/cgi-bin/kf/send_msg")
+    async def send_msg(request: Request):
+        return await qyapi(request, 'kf/send_msg', standin.send_msg)
+
+    @app.post("/cgi-bin/message/send")
+    async def message_send(request: Request):
+        return await qyapi(request, 'message/send',
+                           lambda body: {'errcode': 0, 'errmsg': 'ok', 'invaliduser': '',
+                                         'msgid': f"out{next(standin._ids)}"})
+
+    @app.post("/cgi-bin/user/list_id")
+    async def list_id(request: Request):
+        return await qyapi(request, 'user/list_id', standin.list_id)
+
+    @app.post("/cgi-bin/kf/customer/batchget")
+    async def batchget(request: Request):
+        return await qyapi(request, 'kf/customer/batchget', standin.batchget)
+
+    @app.post("/make/{path:path}")
+    async def make_webhook(request: Request, path: str):
+        outcome = await standin.enter('make')
+        if outcome:
+            return failure(outcome, webhook=True)
+        body = await request.json()
+        if not standin.reply_sentences:
+            return PlainTextResponse(f"模拟回复：{body.get('option', '')}")
+        sse = path.endswith('sse')
+        return StreamingResponse(standin.stream_reply(body.get('option', ''), sse),
+                                 media_type='text/event-stream' if sse else 'text/plain; charset=utf-8')
+
+    @app.post("/standin/config")
+    async def configure(request: Request):
+        standin.configure(**await request.json())
+        return {'latency': standin.latency, 'jitter': standin.jitter, 'error_rate': standin.error_rate,
+                'rate_limit': standin.rate_limit}
+
+    @app.post("/standin/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        standin.add_messages(body['open_kfid'], int(body.get('count', 1)), body.get('external_userid'),
+                             body.get('content'))
+        return {'ok': True}
+
+    @app.get("/standin/stats")
+    async def stats():
+        return standin.stats
+
+    @app.get("/standin/e2e")
+    async def e2e():
+        return {'messages': standin.created_messages, 'ack_seconds': standin.ack_seconds,
+                'reply_seconds': standin.reply_seconds}
+
+    @app.post("/standin/reset")
+    async def reset():
+        standin.reset()
+        return {'ok': True}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', '-p', default=9000, type=int)
+    parser.add_argument('--latency', action='append', default=[], help='ENDPOINT=SECONDS，可重复')
+    parser.add_argument('--jitter', default=0.0, type=float, help='额外随机延迟上限(秒)')
+    parser.add_argument('--error-rate', action='append', default=[], help='ENDPOINT=RATIO，可重复')
+    parser.add_argument('--rate-limit', action='append', default=[], help='ENDPOINT=QPS，可重复')
+    parser.add_argument('--token-ttl', default=7200, type=int, help='access_token 有效期(秒)')
+    parser.add_argument('--auto-messages', default=1, type=int, help='sync_msg 没有新消息时自动生成的消息数')
+    parser.add_argument('--page-size', default=1000, type=int, help='sync_msg 每页最多返回的消息数')
+    parser.add_argument('--users', default=1000, type=int, help='自动生成消息时使用的客户数')
+    parser.add_argument('--reply-sentences', default=0, type=int, help='webhook 流式回复的句子数，0 时一次返回')
+    parser.add_argument('--token-interval', default=0.05, type=float, help='流式回复相邻两块之间的间隔(秒)')
+    args = parser.parse_args()
+
+    standin = StandIn(latency=parse_settings(args.latency), jitter=args.jitter,
+                      error_rate=parse_settings(args.error_rate), rate_limit=parse_settings(args.rate_limit),
+                      token_ttl=args.token_ttl, auto_messages=args.auto_messages, page_size=args.page_size,
+                      users=args.users, reply_sentences=args.reply_sentences, token_interval=args.token_interval)
+    uvicorn.run(create_app(standin), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+回调热点路径基准测试
+
+用 WXBizMsgCrypt.EncryptMsg 生成 100B ~ 64KB 的真实加密回调，分别测量
+VerifyURL / DecryptMsg / EncryptMsg / XMLParse.extract / WeChatMsgHandler._parse_wechat_msg
+的吞吐与延迟分位数，结果以 JSON 输出，可与之前的结果对比发现性能回退。
+
+用法：
+python bench/suite.py -o result.json
+python bench/suite.py -o new.json --baseline result.json --tolerance 0.15
+"""
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+
+from common import new_wxcpt, text_msg, make_callback, summarize
+from WXBizMsgCrypt3 import XMLParse
+from api.utils import WeChatMsgHandler
+
+SIZES = [100, 1024, 4096, 16384, 65536]
+
+
+def measure(func, duration, min_runs=50):
+    """在 duration 秒内反复调用 func，逐次记录耗时"""
+    latencies = []
+    clock = time.perf_counter
+    gc.collect()
+    start = clock()
+    deadline = start + duration
+    while True:
+        t0 = clock()
+        func()
+        t1 = clock()
+        latencies.append(t1 - t0)
+        if t1 >= deadline and len(latencies) >= min_runs:
+            break
+    return summarize(latencies, clock() - start)
+
+
+def build_cases(size):
+    """为某个消息大小准备各热点路径的调用"""
+    wxcpt = new_wxcpt()
+    handler = WeChatMsgHandler(wxcpt)
+    xml = text_msg(size)
+    body, signature, timestamp, nonce, encrypt = make_callback(wxcpt, xml)
+    ret, decrypted = wxcpt.DecryptMsg(body, signature, timestamp, nonce)
+    assert ret == 0 and decrypted.decode() == xml
+    tree_parse = XMLParse()
+    return {
+        'VerifyURL': lambda: wxcpt.VerifyURL(signature, timestamp, nonce, encrypt),
+        'DecryptMsg': lambda: wxcpt.DecryptMsg(body, signature, timestamp, nonce),
+        'EncryptMsg': lambda: wxcpt.EncryptMsg(xml, nonce, timestamp),
+        'XMLParse.extract': lambda: wxcpt.xmlParse.extract(body),
+        'XMLParse.extract[tree]': lambda: tree_parse.extract(body),
+        'WeChatMsgHandler._parse_wechat_msg': lambda: handler._parse_wechat_msg(xml),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """对比 p50 与吞吐，返回超过容忍度的回退项"""
+    regressions = []
+    for key, current in result['results'].items():
+        previous = baseline.get('results', {}).get(key)
+        if not previous:
+            continue
+        if current['p50_us'] > previous['p50_us'] * (1 + tolerance):
+            regressions.append(f"{key}: p50 {previous['p50_us']}us -> {current['p50_us']}us")
+        if current['ops_per_sec'] < previous['ops_per_sec'] * (1 - tolerance):
+            regressions.append(f"{key}: ops/s {previous['ops_per_sec']} -> {current['ops_per_sec']}")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--duration', '-d', default=0.5, type=float, help='每项测量的时长(秒)')
+    arg_parser.add_argument('--sizes', '-s', default=','.join(map(str, SIZES)), help='消息大小(字节)，逗号分隔')
+    arg_parser.add_argument('--only', default=None, help='只测量名称包含该字符串的项')
+    arg_parser.add_argument('--output', '-o', default=None, help='结果JSON文件，默认输出到标准输出')
+    arg_parser.add_argument('--baseline', '-b', default=None, help='对比用的历史结果JSON')
+    arg_parser.add_argument('--tolerance', default=0.15, type=float, help='允许的性能回退比例')
+    args = arg_parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    results = {}
+    for size in [int(s) for s in args.sizes.split(',')]:
+        for name, func in build_cases(size).items():
+            if args.only and args.only not in name:
+                continue
+            key = f"{name}@{size}"
+            results[key] = dict(measure(func, args.duration), op=name, size=size)
+            print(f"{key:45s} p50 {results[key]['p50_us']:9.2f}us  p99 {results[key]['p99_us']:9.2f}us"
+                  f"  {results[key]['ops_per_sec']:10.1f} ops/s", file=sys.stderr)
+
+    result = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'duration': args.duration,
+        'results': results,
+    }
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for item in regressions:
+            print("性能回退:", item, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
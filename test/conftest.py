@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+pytest 公共配置：把仓库根目录加入 sys.path，提供临时 SQLite 数据库
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """每个用例独立的数据库文件，避免改动仓库中的 wechat.db"""
+    return str(tmp_path / 'test.db')
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+AsyncRequestClient 的请求钩子：request/stream 与 RequestClient 一样记录状态码、响应大小、发出次数和各阶段耗时
+"""
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from api.api import AsyncRequestClient, ConnectionManager, RequestException, RequestHooks
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """/ok 返回固定内容，/flaky 第一次返回 503，/missing 返回 404"""
+
+    protocol_version = 'HTTP/1.1'
+    flaky_calls = 0
+
+    def do_GET(self):
+        if self.path.startswith('/flaky'):
+            type(self).flaky_calls += 1
+            if type(self).flaky_calls == 1:
+                return self._reply(503, b'busy')
+        if self.path.startswith('/missing'):
+            return self._reply(404, b'not found')
+        self._reply(200, b'x' * 1000)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._reply(200, 'data: 你好\n\ndata: [DONE]\n\n'.encode())
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def base_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def traced():
+    """(客户端, 记录到的 pre/post)"""
+    hooks = RequestHooks()
+    calls = {'pre': [], 'post': []}
+    hooks.add(pre=calls['pre'].append, post=calls['post'].append)
+    client = AsyncRequestClient(max_retries=2, backoff_factor=0.01, manager=ConnectionManager(), hooks=hooks)
+    return client, calls
+
+
+def _run(client, coro):
+    async def run():
+        try:
+            return await coro
+        finally:
+            await client.manager.aclose()
+    return asyncio.run(run())
+
+
+def test_request_trace(base_url, traced):
+    client, calls = traced
+    response = _run(client, client.get(base_url + '/ok?access_token=secret'))
+    assert response.status_code == 200
+    [pre] = calls['pre']
+    [trace] = calls['post']
+    assert pre is trace
+    assert (trace.method, trace.endpoint, trace.status, trace.bytes, trace.attempts, trace.error) == \
+        ('GET', '127.0.0.1:{}/ok'.format(base_url.rsplit(':', 1)[1]), 200, 1000, 1, None)
+    assert 'secret' not in trace.url
+    assert trace.connect > 0 and trace.ttfb > 0
+    assert trace.total >= trace.ttfb
+
+
+def test_request_trace_counts_retries(base_url, traced):
+    client, calls = traced
+    _run(client, client.get(base_url + '/flaky'))
+    [trace] = calls['post']
+    assert (trace.status, trace.attempts) == (200, 2)
+
+
+def test_request_trace_records_errors(base_url, traced):
+    client, calls = traced
+    with pytest.raises(RequestException):
+        _run(client, client.get(base_url + '/missing'))
+    [trace] = calls['post']
+    assert (trace.status, trace.error, trace.attempts) == (404, 'HTTPStatusError', 1)
+
+
+def test_stream_trace(base_url, traced):
+    client, calls = traced
+
+    async def read():
+        async with client.stream('POST', base_url + '/make/sse', json_data={'option': 'hi'}) as response:
+            # 退出 async with 之前不调用 post 钩子
+            assert calls['post'] == []
+            return [line async for line in response.aiter_lines()]
+
+    assert _run(client, read())[0] == 'data: 你好'
+    [trace] = calls['post']
+    assert (trace.method, trace.status, trace.attempts, trace.error) == ('POST', 200, 1, None)
+    assert trace.bytes == len('data: 你好\n\ndata: [DONE]\n\n'.encode())
+    assert trace.ttfb > 0 and trace.total >= trace.ttfb
+
+
+def test_no_hooks_no_trace(base_url):
+    client = AsyncRequestClient(manager=ConnectionManager(), hooks=RequestHooks())
+    assert _run(client, client.get(base_url + '/ok')).content == b'x' * 1000
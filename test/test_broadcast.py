@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+BroadcastStore / Broadcaster：同名任务复用、内容或接收者不同时拒绝、中断后只发送未完成的分片
+"""
+import asyncio
+
+import pytest
+
+from api.broadcast import (BroadcastConflict, BroadcastStore, Broadcaster, FAILED, SENT, chunk_recipients)
+
+USERS = [f'user{i}' for i in range(2500)]
+
+
+def test_chunk_recipients_respects_api_limits():
+    chunks = chunk_recipients(USERS + ['user0'], parties=[str(i) for i in range(150)], tags=['9'])
+    assert len(chunks) == 3
+    assert [len(chunk['touser'].split('|')) for chunk in chunks] == [1000, 1000, 500]
+    assert [chunk['toparty'].count('|') + 1 if chunk['toparty'] else 0 for chunk in chunks] == [100, 50, 0]
+    assert [chunk['totag'] for chunk in chunks] == ['9', '', '']
+
+
+def test_create_with_same_name_reuses_broadcast(db_path):
+    store = BroadcastStore(db_name=db_path)
+    chunks = chunk_recipients(USERS)
+    broadcast_id = store.create('维护通知', chunks, name='notice')
+    assert store.create('维护通知', chunk_recipients(USERS), name='notice') == broadcast_id
+    assert len(store.chunks(broadcast_id)) == 3
+
+
+def test_create_with_same_name_rejects_different_content(db_path):
+    store = BroadcastStore(db_name=db_path)
+    store.create('维护通知', chunk_recipients(USERS), name='notice')
+    with pytest.raises(BroadcastConflict, match='content'):
+        store.create('维护通知（已改期）', chunk_recipients(USERS), name='notice')
+
+
+def test_create_with_same_name_rejects_different_recipients(db_path):
+    store = BroadcastStore(db_name=db_path)
+    store.create('维护通知', chunk_recipients(USERS), name='notice')
+    with pytest.raises(BroadcastConflict, match='recipients'):
+        store.create('维护通知', chunk_recipients(USERS[:10]), name='notice')
+    # 不指定任务名时每次都新建
+    assert store.create('维护通知', chunk_recipients(USERS[:10])) != store.find('notice')
+
+
+def test_resume_sends_only_unfinished_chunks(db_path):
+    calls = []
+
+    async def send(content, touser, toparty, totag):
+        calls.append(touser.split('|')[0])
+        if touser.startswith('user1000') and len(calls) == 2:
+            return {'errcode': 45009, 'errmsg': 'api freq out of limit'}
+        if touser.startswith('user2000'):
+            return {'errcode': 40003, 'errmsg': 'invalid userid'}
+        return {'errcode': 0, 'errmsg': 'ok', 'invaliduser': 'user1'}
+
+    store = BroadcastStore(db_name=db_path)
+    broadcaster = Broadcaster(store=store, send=send, concurrency=1, retry_backoff=0)
+    report = asyncio.run(broadcaster.send('维护通知', USERS, name='notice'))
+    # 45009 重试后成功，40003 不重试
+    assert [chunk.status for chunk in report.chunks] == [SENT, SENT, FAILED]
+    assert [chunk.attempts for chunk in report.chunks] == [1, 2, 1]
+    assert report.to_dict()['invaliduser'] == ['user1']
+
+    calls.clear()
+    report = asyncio.run(broadcaster.send('维护通知', USERS, name='notice'))
+    assert calls == []
+    assert store.report(report.broadcast_id).to_dict()['sent'] == 2
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+CustomerCache：合并查询、每批不超过 100 个、无效客户缓存、失败不缓存、发起查询的调用方被取消时结束共用的结果
+"""
+import asyncio
+import threading
+
+import pytest
+
+from api.api import RequestException
+from api.customer import CustomerCache
+
+
+class FakeClock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _response(batch, invalid=()):
+    return {'errcode': 0, 'customer_list': [{'external_userid': external_userid, 'nickname': f'nick-{external_userid}'}
+                                            for external_userid in batch if external_userid not in invalid],
+            'invalid_external_userid': [external_userid for external_userid in batch if external_userid in invalid]}
+
+
+def test_batches_are_capped_at_100():
+    batches = []
+
+    def fetch(batch):
+        batches.append(list(batch))
+        return _response(batch)
+
+    cache = CustomerCache(fetch=fetch)
+    ids = [f'wm{i}' for i in range(250)]
+    result = cache.get_many(ids + ['wm0'])
+    assert [len(batch) for batch in batches] == [100, 100, 50]
+    assert result['wm249'].nickname == 'nick-wm249'
+    # 命中缓存后不再查询
+    cache.get_many(ids)
+    assert len(batches) == 3
+    assert cache.stats()['hits'] == 250
+
+
+def test_concurrent_async_callers_share_one_batch():
+    batches = []
+
+    async def afetch(batch):
+        batches.append(sorted(batch))
+        await asyncio.sleep(0.01)
+        return _response(batch)
+
+    cache = CustomerCache(afetch=afetch, batch_window=0.01)
+
+    async def scenario():
+        return await asyncio.gather(cache.aget_many(['wm1', 'wm2']), cache.aget_many(['wm2', 'wm3']),
+                                    cache.aget('wm1'))
+
+    first, second, third = asyncio.run(scenario())
+    # 第二个调用方在第一个调用方的 batch_window 内登记，wm2 只查询一次
+    assert batches == [['wm1', 'wm2', 'wm3']]
+    assert first['wm2'] is second['wm2']
+    assert third.nickname == 'nick-wm1'
+
+
+def test_concurrent_threads_wait_for_the_inflight_lookup():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch(batch):
+        calls.append(batch)
+        started.set()
+        release.wait(5)
+        return _response(batch)
+
+    cache = CustomerCache(fetch=fetch)
+    results = {}
+    fetcher = threading.Thread(target=lambda: results.setdefault('fetcher', cache.get('wm1')))
+    fetcher.start()
+    started.wait(5)
+    waiter = threading.Thread(target=lambda: results.setdefault('waiter', cache.get('wm1')))
+    waiter.start()
+    release.set()
+    fetcher.join(5)
+    waiter.join(5)
+    assert calls == [['wm1']]
+    assert results['fetcher'] is results['waiter']
+
+
+def test_invalid_customers_are_cached_for_negative_ttl():
+    clock = FakeClock()
+    batches = []
+
+    def fetch(batch):
+        batches.append(batch)
+        return _response(batch, invalid={'wm-gone'})
+
+    cache = CustomerCache(fetch=fetch, ttl=3600, negative_ttl=300, clock=clock)
+    assert cache.get_many(['wm1', 'wm-gone']) == {'wm1': cache.get('wm1'), 'wm-gone': None}
+    clock.now += 299
+    assert cache.get('wm-gone') is None
+    assert len(batches) == 1
+    clock.now += 1
+    cache.get('wm-gone')
+    assert batches[-1] == ['wm-gone']
+    # 有效客户的缓存还没过期
+    cache.get('wm1')
+    assert len(batches) == 2
+
+
+def test_lru_eviction():
+    cache = CustomerCache(fetch=_response, max_size=2)
+    cache.get('wm1')
+    cache.get('wm2')
+    cache.get('wm1')
+    cache.get('wm3')
+    assert cache.stats()['evictions'] == 1
+    assert set(cache._entries) == {'wm1', 'wm3'}
+
+
+def test_failures_are_not_cached():
+    attempts = []
+
+    def fetch(batch):
+        attempts.append(batch)
+        if len(attempts) == 1:
+            raise RequestException('kf/customer/batchget failed')
+        return _response(batch)
+
+    cache = CustomerCache(fetch=fetch)
+    with pytest.raises(RequestException):
+        cache.get('wm1')
+    assert cache.get('wm1').nickname == 'nick-wm1'
+    assert cache.stats()['inflight'] == 0
+
+
+def test_cancelled_fetcher_releases_waiters():
+    calls = []
+
+    async def afetch(batch):
+        calls.append(batch)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return _response(batch)
+
+    cache = CustomerCache(afetch=afetch)
+
+    async def scenario():
+        fetcher = asyncio.ensure_future(cache.aget('wm1'))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.ensure_future(cache.aget('wm1'))
+        await asyncio.sleep(0.01)
+        fetcher.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await fetcher
+        # 等待同一个客户的调用方收到 RequestException，而不是一直等下去
+        with pytest.raises(RequestException, match='aborted'):
+            await asyncio.wait_for(waiter, 1)
+        assert cache.stats()['inflight'] == 0
+        return await cache.aget('wm1')
+
+    assert asyncio.run(scenario()).nickname == 'nick-wm1'
+    assert calls == [['wm1'], ['wm1']]
+
+
+def test_cancelled_waiter_does_not_cancel_shared_result():
+    async def afetch(batch):
+        await asyncio.sleep(0.05)
+        return _response(batch)
+
+    cache = CustomerCache(afetch=afetch)
+
+    async def scenario():
+        fetcher = asyncio.ensure_future(cache.aget('wm1'))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.ensure_future(cache.aget('wm1'))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        return await fetcher
+
+    assert asyncio.run(scenario()).nickname == 'nick-wm1'
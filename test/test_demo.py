@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+_test_make：熔断器只统计 make.com 本身，发给客户失败不打开熔断器，也不经同一条路径发送默认回复
+"""
+import asyncio
+
+import pytest
+
+from api import demo
+from api.api import RequestException
+from api.breaker import CLOSED, OPEN
+
+
+class _FakeStream:
+    """async_client.stream 返回的响应，逐块返回 chunks，遇到异常实例时抛出，遇到数字时等待相应秒数"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.headers = {}
+        self.encoding = None
+        self.closed_reader = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def aiter_text(self):
+        try:
+            for chunk in self.chunks:
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                if isinstance(chunk, float):
+                    await asyncio.sleep(chunk)
+                    continue
+                yield chunk
+        finally:
+            self.closed_reader = True
+
+
+@pytest.fixture
+def make(monkeypatch):
+    """流式读取 make.com，熔断器连续失败 1 次即打开，记录发给客户的消息"""
+    state = type('MakeState', (), {})()
+    state.breaker = demo.CircuitBreaker('test_make', failure_threshold=1, recovery_timeout=60)
+    state.sent = []
+    state.send_error = None
+    state.chunks = []
+
+    async def send_kf_text(touser, open_kfid, content, key):
+        if state.send_error is not None:
+            raise state.send_error
+        state.sent.append((touser, open_kfid, content, key))
+
+    async def no_profile(external_userid):
+        return None
+
+    monkeypatch.setattr(demo, 'make_breaker', state.breaker)
+    monkeypatch.setattr(demo, 'make_stream', True)
+    monkeypatch.setattr(demo, 'asend_kf_text', send_kf_text)
+    monkeypatch.setattr(demo.customer_cache, 'aget', no_profile)
+    def stream(method, url, json_data=None, timeout=None):
+        state.response = _FakeStream(state.chunks)
+        return state.response
+
+    monkeypatch.setattr(demo.async_client, 'stream', stream)
+    return state
+
+
+def test_stream_reply_is_sent_by_sentence(make):
+    make.chunks = ['您好，', '请问有什么', '可以帮您？我们', '在线。']
+    assert asyncio.run(demo._test_make('wm1', 'm1', 'kf1', '你好')) == '您好，请问有什么可以帮您？我们在线。'
+    assert [content for _, _, content, _ in make.sent] == ['您好，请问有什么可以帮您？', '我们在线。']
+    assert [key for _, _, _, key in make.sent] == ['reply:m1', 'reply:m1:1']
+    assert make.breaker.state == CLOSED
+
+
+def test_make_failure_opens_breaker_and_sends_fallback(make):
+    make.chunks = [RequestException('make.com reset')]
+    assert asyncio.run(demo._test_make('wm1', 'm1', 'kf1', '你好')) == demo.FALLBACK_REPLY
+    assert make.sent == [('wm1', 'kf1', demo.FALLBACK_REPLY, 'reply:m1')]
+    assert make.breaker.state == OPEN
+
+
+def test_kf_send_failure_does_not_open_breaker(make):
+    make.chunks = ['您好，请问有什么可以帮您？', '我们在线。']
+    make.send_error = RequestException('kf/send_msg 45033')
+    with pytest.raises(RequestException, match='45033'):
+        asyncio.run(demo._test_make('wm1', 'm1', 'kf1', '你好'))
+    # 发送失败时不再经 kf/send_msg 发送默认回复，make.com 仍然可用
+    assert make.sent == []
+    assert make.breaker.state == CLOSED
+    assert demo.make_bulkhead.inflight == 0
+
+
+def test_customer_lookup_error_does_not_block_reply(make, monkeypatch):
+    async def broken_profile(external_userid):
+        raise KeyError('external_userid')
+
+    monkeypatch.setattr(demo.customer_cache, 'aget', broken_profile)
+    make.chunks = ['您好。']
+    assert asyncio.run(demo._test_make('wm1', 'm1', 'kf1', '你好')) == '您好。'
+    assert [content for _, _, content, _ in make.sent] == ['您好。']
+
+
+def test_stream_deadline_covers_the_whole_answer(make, monkeypatch):
+    monkeypatch.setattr(demo, 'make_deadline', 0.2)
+    # 相邻两块的间隔都小于截止时间，但整个回答超过截止时间
+    make.chunks = ['第一句。', 0.12, '第二句。', 0.12, '第三句。']
+    assert asyncio.run(demo._test_make('wm1', 'm1', 'kf1', '你好')) == '第一句。第二句。'
+    # 已经发出的部分保留，不再发送默认回复
+    assert [content for _, _, content, _ in make.sent] == ['第一句。', '第二句。']
+    assert make.breaker.state == OPEN
+    assert make.response.closed_reader
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+WeChatMsgHandler._route：应用文本消息交给 make.com 回复，回答通过 message/send 发给成员
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from WXBizMsgCrypt3 import WXBizMsgCrypt
+from api import config, demo
+from api.api import RequestException
+from api.utils import WeChatMsgHandler
+
+TOKEN = 'K0p31BNNXyqRCtbupNuURNVu'
+AESKEY = 'VlistlBRh3A7ent3S3rq6A1WYHoyjEuqIU01GeuLzK9'
+
+TEXT_MSG = {'ToUserName': config.CORPID, 'FromUserName': 'zhangsan', 'CreateTime': '1700000000',
+            'MsgType': 'text', 'Content': ' 你好 ', 'MsgId': '7001', 'AgentID': '1000005'}
+
+
+class _RecordingDispatcher:
+    """只记录 spawn 的协程，由用例自己运行"""
+
+    def __init__(self):
+        self.spawned = []
+
+    def spawn(self, coro):
+        self.spawned.append(coro)
+
+
+@pytest.fixture
+def handler():
+    return WeChatMsgHandler(WXBizMsgCrypt(TOKEN, AESKEY, config.CORPID), dispatcher=_RecordingDispatcher())
+
+
+@pytest.fixture
+def app_sends(monkeypatch):
+    sent = []
+
+    async def send_msg(username, content):
+        sent.append((username, content))
+
+    async def send_kf_text(*args):
+        raise AssertionError('app message replied through kf/send_msg')
+
+    monkeypatch.setattr(demo, '_send_msg', send_msg)
+    monkeypatch.setattr(demo, 'asend_kf_text', send_kf_text)
+    monkeypatch.setattr(demo, 'make_stream', False)
+    monkeypatch.setattr(demo, 'make_breaker', demo.CircuitBreaker('test_make', failure_threshold=5))
+    return sent
+
+
+def test_text_message_replies_through_message_send(handler, app_sends, monkeypatch):
+    requests = []
+
+    async def post(url, json_data=None, timeout=None):
+        requests.append(json_data)
+        return SimpleNamespace(text='您好，请问有什么可以帮您？', encoding=None)
+
+    monkeypatch.setattr(demo.async_client, 'post', post)
+    assert handler._route(dict(TEXT_MSG)) == '正在响应中,请耐心等待...'
+    [coro] = handler.dispatcher.spawned
+    assert asyncio.run(coro) == '您好，请问有什么可以帮您？'
+    # 应用消息的发送者是成员，不查询客户信息
+    assert requests == [{'name': 'zhangsan', 'option': '你好'}]
+    assert app_sends == [('zhangsan', '您好，请问有什么可以帮您？')]
+
+
+def test_text_message_falls_back_when_make_fails(handler, app_sends, monkeypatch):
+    async def post(url, json_data=None, timeout=None):
+        raise RequestException('make.com unavailable')
+
+    monkeypatch.setattr(demo.async_client, 'post', post)
+    handler._route(dict(TEXT_MSG))
+    [coro] = handler.dispatcher.spawned
+    assert asyncio.run(coro) == demo.FALLBACK_REPLY
+    assert app_sends == [('zhangsan', demo.FALLBACK_REPLY)]
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+JobQueue / JobWorkerPool：批量领取、可见性超时、退避重试、dead 和去重
+"""
+import threading
+import time
+
+from api.jobqueue import JobQueue, JobWorkerPool
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _queue(db_path, clock=None, **kwargs):
+    return JobQueue(db_name=db_path, clock=clock or FakeClock(), **kwargs)
+
+
+def test_claim_hides_jobs_until_visibility_timeout(db_path):
+    clock = FakeClock()
+    queue = _queue(db_path, clock, visibility_timeout=30)
+    job_id = queue.enqueue('ai_reply', {'msg_id': 'm1'})
+    [job] = queue.claim(limit=10)
+    assert (job.id, job.kind, job.payload, job.attempts) == (job_id, 'ai_reply', {'msg_id': 'm1'}, 1)
+    assert queue.claim(limit=10) == []
+    assert queue.stats()['inflight'] == 1
+
+    # 领取后未确认(工作线程崩溃)，超时后重新可见
+    clock.now += 30
+    [again] = queue.claim(limit=10)
+    assert (again.id, again.attempts) == (job_id, 2)
+    queue.ack(again)
+    clock.now += 60
+    assert queue.claim(limit=10) == []
+    assert queue.stats()['depth'] == 0
+
+
+def test_claim_respects_limit_and_order(db_path):
+    clock = FakeClock()
+    queue = _queue(db_path, clock)
+    ids = [queue.enqueue('wechat_msg', index) for index in range(5)]
+    delayed = queue.enqueue('wechat_msg', 'later', delay=10)
+    assert [job.id for job in queue.claim(limit=3)] == ids[:3]
+    assert [job.id for job in queue.claim(limit=3)] == ids[3:]
+    clock.now += 10
+    assert [job.id for job in queue.claim(limit=3)] == [delayed]
+
+
+def test_concurrent_claims_never_share_a_job(db_path):
+    _queue(db_path).enqueue_many('wechat_msg', [(index, None) for index in range(200)])
+    claimed = []
+    lock = threading.Lock()
+
+    def worker():
+        # 每个线程使用自己的 JobQueue(连接)，模拟多进程争抢同一个数据库
+        queue = _queue(db_path)
+        while True:
+            jobs = queue.claim(limit=7)
+            if not jobs:
+                return
+            with lock:
+                claimed.extend(job.id for job in jobs)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(claimed) == len(set(claimed)) == 200
+
+
+def test_retry_backs_off_then_marks_dead(db_path):
+    clock = FakeClock()
+    queue = _queue(db_path, clock, max_attempts=3, retry_backoff=2.0)
+    job_id = queue.enqueue('ai_reply', {})
+    for attempt in (1, 2):
+        [job] = queue.claim()
+        assert job.attempts == attempt
+        queue.retry(job, 'boom')
+        # 第 n 次失败后等待 retry_backoff ** n 秒
+        clock.now += 2.0 ** attempt - 0.5
+        assert queue.claim() == []
+        clock.now += 0.5
+    [job] = queue.claim()
+    assert job.attempts == 3
+    queue.retry(job, 'boom')
+    clock.now += 3600
+    assert queue.claim() == []
+    stats = queue.stats()
+    assert (stats['depth'], stats['dead']) == (0, 1)
+    row = queue._helper().cursor.execute(
+        f"SELECT status, last_error FROM {queue.table} WHERE id = ?", (job_id,)).fetchone()
+    assert row == ('dead', 'boom')
+
+
+def test_dedup_key(db_path):
+    queue = _queue(db_path)
+    assert queue.enqueue('wechat_msg', 1, dedup_key='msg:1') is not None
+    assert queue.enqueue('wechat_msg', 1, dedup_key='msg:1') is None
+    assert queue.enqueue_many('ai_reply', [(1, 'msg:1'), (2, 'msg:2'), (3, None)]) == 2
+    assert queue.stats()['depth'] == 3
+
+
+def test_worker_pool_acks_and_retries(db_path):
+    queue = JobQueue(db_name=db_path, retry_backoff=0, max_attempts=2)
+    handled = []
+
+    def handle(payload):
+        handled.append(payload)
+        if payload == 'bad':
+            raise ValueError(payload)
+
+    pool = JobWorkerPool(queue, {'ai_reply': handle}, workers=2, poll_interval=0.05)
+    queue.enqueue('ai_reply', 'bad')
+    queue.enqueue('ai_reply', 'good')
+    queue.enqueue('unknown', 'orphan')
+    pool.start()
+    try:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and queue.stats()['dead'] < 2:
+            time.sleep(0.02)
+    finally:
+        pool.stop()
+    # bad 尝试 max_attempts 次后 dead，没有处理函数的任务同样 dead，good 完成后删除
+    assert sorted(handled) == ['bad', 'bad', 'good']
+    stats = queue.stats()
+    assert (stats['depth'], stats['dead']) == (0, 2)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+KfSyncEngine / CursorStore：交接(enqueue_many)成功后才保存 cursor、预取下一页、租约续期和旧版 cursor
+"""
+import sqlite3
+import threading
+
+import pytest
+
+from api.jobqueue import JobQueue
+from api.kfsync import CursorStore, KfSyncEngine
+
+
+class FakeSyncMsg:
+    """按 cursor 返回预先准备好的 kf/sync_msg 页，记录每次请求的 cursor"""
+
+    def __init__(self, pages):
+        # pages: {cursor: (next_cursor, msgids, has_more)}
+        self.pages = pages
+        self.calls = []
+        self.fetched = {}
+
+    def __call__(self, cursor, open_kfid, token, limit):
+        self.calls.append(cursor)
+        self.fetched.setdefault(cursor, threading.Event()).set()
+        if cursor not in self.pages:
+            return {'errcode': 95018, 'errmsg': 'invalid cursor'}
+        next_cursor, msgids, has_more = self.pages[cursor]
+        return {'errcode': 0, 'errmsg': 'ok', 'next_cursor': next_cursor, 'has_more': int(has_more),
+                'msg_list': [{'msgid': msgid, 'open_kfid': open_kfid} for msgid in msgids]}
+
+    def wait_fetched(self, cursor, timeout=2.0):
+        return self.fetched.setdefault(cursor, threading.Event()).wait(timeout)
+
+
+PAGES = {
+    '': ('c1', ['m1', 'm2'], True),
+    'c1': ('c2', ['m3'], True),
+    'c2': ('c3', ['m4', 'm5'], False),
+}
+
+
+def _engine(db_path, fetch, handoff, **kwargs):
+    return KfSyncEngine(handoff=handoff, fetch=fetch, store=CursorStore(db_name=db_path), **kwargs)
+
+
+def _enqueue_handoff(queue, store, seen):
+    """与 WechatMsgHandler 一样把每页消息交给 enqueue_many，同时记录交接时已保存的 cursor"""
+    def handoff(open_kfid, msg_list):
+        seen.append(store.load(open_kfid))
+        queue.enqueue_many('ai_reply', [({'msg_id': item['msgid']}, f"ai_reply:{item['msgid']}")
+                                        for item in msg_list])
+    return handoff
+
+
+def test_cursor_saved_after_each_page_is_enqueued(db_path):
+    queue = JobQueue(db_name=db_path)
+    store = CursorStore(db_name=db_path)
+    seen = []
+    fetch = FakeSyncMsg(PAGES)
+    engine = KfSyncEngine(handoff=_enqueue_handoff(queue, store, seen), fetch=fetch, store=store)
+    stats = engine.sync('kf1', 'token')
+    assert (stats['pages'], stats['messages']) == (3, 5)
+    assert 'error' not in stats
+    assert fetch.calls == ['', 'c1', 'c2']
+    # 交接某一页时 cursor 还停在上一页
+    assert seen == ['', 'c1', 'c2']
+    assert store.load('kf1') == 'c3'
+    assert queue.stats()['depth'] == 5
+
+
+def test_enqueue_failure_keeps_cursor_and_resync_dedups(db_path, monkeypatch):
+    queue = JobQueue(db_name=db_path)
+    store = CursorStore(db_name=db_path)
+    fetch = FakeSyncMsg(PAGES)
+    engine = KfSyncEngine(handoff=_enqueue_handoff(queue, store, []), fetch=fetch, store=store)
+    enqueue_many = queue.enqueue_many
+
+    def fail_on_second_page(kind, items, delay=0):
+        if items[0][1] == 'ai_reply:m3':
+            # 模拟写入一半后事务失败：m3 已落盘但 cursor 不能前进
+            enqueue_many(kind, items, delay)
+            raise sqlite3.OperationalError('database is locked')
+        return enqueue_many(kind, items, delay)
+
+    monkeypatch.setattr(queue, 'enqueue_many', fail_on_second_page)
+    with pytest.raises(sqlite3.OperationalError):
+        engine.sync('kf1', 'token')
+    assert store.load('kf1') == 'c1'
+
+    # 下一次同步从 c1 重新拉取，重复交接的 m3 由去重键去重
+    monkeypatch.setattr(queue, 'enqueue_many', enqueue_many)
+    fetch.calls.clear()
+    stats = engine.sync('kf1', 'token')
+    assert fetch.calls == ['c1', 'c2']
+    assert (stats['pages'], stats['messages']) == (2, 3)
+    assert store.load('kf1') == 'c3'
+    assert queue.stats()['depth'] == 5
+
+
+def test_next_page_is_prefetched_during_handoff(db_path):
+    fetch = FakeSyncMsg(PAGES)
+    prefetched = []
+
+    def handoff(open_kfid, msg_list):
+        if msg_list[0]['msgid'] == 'm1':
+            # 第一页交接还没返回时下一页的请求已经发出
+            prefetched.append(fetch.wait_fetched('c1'))
+
+    stats = _engine(db_path, fetch, handoff).sync('kf1', 'token')
+    assert prefetched == [True]
+    assert stats['pages'] == 3
+
+
+def test_lease_lost_stops_before_handoff(db_path):
+    fetch = FakeSyncMsg(PAGES)
+    handed = []
+    renewals = iter([True, False])
+    engine = _engine(db_path, fetch, lambda open_kfid, msg_list: handed.extend(msg_list))
+    stats = engine.sync('kf1', 'token', renew=lambda: next(renewals))
+    assert stats['error'] == 'lease lost'
+    assert [item['msgid'] for item in handed] == ['m1', 'm2']
+    # 第二页没有交接，cursor 停在第一页之后
+    assert engine.store.load('kf1') == 'c1'
+
+
+def test_fetch_error_keeps_cursor(db_path):
+    pages = dict(PAGES)
+    del pages['c1']
+    handed = []
+    engine = _engine(db_path, FakeSyncMsg(pages), lambda open_kfid, msg_list: handed.extend(msg_list))
+    stats = engine.sync('kf1', 'token')
+    assert stats['error'].startswith('kf/sync_msg failed')
+    assert (stats['pages'], len(handed)) == (1, 2)
+    assert engine.store.load('kf1') == 'c1'
+
+
+def test_max_pages_leaves_rest_for_next_sync(db_path):
+    fetch = FakeSyncMsg(PAGES)
+    engine = _engine(db_path, fetch, lambda open_kfid, msg_list: None, max_pages=2)
+    assert engine.sync('kf1', 'token')['pages'] == 2
+    assert fetch.calls == ['', 'c1']
+    assert engine.store.load('kf1') == 'c2'
+
+
+def test_cursor_store_falls_back_to_legacy_table(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE cursors (id INTEGER PRIMARY KEY AUTOINCREMENT, value TEXT)")
+    conn.executemany("INSERT INTO cursors (value) VALUES (?)", [('old1',), ('old2',)])
+    conn.commit()
+    conn.close()
+    store = CursorStore(db_name=db_path)
+    assert store.load('kf1') == 'old2'
+    store.save('kf1', 'new1')
+    assert store.load('kf1') == 'new1'
+    # 其他客服账号仍沿用旧版 cursor
+    assert store.load('kf2') == 'old2'
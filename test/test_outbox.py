@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Outbox / OutboxWorkerPool：同一客户按入队顺序逐条发送、可重试错误码、dead、去重和可见性超时
+"""
+import threading
+import time
+
+import pytest
+
+from api import outbox as outbox_module
+from api.outbox import RETRY_ERRCODES, Outbox, OutboxWorkerPool, make_msgid, send_kf_texts
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _outbox(db_path, clock=None, **kwargs):
+    return Outbox(db_name=db_path, clock=clock or FakeClock(), **kwargs)
+
+
+def _ok(*args):
+    return {'errcode': 0, 'errmsg': 'ok'}
+
+
+def _status(outbox, message_id):
+    return outbox._helper().cursor.execute(
+        f"SELECT status, attempts, last_error FROM {outbox.table} WHERE id = ?", (message_id,)).fetchone()
+
+
+def test_one_message_per_customer_in_enqueue_order(db_path):
+    outbox = _outbox(db_path)
+    a1 = outbox.enqueue('kf1', 'wmA', '处理中...', 'ack:1')
+    a2 = outbox.enqueue('kf1', 'wmA', 'AI 回复', 'reply:1')
+    b1 = outbox.enqueue('kf1', 'wmB', '处理中...', 'ack:2')
+    # 另一个客服账号下的同一客户单独排序
+    c1 = outbox.enqueue('kf2', 'wmA', '处理中...', 'ack:3')
+    claimed = {message.id: message for message in outbox.claim(limit=10)}
+    assert sorted(claimed) == [a1, b1, c1]
+    # 领取中的消息未完成前，该客户的下一条不会被领取
+    assert outbox.claim(limit=10) == []
+    outbox.deliver(claimed[a1], _ok)
+    assert [message.id for message in outbox.claim(limit=10)] == [a2]
+
+
+def test_next_message_waits_for_retry_of_previous(db_path):
+    clock = FakeClock()
+    outbox = _outbox(db_path, clock, retry_backoff=2.0)
+    a1 = outbox.enqueue('kf1', 'wmA', 'first', 'k1')
+    a2 = outbox.enqueue('kf1', 'wmA', 'second', 'k2')
+    [message] = outbox.claim()
+    assert not outbox.deliver(message, lambda *args: {'errcode': 45033, 'errmsg': 'busy'})
+    clock.now += 1.9
+    assert outbox.claim() == []
+    clock.now += 0.1
+    [message] = outbox.claim()
+    assert (message.id, message.attempts) == (a1, 2)
+    assert outbox.deliver(message, _ok)
+    [message] = outbox.claim()
+    assert message.id == a2
+
+
+@pytest.mark.parametrize('errcode', RETRY_ERRCODES)
+def test_retryable_errcodes(db_path, errcode):
+    outbox = _outbox(db_path)
+    message_id = outbox.enqueue('kf1', 'wmA', 'hi', 'k1')
+    [message] = outbox.claim()
+    assert not outbox.deliver(message, lambda *args: {'errcode': errcode, 'errmsg': 'retry'})
+    assert _status(outbox, message_id) == ('ready', 1, f'{errcode} retry')
+
+
+def test_request_errors_are_retried(db_path):
+    outbox = _outbox(db_path)
+    message_id = outbox.enqueue('kf1', 'wmA', 'hi', 'k1')
+    [message] = outbox.claim()
+
+    def send(*args):
+        raise ConnectionError('reset')
+
+    assert not outbox.deliver(message, send)
+    assert _status(outbox, message_id)[:2] == ('ready', 1)
+
+
+def test_other_errcodes_are_dead_and_unblock_the_customer(db_path):
+    outbox = _outbox(db_path)
+    first = outbox.enqueue('kf1', 'wmA', 'hi', 'k1')
+    second = outbox.enqueue('kf1', 'wmA', 'again', 'k2')
+    [message] = outbox.claim()
+    assert not outbox.deliver(message, lambda *args: {'errcode': 95018, 'errmsg': 'session closed'})
+    assert _status(outbox, first) == ('dead', 1, '95018 session closed')
+    assert [message.id for message in outbox.claim()] == [second]
+    assert outbox.stats()['dead'] == 1
+
+
+def test_dead_after_max_attempts(db_path):
+    clock = FakeClock()
+    outbox = _outbox(db_path, clock, max_attempts=3, retry_backoff=1.0)
+    message_id = outbox.enqueue('kf1', 'wmA', 'hi', 'k1')
+    for _ in range(3):
+        clock.now += 10
+        [message] = outbox.claim()
+        outbox.deliver(message, lambda *args: {'errcode': -1, 'errmsg': 'system busy'})
+    assert _status(outbox, message_id) == ('dead', 3, '-1 system busy')
+
+
+def test_same_key_is_enqueued_once_with_stable_msgid(db_path):
+    clock = FakeClock()
+    outbox = _outbox(db_path, clock, visibility_timeout=60)
+    assert outbox.enqueue('kf1', 'wmA', 'hi', 'reply:1') is not None
+    assert outbox.enqueue('kf1', 'wmA', 'hi', 'reply:1') is None
+    assert outbox.enqueue_many([('kf1', 'wmA', 'hi', 'reply:1'), ('kf1', 'wmB', 'hi', 'reply:2')]) == 1
+    [first, _] = sorted(outbox.claim(), key=lambda message: message.id)
+    assert first.msgid == make_msgid('reply:1') and len(first.msgid) == 32
+    # 领取后未完成(工作线程崩溃)，可见性超时后以相同的 msgid 重新领取
+    clock.now += 60
+    [again] = [message for message in outbox.claim() if message.id == first.id]
+    assert (again.msgid, again.attempts) == (first.msgid, 2)
+
+
+def test_purge_keeps_recent_sent_messages(db_path):
+    clock = FakeClock()
+    outbox = _outbox(db_path, clock, retention=100)
+    outbox.enqueue('kf1', 'wmA', 'hi', 'k1')
+    [message] = outbox.claim()
+    outbox.deliver(message, _ok)
+    assert outbox.purge() == 0
+    clock.now += 101
+    assert outbox.purge() == 1
+    # 超过保留时间后相同的业务键可以再次入队
+    assert outbox.enqueue('kf1', 'wmA', 'hi', 'k1') is not None
+
+
+def test_worker_pool_sends_each_customer_in_order(db_path, monkeypatch):
+    outbox = Outbox(db_name=db_path)
+    sent = []
+    lock = threading.Lock()
+
+    def send(touser, open_kfid, content, msgid):
+        time.sleep(0.001)
+        with lock:
+            sent.append((touser, content))
+        return {'errcode': 0}
+
+    monkeypatch.setattr(outbox_module, 'outbox', outbox)
+    send_kf_texts([(f'wm{i % 3}', 'kf1', str(i), f'k{i}') for i in range(30)])
+    pool = OutboxWorkerPool(outbox, send=send, workers=3, poll_interval=0.05)
+    pool.start()
+    try:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and outbox.stats()['depth']:
+            time.sleep(0.02)
+    finally:
+        pool.stop()
+    assert len(sent) == 30
+    for customer in range(3):
+        contents = [int(content) for touser, content in sent if touser == f'wm{customer}']
+        assert contents == sorted(contents)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+TokenBucket / RateLimiter：负余额排队(FIFO)、多维度预约、取消时归还预约
+"""
+import asyncio
+
+import pytest
+
+from api.ratelimit import RateLimiter, TokenBucket, parse_limit
+
+SEND_MSG_URL = 'https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token=abc'
+
+
+class FakeClock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_queues_callers_in_reservation_order():
+    bucket = TokenBucket(rate=2.0, burst=2, now=0.0)
+    # 突发容量内不等待，之后每次预约比上一次多等 1/rate 秒
+    assert [bucket.reserve(0.0) for _ in range(5)] == [0.0, 0.0, 0.5, 1.0, 1.5]
+    # 余额为负时补充的令牌先还给排在前面的预约
+    assert bucket.reserve(1.0) == pytest.approx(1.0)
+
+
+def test_bucket_refill_is_capped_at_burst():
+    bucket = TokenBucket(rate=1.0, burst=3, now=0.0)
+    assert bucket.reserve(0.0) == 0.0
+    assert bucket.idle(1000.0)
+    assert [bucket.reserve(1000.0) for _ in range(4)] == [0.0, 0.0, 0.0, 1.0]
+
+
+def test_bucket_cancel_refunds_reservation():
+    bucket = TokenBucket(rate=1.0, burst=1, now=0.0)
+    assert bucket.reserve(0.0) == 0.0
+    assert bucket.reserve(0.0) == 1.0
+    bucket.cancel(0.0)
+    assert bucket.reserve(0.0) == 1.0
+    # 归还不会超过突发容量
+    for _ in range(5):
+        bucket.cancel(0.0)
+    assert [bucket.reserve(0.0) for _ in range(2)] == [0.0, 1.0]
+
+
+def test_limiter_waits_for_the_slowest_matching_bucket():
+    limiter = RateLimiter({'*': {'corp': (10.0, 1)}, 'kf/send_msg': {'external_userid': (1.0, 1)}},
+                          clock=FakeClock())
+    keys = {'corp': 'ww1', 'external_userid': 'wm1'}
+    assert limiter.reserve('kf/send_msg', keys)[0] == 0.0
+    wait, reserved = limiter.reserve('kf/send_msg', keys)
+    assert len(reserved) == 2 and wait == pytest.approx(1.0)
+    # 不同客户各自计数，企业维度的令牌桶共用
+    assert limiter.reserve('kf/send_msg', {'corp': 'ww1', 'external_userid': 'wm2'})[0] == pytest.approx(0.2)
+    # '*' 规则按接口分别计数
+    assert limiter.reserve('message/send', {'corp': 'ww1'})[0] == 0.0
+
+
+def test_configure_replaces_and_removes_limits():
+    limiter = RateLimiter({'kf/send_msg': {'external_userid': (1.0, 1)}}, clock=FakeClock())
+    keys = {'external_userid': 'wm1'}
+    limiter.reserve('kf/send_msg', keys)
+    limiter.configure('kf/send_msg', 'external_userid', rate=1.0, burst=3)
+    assert [limiter.reserve('kf/send_msg', keys)[0] for _ in range(3)] == [0.0, 0.0, 0.0]
+    limiter.configure('kf/send_msg', 'external_userid', rate=0, burst=0)
+    assert limiter.reserve('kf/send_msg', keys) == (0.0, [])
+
+
+def test_aacquire_cancelled_while_waiting_refunds_its_slot():
+    clock = FakeClock()
+    limiter = RateLimiter({'kf/send_msg': {'external_userid': (1.0, 1)}}, clock=clock)
+    keys = {'external_userid': 'wm1'}
+
+    async def scenario():
+        assert await limiter.aacquire(SEND_MSG_URL, keys) == 0.0
+        waiter = asyncio.ensure_future(limiter.aacquire(SEND_MSG_URL, keys))
+        await asyncio.sleep(0.01)
+        assert limiter.waiting() == {('kf/send_msg',): 1}
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.waiting() == {('kf/send_msg',): 0}
+
+    asyncio.run(scenario())
+    # 被取消的预约已归还，下一个调用方只需等待第一次调用之后的 1 秒，而不是 2 秒
+    assert limiter.reserve('kf/send_msg', keys)[0] == pytest.approx(1.0)
+
+
+def test_endpoint_of_and_parse_limit():
+    assert RateLimiter.endpoint_of(SEND_MSG_URL) == 'kf/send_msg'
+    assert RateLimiter.endpoint_of('http://127.0.0.1:9000/make/webhook') == '127.0.0.1:9000/make/webhook'
+    assert parse_limit('kf/send_msg:external_userid=0.5/5') == ('kf/send_msg', 'external_userid', 0.5, 5)
+    assert parse_limit('*:corp=150') == ('*', 'corp', 150.0, 150)
+    with pytest.raises(ValueError):
+        parse_limit('kf/send_msg')
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+TenantRegistry：其他进程新增的租户在查找不到时重新加载，异步查找的数据库读取不在事件循环中进行
+"""
+import asyncio
+import logging
+import threading
+
+from api.sql import SQLiteHelper
+from api.tenant import TENANT_TABLE, TenantRegistry
+
+CORPID = 'ww4ede9a36781c6e1c'
+TOKEN = 'K0p31BNNXyqRCtbupNuURNVu'
+AESKEY = 'VlistlBRh3A7ent3S3rq6A1WYHoyjEuqIU01GeuLzK9'
+
+
+def _registry(db_path, reload_interval=0.0):
+    return TenantRegistry(lambda wxcpt, name: name, db_name=db_path, reload_interval=reload_interval)
+
+
+def test_get_reloads_tenants_added_elsewhere(db_path):
+    registry = _registry(db_path)
+    assert registry.get('acme') is None
+    _registry(db_path).add('acme', CORPID, TOKEN, AESKEY)
+    tenant = registry.get('acme')
+    assert tenant.handler == 'acme'
+    assert registry.get_by_corpid(CORPID) is tenant
+
+
+def test_reload_keeps_unchanged_tenants(db_path):
+    registry = _registry(db_path)
+    tenant = registry.add('acme', CORPID, TOKEN, AESKEY)
+    registry.reload()
+    assert registry.get('acme') is tenant
+
+
+def test_aget_reloads_in_worker_thread(db_path, monkeypatch):
+    registry = _registry(db_path)
+    _registry(db_path).add('acme', CORPID, TOKEN, AESKEY)
+    reload_threads = []
+    reload = registry.reload
+    monkeypatch.setattr(registry, 'reload', lambda: (reload_threads.append(threading.current_thread()), reload()))
+
+    async def lookup():
+        return await registry.aget('acme'), await registry.aget_by_corpid(CORPID)
+
+    by_name, by_corpid = asyncio.run(lookup())
+    assert by_name is by_corpid is not None
+    assert reload_threads and threading.main_thread() not in reload_threads
+
+
+def test_aget_hit_does_not_reload(db_path, monkeypatch):
+    registry = _registry(db_path, reload_interval=0.0)
+    tenant = registry.add('acme', CORPID, TOKEN, AESKEY, persist=False)
+    monkeypatch.setattr(registry, 'reload', lambda: (_ for _ in ()).throw(AssertionError('reloaded')))
+    assert asyncio.run(registry.aget('acme')) is tenant
+
+
+def test_invalid_tenant_is_logged(db_path, caplog):
+    _registry(db_path).add('acme', CORPID, TOKEN, AESKEY)
+    registry = _registry(db_path)
+    db_helper = SQLiteHelper(db_path)
+    db_helper.connect()
+    db_helper.insert_data(TENANT_TABLE, {'name': 'broken', 'corpid': CORPID, 'token': TOKEN, 'aeskey': 'short'})
+    db_helper.close()
+    with caplog.at_level(logging.ERROR, logger='api.tenant'):
+        registry.reload()
+    assert registry.get('acme') is not None
+    assert registry.get('broken') is None
+    assert any('broken' in record.getMessage() for record in caplog.records)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+XMLParse.extract 快速扫描与 ElementTree 对拍
+
+语料为 nohup.out 中记录的真实回调 + 构造的边界数据，两种方式的提取结果必须完全一致
+"""
+import os
+import re
+import base64
+import logging
+
+import pytest
+
+from conftest import ROOT
+from WXBizMsgCrypt3 import XMLParse
+
+ENVELOPE = ('<xml><ToUserName><![CDATA[ww4ede9a36781c6e1c]]></ToUserName>'
+            '<Encrypt><![CDATA[%s]]></Encrypt><AgentID><![CDATA[]]></AgentID></xml>')
+ENCRYPT = base64.b64encode(os.urandom(480)).decode()
+
+
+def load_logged_bodies(path=os.path.join(ROOT, 'nohup.out')):
+    """读取 nohup.out 中打印过的回调请求体"""
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8', errors='ignore') as f:
+        return [m.encode() for m in re.findall(r"request_body: b'([^']*)'", f.read())]
+
+
+CORPUS = [('logged-%d' % i, body) for i, body in enumerate(load_logged_bodies())] + [
+    ('plain', ENVELOPE % ENCRYPT),
+    ('bytes', (ENVELOPE % ENCRYPT).encode()),
+    ('large-64k', ENVELOPE % base64.b64encode(os.urandom(48 * 1024)).decode()),
+    ('declaration', '<?xml version="1.0" encoding="utf-8"?>\n' + ENVELOPE % ENCRYPT),
+    ('pretty', '<xml>\n  <ToUserName><![CDATA[ww]]></ToUserName>\n  <Encrypt><![CDATA[%s]]></Encrypt>\n'
+               '  <AgentID>1000005</AgentID>\n</xml>\n' % ENCRYPT),
+    ('reply-template', XMLParse.AES_TEXT_RESPONSE_TEMPLATE % {
+        'msg_encrypt': ENCRYPT, 'msg_signaturet': 'sig', 'timestamp': '1', 'nonce': 'n'}),
+    ('encrypt-first', '<xml><Encrypt><![CDATA[%s]]></Encrypt></xml>' % ENCRYPT),
+    ('empty-encrypt', ENVELOPE % ''),
+    ('newline-in-cdata', ENVELOPE % (ENCRYPT[:10] + '\r\n' + ENCRYPT[10:])),
+    ('tab-in-cdata', ENVELOPE % (ENCRYPT[:10] + '\t' + ENCRYPT[10:])),
+    ('del-in-cdata', ENVELOPE % (ENCRYPT[:10] + '\x7f' + ENCRYPT[10:])),
+    ('non-ascii-in-cdata', ENVELOPE % (ENCRYPT[:10] + '密文' + ENCRYPT[10:])),
+    ('non-ascii-control-in-cdata', ENVELOPE % (ENCRYPT[:10] + '密\x85' + ENCRYPT[10:])),
+    ('plain-text-encrypt', '<xml><Encrypt>%s</Encrypt></xml>' % ENCRYPT),
+    ('duplicate', '<xml><Encrypt><![CDATA[AAAA]]></Encrypt><Encrypt><![CDATA[BBBB]]></Encrypt></xml>'),
+    ('nested', '<xml><Outer><Encrypt><![CDATA[%s]]></Encrypt></Outer></xml>' % ENCRYPT),
+    ('commented', '<xml><!-- <Encrypt><![CDATA[AAAA]]></Encrypt> --><Encrypt><![CDATA[BBBB]]></Encrypt></xml>'),
+    ('in-cdata', '<xml><A><![CDATA[<Encrypt><![CDATA[AAAA]]></A><Encrypt><![CDATA[BBBB]]></Encrypt></xml>'),
+    ('attribute', '<xml><A x="1">v</A><Encrypt><![CDATA[%s]]></Encrypt></xml>' % ENCRYPT),
+    ('control-char', '<xml><A>\x01</A><Encrypt><![CDATA[%s]]></Encrypt></xml>' % ENCRYPT),
+    ('control-char-cdata', '<xml><A><![CDATA[\x1f]]></A><Encrypt><![CDATA[%s]]></Encrypt></xml>' % ENCRYPT),
+    ('control-char-between', '<xml><A>v</A>\x0c<Encrypt><![CDATA[%s]]></Encrypt>\x1c</xml>' % ENCRYPT),
+    ('entity', '<xml><A>a&amp;b</A><Encrypt><![CDATA[%s]]></Encrypt></xml>' % ENCRYPT),
+    ('truncated', (ENVELOPE % ENCRYPT)[:-4]),
+    ('trailing-junk', ENVELOPE % ENCRYPT + '<x/>'),
+    ('leading-space', '  ' + ENVELOPE % ENCRYPT),
+    ('no-encrypt', '<xml><ToUserName><![CDATA[ww]]></ToUserName><MsgType>text</MsgType></xml>'),
+    ('not-xml', 'hello'),
+    ('empty', ''),
+]
+
+
+@pytest.fixture(autouse=True)
+def _quiet_extract():
+    # 语料中故意构造了非法xml，屏蔽 extract 中的错误日志
+    logging.disable(logging.ERROR)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+@pytest.mark.parametrize('body', [body for _, body in CORPUS], ids=[name for name, _ in CORPUS])
+def test_fast_extract_matches_elementtree(body):
+    assert XMLParse(fast=True).extract(body) == XMLParse().extract(body)
+
+
+@pytest.mark.parametrize('name', ['plain', 'bytes', 'large-64k', 'declaration', 'pretty',
+                                  'reply-template', 'encrypt-first', 'non-ascii-in-cdata'])
+def test_common_envelopes_hit_fast_scan(name):
+    body = dict(CORPUS)[name]
+    assert XMLParse().scan_encrypt(body) is not None
+
+
+@pytest.mark.parametrize('name', ['newline-in-cdata', 'tab-in-cdata', 'del-in-cdata',
+                                  'non-ascii-control-in-cdata', 'control-char', 'entity', 'empty-encrypt'])
+def test_unusual_envelopes_fall_back(name):
+    body = dict(CORPUS)[name]
+    assert XMLParse().scan_encrypt(body) is None
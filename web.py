@@ -9,6 +9,11 @@ Email: me@gentlecp.com
 Create Date: 2021/6/19
 -----------------End-----------------------------
 """
+import os
+import re
+import sys
+import json
+import logging
 import argparse
 from fastapi import FastAPI
 from fastapi import Response, Request
@@ -20,83 +25,321 @@ from xml.etree.ElementTree import fromstring  # 可用于对xml格式进行解
 import uvicorn
 from WXBizMsgCrypt3 import XMLParse
 from api.utils import WeChatMsgHandler
+from api.cache import ReplayCache, SharedReplayCache
+from api.tenant import TenantRegistry
+from api.dispatcher import dispatcher
+from api.jobqueue import JobQueue, JobWorkerPool
+from api.utils import run_ai_reply_job
+from api.shared import SharedStore
+from api.log import setup_logging, shutdown_logging, parse_levels, log_payload
+from api.log import setup_request_trace, shutdown_request_trace, log_request_trace
+from api.metrics import REGISTRY, observe_request
+from api.auth import token_manager, TokenRefresher
+from api.api import connection_manager, request_hooks
+from api.ratelimit import rate_limiter, parse_limit
+from api.demo import configure_make_backend, make_backend_stats
+from api.directory import directory, DirectoryRefresher
+from api.customer import customer_cache
+from api.outbox import Outbox, OutboxWorkerPool, configure_outbox
+from api.kfsync import shutdown_prefetch
+from api import config
 
-app = FastAPI()
 # 创建xml解析实例
 xmlparse = XMLParse()
+# 回调数据包中的企业ID，用于在 / 路径上按企业ID选择租户
+TO_USER_NAME_RE = re.compile(rb'<ToUserName><!\[CDATA\[([^\]]{1,64})\]\]></ToUserName>')
+# 多 worker 模式下通过环境变量把命令行参数传给各个 worker 进程
+ARGS_ENV = 'WXROBOT_ARGS'
+
+logger = logging.getLogger('web')
 
 
 # 在这里接收命令行提供的参数
-def parse_args():
+def parse_args(argv=None):
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--port', '-p', default=8000, type=int, help="port to build web server")
     arg_parser.add_argument('--token', '-t', type=str, help='token set in corpwechat app')
     arg_parser.add_argument('--aeskey', '-a', type=str, help='encoding aeskey')
     arg_parser.add_argument('--corpid', '-c', type=str, help='your corpwechat id')
-    args = arg_parser.parse_args()
+    arg_parser.add_argument('--async-mode', action='store_true',
+                            help='ack callbacks right after decrypting, route them in a thread pool')
+    arg_parser.add_argument('--max-workers', default=32, type=int, help='thread pool size for upstream/db work')
+    arg_parser.add_argument('--max-pending', default=1000, type=int, help='max queued callbacks in async mode')
+    arg_parser.add_argument('--job-workers', default=0, type=int,
+                            help='persist callbacks to the sqlite job queue and drain it with N workers (async mode)')
+    arg_parser.add_argument('--outbox-workers', default=0, type=int,
+                            help='persist outgoing kf messages in the sqlite outbox and send them with N workers, '
+                                 'keeping per-customer order')
+    arg_parser.add_argument('--workers', '-w', default=1, type=int, help='number of uvicorn worker processes')
+    arg_parser.add_argument('--shared-state', action='store_true',
+                            help='keep dedup state and sync locks in wechat.db (implied by --workers > 1)')
+    arg_parser.add_argument('--http-max-connections', default=20, type=int,
+                            help='max pooled connections per upstream host')
+    arg_parser.add_argument('--http-keepalive', default=30.0, type=float,
+                            help='seconds an idle upstream connection is kept alive (async client)')
+    arg_parser.add_argument('--rate-limit', action='append', default=[], metavar='ENDPOINT:PER=RATE/BURST',
+                            help='outbound qyapi rate limit, e.g. kf/send_msg:external_userid=0.5/5 or *:corp=100/200')
+    arg_parser.add_argument('--qyapi-base-url', default=None, type=str,
+                            help='base url of the qyapi upstream, e.g. http://127.0.0.1:9000 for bench/standin.py')
+    arg_parser.add_argument('--make-webhook-url', default=None, type=str, help='url of the make.com AI webhook')
+    arg_parser.add_argument('--ai-deadline', default=30.0, type=float, help='deadline in seconds for one make.com call')
+    arg_parser.add_argument('--ai-max-inflight', default=20, type=int, help='max concurrent make.com calls')
+    arg_parser.add_argument('--ai-failure-threshold', default=5, type=int,
+                            help='consecutive make.com failures before the breaker opens')
+    arg_parser.add_argument('--ai-stream', action='store_true',
+                            help='read the make.com answer as a stream and send it to the customer sentence by sentence')
+    arg_parser.add_argument('--ai-recovery-timeout', default=30.0, type=float,
+                            help='seconds the breaker stays open before a half-open probe')
+    arg_parser.add_argument('--token-refresh-interval', default=30, type=float,
+                            help='seconds between background access token refresh checks, 0 to disable')
+    arg_parser.add_argument('--directory-refresh-interval', default=3600, type=float,
+                            help='seconds between employee directory refreshes from user/list_id, 0 to disable')
+    arg_parser.add_argument('--customer-cache-size', default=10000, type=int,
+                            help='max kf customer profiles cached in memory')
+    arg_parser.add_argument('--customer-cache-ttl', default=3600, type=float,
+                            help='seconds a kf customer profile from kf/customer/batchget stays cached')
+    arg_parser.add_argument('--log-level', default='INFO', type=str, help='root log level')
+    arg_parser.add_argument('--log-levels', default='', type=str,
+                            help='per-module log levels, e.g. api.utils=DEBUG,WXBizMsgCrypt3=WARNING')
+    arg_parser.add_argument('--log-sample-rate', default=0.01, type=float,
+                            help='fraction of request bodies/payloads logged at DEBUG level')
+    arg_parser.add_argument('--log-file', default=None, type=str, help='write JSON log lines to this file instead of stdout')
+    arg_parser.add_argument('--trace-file', default=None, type=str,
+                            help='write one JSON line per outbound RequestClient call to this file')
+    args = arg_parser.parse_args(argv)
     return args
 
-args = parse_args()
-wxcpt = WXBizMsgCrypt(args.token, args.aeskey, args.corpid)
-# 统一处理
-handler = WeChatMsgHandler(wxcpt)
 
+def create_app(args=None):
+    """
+    创建 FastAPI 应用
+    :param args: parse_args() 的结果，为 None 时从环境变量 WXROBOT_ARGS 读取(多 worker 模式)
+    """
+    if args is None:
+        args = parse_args(json.loads(os.environ.get(ARGS_ENV, '[]')))
+    # 结构化日志(JSON Lines)，写日志在后台线程中进行，不阻塞事件循环
+    setup_logging(args.log_level, parse_levels(args.log_levels), args.log_sample_rate, args.log_file)
+    dispatcher.configure(max_workers=args.max_workers, max_pending=args.max_pending)
+    # 多进程部署时，去重状态和消息同步锁保存在 wechat.db 中由各 worker 共享
+    shared_store = SharedStore() if args.workers > 1 or args.shared_state else None
+    # 上游接口地址，默认为线上服务
+    if args.qyapi_base_url:
+        config.QYAPI_BASE_URL = args.qyapi_base_url.rstrip('/')
+    if args.make_webhook_url:
+        config.MAKE_WEBHOOK_URL = args.make_webhook_url
+    # 上游接口共用进程内的连接池
+    connection_manager.configure_host(max_connections=args.http_max_connections, keepalive_expiry=args.http_keepalive)
+    # 上游请求的 DNS/连接/首字节耗时、重试次数和响应大小记入 /metrics，指定 --trace-file 时逐条写入文件
+    for hook in (observe_request, log_request_trace):
+        request_hooks.remove(hook)
+    request_hooks.add(post=observe_request)
+    if args.trace_file:
+        setup_request_trace(args.trace_file)
+        request_hooks.add(post=log_request_trace)
+    # 上游接口按接口/企业/客户限流，超限的调用排队
+    for spec in args.rate_limit:
+        rate_limiter.configure(*parse_limit(spec))
+    # AI 后端(make.com)的截止时间、并发上限与熔断
+    configure_make_backend(args.ai_deadline, args.ai_max_inflight, args.ai_failure_threshold, args.ai_recovery_timeout,
+                           args.ai_stream)
+    # access_token 在多进程间共享，由后台线程提前刷新
+    token_manager.store = shared_store
+    token_refresher = TokenRefresher(token_manager, interval=args.token_refresh_interval) \
+        if args.token_refresh_interval > 0 else None
+    # 成员目录缓存在内存中，启动时从 wechat.db 加载，由后台线程定期从 user/list_id 刷新
+    directory.store = shared_store
+    directory_refresher = DirectoryRefresher(directory, interval=args.directory_refresh_interval) \
+        if args.directory_refresh_interval > 0 else None
+    # 客户信息(kf/customer/batchget)缓存在内存中，未命中的客户合并查询
+    customer_cache.max_size = args.customer_cache_size
+    customer_cache.ttl = args.customer_cache_ttl
+    # 所有租户共用一个重放缓存，缓存键中的签名已经包含各自的token
+    if shared_store is not None:
+        replay_cache = SharedReplayCache(shared_store, ttl=300)
+    else:
+        replay_cache = ReplayCache(max_size=10000, ttl=300)
+    # 指定 --job-workers 时回调消息先写入 wechat.db 的任务队列，由工作线程处理
+    job_queue = JobQueue() if args.job_workers > 0 else None
+    # 客服消息的 AI 回复任务落盘后才保存 kf/sync_msg 的 cursor；没有任务队列时单独创建，只处理 ai_reply 任务，
+    # 工作线程数与 make.com 的并发上限一致，每次领取一个任务
+    reply_queue = job_queue or JobQueue()
+    reply_workers = JobWorkerPool(reply_queue, {'ai_reply': run_ai_reply_job}, workers=args.ai_max_inflight,
+                                  batch_size=1) if not job_queue else None
+    # 多租户注册表：命令行参数作为 default 租户，其余租户从 wechat.db 的 tenants 表加载
+    tenants = TenantRegistry(lambda wxcpt, name: WeChatMsgHandler(wxcpt, replay_cache=replay_cache,
+                                                                 job_queue=job_queue, name=name,
+                                                                 shared_store=shared_store,
+                                                                 reply_queue=reply_queue))
+    if args.token and args.aeskey and args.corpid:
+        tenants.add('default', args.corpid, args.token, args.aeskey, persist=False)
+    tenants.reload()
+
+    def run_msg_job(payload):
+        """任务队列中 wechat_msg 任务的处理函数"""
+        tenant = tenants.get(payload['tenant'])
+        if tenant is None:
+            raise LookupError(f"unknown tenant {payload['tenant']}")
+        tenant.handler._route(payload['msg'])
+
+    # 指定 --outbox-workers 时发给客户的消息先写入 wechat.db 的发件箱，按客户顺序发送，失败重试
+    outbox = Outbox() if args.outbox_workers > 0 else None
+    configure_outbox(outbox)
+    outbox_workers = OutboxWorkerPool(outbox, workers=args.outbox_workers) if outbox else None
+
+    job_workers = JobWorkerPool(job_queue, {'wechat_msg': run_msg_job, 'ai_reply': run_ai_reply_job},
+                                workers=args.job_workers) if job_queue else None
+
+    app = FastAPI()
+    app.state.args = args
+    app.state.tenants = tenants
+    app.state.replay_cache = replay_cache
+    app.state.job_queue = job_queue
+
+    @app.on_event("startup")
+    async def startup():
+        # 线程池中的路由处理需要把协程交回主事件循环
+        dispatcher.bind_loop()
+        if job_workers:
+            job_workers.start()
+        if reply_workers:
+            reply_workers.start()
+        if outbox_workers:
+            outbox_workers.start()
+        if token_refresher:
+            token_refresher.start()
+        if directory_refresher:
+            await dispatcher.run_blocking(directory.load)
+            directory_refresher.start()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        # ai_reply 任务在工作线程中等待事件循环上的协程，等待线程退出时不能阻塞事件循环
+        if job_workers:
+            await dispatcher.run_blocking(job_workers.stop)
+        if reply_workers:
+            await dispatcher.run_blocking(reply_workers.stop)
+        if outbox_workers:
+            outbox_workers.stop()
+        if token_refresher:
+            token_refresher.stop()
+        if directory_refresher:
+            directory_refresher.stop()
+        shutdown_prefetch()
+        await connection_manager.aclose()
+        dispatcher.shutdown(wait=False)
+        shutdown_request_trace()
+        shutdown_logging()
+
+    @app.get("/stats")
+    async def stats():
+        """队列深度、任务等待时间、重放缓存命中等运行指标"""
+        result = {
+            'pid': os.getpid(),
+            'replay_cache': replay_cache.stats(),
+            'dispatcher': {'pending': dispatcher.pending, 'max_pending': dispatcher.max_pending},
+            'ai_backend': make_backend_stats(),
+            'directory': {'employees': len(directory), 'refreshed_at': directory.refreshed_at},
+            'customer_cache': customer_cache.stats(),
+        }
+        result['job_queue'] = await dispatcher.run_blocking(reply_queue.stats)
+        if outbox:
+            result['outbox'] = await dispatcher.run_blocking(outbox.stats)
+        return result
+
+    @app.get("/metrics")
+    async def metrics():
+        """Prometheus 文本格式的各阶段耗时、上游接口耗时与消息/错误计数，仅在抓取时生成"""
+        return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    async def resolve_tenant(name=None, request_body=None):
+        """按路径名或数据包中的企业ID查找租户，都找不到时使用 default 租户；未命中时重新加载数据库在线程池中进行"""
+        if name is not None:
+            return await tenants.aget(name)
+        if request_body:
+            match = TO_USER_NAME_RE.search(request_body, 0, 512)
+            if match:
+                tenant = await tenants.aget_by_corpid(match.group(1).decode('utf-8', 'ignore'))
+                if tenant is not None:
+                    return tenant
+        return await tenants.aget('default')
 
-'''
-    验证配置是否成功，处理get请求
-    :param msg_signature:
-    :param timestamp:
-    :param nonce:
-    :param echostr:
-    :return:
     '''
-@app.get("/")
-async def verify(msg_signature: str,
-                 timestamp: str,
-                 nonce: str,
-                 echostr: str):
-    
-    ret, sEchoStr = wxcpt.VerifyURL(msg_signature, timestamp, nonce, echostr)
-    print("正在进行鉴权",ret,sEchoStr)
-    
-    if ret == 0:
-        return Response(content=sEchoStr.decode('utf-8'))
-    else:
-        print(sEchoStr)
+        验证配置是否成功，处理get请求
+        :param msg_signature:
+        :param timestamp:
+        :param nonce:
+        :param echostr:
+        :return:
+        '''
+    @app.get("/")
+    @app.get("/{tenant_name}")
+    async def verify(msg_signature: str,
+                     timestamp: str,
+                     nonce: str,
+                     echostr: str,
+                     tenant_name: str = None):
 
+        tenant = await resolve_tenant(tenant_name)
+        if tenant is None:
+            return Response(content="unknown tenant", status_code=404)
+        ret, sEchoStr = tenant.wxcpt.VerifyURL(msg_signature, timestamp, nonce, echostr)
+        logger.info("Verify url", extra={'tenant': tenant.name, 'ret': ret})
 
+        if ret == 0:
+            return Response(content=sEchoStr.decode('utf-8'))
+        else:
+            logger.warning("Verify url failed", extra={'tenant': tenant.name, 'ret': ret})
 
-"""
-企业微信消息回调接口
-参数顺序规则：
-1. 普通参数(request)
-2. 有默认值的参数(Query参数)
-"""
-@app.post("/")
-async def wechat_callback(
-    request: Request,
-    msg_signature: str = Query(...),  # 企业微信签名
-    timestamp: str = Query(...),      # 时间戳
-    nonce: str = Query(...)           # 随机数
-):
-    
-    request_body = await request.body()
-    print("响应体request_body:",request_body,'\n')
-    # 统一处理
-    ret,response = handler.process_request({
-        'msg_signature': msg_signature,
-        'timestamp': timestamp,
-        'nonce': nonce,
-        'request_body': request_body
-    })
+
+
+    """
+    企业微信消息回调接口
+    参数顺序规则：
+    1. 普通参数(request)
+    2. 有默认值的参数(Query参数)
+    """
+    @app.post("/")
+    @app.post("/{tenant_name}")
+    async def wechat_callback(
+        request: Request,
+        msg_signature: str = Query(...),  # 企业微信签名
+        timestamp: str = Query(...),      # 时间戳
+        nonce: str = Query(...),          # 随机数
+        tenant_name: str = None
+    ):
     
-    print("wechat_callback->response:", ret,response,'\n')
+        request_body = await request.body()
+        log_payload(logger, "Callback body", body=request_body)
+        tenant = await resolve_tenant(tenant_name, request_body)
+        if tenant is None:
+            return Response(content="unknown tenant", status_code=404)
+        request_data = {
+            'msg_signature': msg_signature,
+            'timestamp': timestamp,
+            'nonce': nonce,
+            'request_body': request_body
+        }
+        if args.async_mode or job_queue:
+            # 验签解密后立即返回，路由处理在线程池中进行
+            ret,response = await tenant.handler.process_request_async(request_data)
+        else:
+            # 统一处理
+            ret,response = tenant.handler.process_request(request_data)
     
-    if ret != 0:
-        return Response(content=response, status_code=400)
+        if ret != 0:
+            logger.warning("Callback failed", extra={'tenant': tenant.name, 'ret': ret, 'error': response})
+            return Response(content=response, status_code=400)
     
-    return Response(content=response if response else "")
+        return Response(content=response if response else "")
+
+    return app
 
 
 if __name__ == "__main__":
-    uvicorn.run("web:app", port=args.port, host='0.0.0.0', reload=False,debug=True)
+    args = parse_args()
+    if args.workers > 1:
+        # 多 worker 时 uvicorn 需要通过导入路径在每个子进程中创建应用
+        os.environ[ARGS_ENV] = json.dumps(sys.argv[1:])
+        uvicorn.run("web:create_app", factory=True, port=args.port, host='0.0.0.0', workers=args.workers)
+    else:
+        uvicorn.run(create_app(args), port=args.port, host='0.0.0.0')